@@ -0,0 +1,283 @@
+"""Throughput benchmark for the copy/verify write path.
+
+Generates synthetic images (random, zero-heavy, mixed) and writes them to
+image files on tmpfs and on disk across chunk sizes, queue depths, buffered
+vs O_DIRECT, copy backends (the pipelined engine, the kernel copy_file_range,
+sendfile and splice paths, a plain copyfileobj loop) and cache-friendly mode
+on or off. Prints a table and optionally writes a JSON
+report; --baseline compares against an earlier report and exits non-zero
+when throughput dropped by more than --tolerance.
+
+    python benchmarks/bench_write_path.py --sizes 64M --json report.json
+    python benchmarks/bench_write_path.py --baseline report.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from usbcreator.engine import FanOutCopier, TargetVerifier, drop_cached_pages  # noqa: E402
+from usbcreator.zerocopy import KERNEL_BACKENDS, KernelCopier, ZeroCopyUnsupported, available_backends  # noqa: E402
+
+PATTERNS = ("random", "zero", "mixed")
+CACHE_MODES = ("normal", "friendly")
+
+
+def parse_size(text):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper()
+    if text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def format_size(size):
+    for unit, factor in (("G", 1024 ** 3), ("M", 1024 ** 2), ("K", 1024)):
+        if size >= factor and size % factor == 0:
+            return f"{size // factor}{unit}"
+    return str(size)
+
+
+def make_image(path, size, pattern):
+    # random: incompressible data; zero: 90% zero padding like a mostly empty
+    # hybrid ISO; mixed: alternating 1 MiB runs of data and zeros
+    block = 1024 * 1024
+    with open(path, "wb") as f:
+        written = 0
+        index = 0
+        while written < size:
+            count = min(block, size - written)
+            if pattern == "random":
+                data = os.urandom(count)
+            elif pattern == "zero":
+                data = os.urandom(count) if index % 10 == 0 else bytes(count)
+            else:
+                data = os.urandom(count) if index % 2 == 0 else bytes(count)
+            f.write(data)
+            written += count
+            index += 1
+
+
+def default_workdirs():
+    workdirs = []
+    if os.path.isdir("/dev/shm"):
+        workdirs.append(("tmpfs", "/dev/shm"))
+    workdirs.append(("disk", tempfile.gettempdir()))
+    return workdirs
+
+
+def forget_source(path):
+    # Keep the page cache from turning every run after the first into a memcpy
+    with open(path, "rb") as f:
+        drop_cached_pages(f.fileno())
+
+
+def copy_pipelined(source, target, chunk_size, queue_depth, direct, skip_zeros, verify, cache_friendly):
+    copier = FanOutCopier(source, [target], chunk_size=chunk_size, queue_depth=queue_depth,
+                          direct=direct, skip_zeros=skip_zeros, hash_source=verify,
+                          cache_friendly=cache_friendly)
+    writer = copier.run()[0]
+    if writer.error:
+        raise writer.error
+    return copier, writer.direct
+
+
+def kernel_copy(backend):
+    # KernelCopier pinned to one backend; it has no queue, no O_DIRECT and
+    # no zero skipping
+    def copy(source, target, chunk_size, queue_depth, direct, skip_zeros, verify, cache_friendly):
+        copier = KernelCopier(source, [target], chunk_size=chunk_size, hash_source=verify,
+                              backend=backend, cache_friendly=cache_friendly)
+        writer = copier.run()[0]
+        if writer.error:
+            raise writer.error
+        return copier, False
+    return copy
+
+
+def copy_copyfileobj(source, target, chunk_size, queue_depth, direct, skip_zeros, verify, cache_friendly):
+    # Single-threaded baseline, what a plain "dd bs=N" amounts to
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        shutil.copyfileobj(src, dst, chunk_size)
+        dst.flush()
+        os.fsync(dst.fileno())
+    return None, False
+
+
+BACKENDS = {
+    "pipelined": copy_pipelined,
+    **{backend: kernel_copy(backend) for backend in KERNEL_BACKENDS},
+    "copyfileobj": copy_copyfileobj,
+}
+
+
+def run_case(source, target, size, backend, chunk_size, queue_depth, direct, skip_zeros, verify,
+             cache_friendly):
+    if os.path.exists(target):
+        os.remove(target)
+    forget_source(source)
+
+    started = time.perf_counter()
+    copier, direct_used = BACKENDS[backend](source, target, chunk_size, queue_depth, direct, skip_zeros, verify,
+                                            cache_friendly)
+    copy_seconds = time.perf_counter() - started
+
+    verify_seconds = None
+    if verify and copier:
+        started = time.perf_counter()
+        TargetVerifier(source, target, copier.source_digests, chunk_size=chunk_size).run()
+        verify_seconds = time.perf_counter() - started
+
+    return {
+        "copy_seconds": round(copy_seconds, 4),
+        "copy_mb_s": round(size / copy_seconds / (1024 * 1024), 1),
+        "verify_seconds": round(verify_seconds, 4) if verify_seconds else None,
+        "verify_mb_s": round(size / verify_seconds / (1024 * 1024), 1) if verify_seconds else None,
+        "direct_used": direct_used,
+    }
+
+
+def case_key(case):
+    # Reports from before the cache column only have normal runs
+    return "/".join(str(case.get(k, "normal")) for k in ("workdir", "pattern", "size", "backend", "chunk_size",
+                                                         "queue_depth", "io", "skip_zeros", "cache"))
+
+
+def iter_cases(args, workdirs):
+    for (label, _), pattern, size, backend in itertools.product(workdirs, args.patterns, args.sizes, args.backends):
+        # Only the pipelined engine has a queue and O_DIRECT, the baseline
+        # loop has no cache-friendly mode either
+        depths = args.queue_depths if backend == "pipelined" else [1]
+        modes = args.io if backend == "pipelined" else ["buffered"]
+        caches = args.cache if backend != "copyfileobj" else ["normal"]
+        for chunk_size, queue_depth, io, cache in itertools.product(args.chunk_sizes, depths, modes, caches):
+            yield {"workdir": label, "pattern": pattern, "size": size, "backend": backend,
+                   "chunk_size": chunk_size, "queue_depth": queue_depth, "io": io,
+                   "skip_zeros": args.skip_zeros, "cache": cache}
+
+
+def print_table(results):
+    header = f"{'workdir':7} {'pattern':7} {'size':>5} {'backend':15} {'chunk':>5} {'qd':>3} {'io':8} " \
+             f"{'cache':8} {'copy MB/s':>10} {'verify MB/s':>11}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        verify = f"{r['verify_mb_s']:.1f}" if r.get("verify_mb_s") else "-"
+        io = r["io"] if r["io"] == "buffered" or r["direct_used"] else "direct*"
+        print(f"{r['workdir']:7} {r['pattern']:7} {format_size(r['size']):>5} {r['backend']:15} "
+              f"{format_size(r['chunk_size']):>5} {r['queue_depth']:>3} {io:8} {r['cache']:8} "
+              f"{r['copy_mb_s']:>10.1f} {verify:>11}")
+    if any(r["io"] == "direct" and not r["direct_used"] for r in results):
+        print("* O_DIRECT not supported there, fell back to buffered writes")
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = {case_key(r): r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        old = baseline.get(case_key(r))
+        if old and r["copy_mb_s"] < old["copy_mb_s"] * (1 - tolerance):
+            regressions.append((case_key(r), old["copy_mb_s"], r["copy_mb_s"]))
+    for key, old, new in regressions:
+        print(f"REGRESSION {key}: {old:.1f} -> {new:.1f} MB/s")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the copy/verify write path")
+    parser.add_argument("--sizes", default="64M", help="Comma separated image sizes (default 64M)")
+    parser.add_argument("--patterns", default=",".join(PATTERNS), help="random, zero and/or mixed")
+    parser.add_argument("--chunk-sizes", default="256K,1M,4M,16M")
+    parser.add_argument("--queue-depths", default="1,2,4,8")
+    parser.add_argument("--io", default="buffered,direct", help="buffered and/or direct")
+    # Kernel backends this Python lacks are left out of the default set
+    backends = [name for name in BACKENDS if name not in KERNEL_BACKENDS or name in available_backends()]
+    parser.add_argument("--backends", default=",".join(backends),
+                        help="pipelined, copy_file_range, sendfile, splice and/or copyfileobj")
+    parser.add_argument("--cache", default=",".join(CACHE_MODES),
+                        help="normal and/or friendly, the write path's cache-friendly mode")
+    parser.add_argument("--workdir", action="append", default=[],
+                        help="Directory to write images to, as LABEL=PATH (default tmpfs and disk)")
+    parser.add_argument("--skip-zeros", action="store_true", help="Enable zero-block skipping")
+    parser.add_argument("--no-verify", dest="verify", action="store_false", help="Only measure the copy")
+    parser.add_argument("--json", help="Write the report to this file")
+    parser.add_argument("--baseline", help="Compare against an earlier JSON report")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="Allowed throughput drop against the baseline (default 0.15)")
+    args = parser.parse_args(argv)
+
+    args.sizes = [parse_size(s) for s in args.sizes.split(",")]
+    args.patterns = args.patterns.split(",")
+    args.chunk_sizes = [parse_size(s) for s in args.chunk_sizes.split(",")]
+    args.queue_depths = [int(d) for d in args.queue_depths.split(",")]
+    args.io = args.io.split(",")
+    args.backends = args.backends.split(",")
+    for backend in args.backends:
+        if backend not in BACKENDS:
+            parser.error(f"unknown backend {backend}, choose from {', '.join(BACKENDS)}")
+    args.cache = args.cache.split(",")
+    for cache in args.cache:
+        if cache not in CACHE_MODES:
+            parser.error(f"unknown cache mode {cache}, choose from {', '.join(CACHE_MODES)}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdirs = [tuple(w.split("=", 1)) for w in args.workdir] or default_workdirs()
+
+    results = []
+    sources = {}
+    try:
+        for case in iter_cases(args, workdirs):
+            workdir = dict(workdirs)[case["workdir"]]
+            # Images are generated once per workdir/pattern/size and reused
+            source_key = (case["workdir"], case["pattern"], case["size"])
+            if source_key not in sources:
+                path = os.path.join(workdir, f"bench-{case['pattern']}-{case['size']}.iso")
+                make_image(path, case["size"], case["pattern"])
+                sources[source_key] = path
+            target = os.path.join(workdir, "bench-target.img")
+            try:
+                result = run_case(sources[source_key], target, case["size"], case["backend"],
+                                  case["chunk_size"], case["queue_depth"], case["io"] == "direct",
+                                  case["skip_zeros"], args.verify, case["cache"] == "friendly")
+            except ZeroCopyUnsupported as e:
+                # e.g. copy_file_range between file systems that do not support it
+                print(f"Skipping {case_key(case)}: {e}")
+                continue
+            finally:
+                if os.path.exists(target):
+                    os.remove(target)
+            results.append(dict(case, **result))
+    finally:
+        for path in sources.values():
+            os.remove(path)
+
+    print_table(results)
+    report = {
+        "host": platform.node(),
+        "system": f"{platform.system()} {platform.release()}",
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline and compare(results, args.baseline, args.tolerance):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
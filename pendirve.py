@@ -1,12 +1,28 @@
 import os
-import sys
-import subprocess
 import threading
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 from tkinter.scrolledtext import ScrolledText
 import time
 import platform
+import sys
+
+from usbcreator.analysis import analyze_iso, describe_image
+from usbcreator.checksums import describe_checksums, verify_checksums
+from usbcreator.compressed import IMAGE_PATTERNS
+from usbcreator.drive_index import DriveIndex
+from usbcreator.drives import DriveProber
+from usbcreator.event_log import EventLog
+from usbcreator.events import EventQueue
+from usbcreator.health import check_targets, health_problems, image_bytes
+from usbcreator.jobqueue import JobQueue, Scheduler, run_queued_jobs
+from usbcreator.metrics import ImagingMetrics, JobTrace, MetricsFile, MetricsServer, media_label
+from usbcreator.stats import describe_rate
+
+# How often queued worker updates are applied to the widgets
+UI_TICK_MS = 50
+# Only the most recent lines stay in the log widget, the full history goes to the log file
+LOG_VIEW_LINES = 1000
 
 class ModernUIApp(tk.Tk):
     def __init__(self):
@@ -127,14 +143,77 @@ class BootableUSBCreator(ttk.Frame):
         self.iso_path = tk.StringVar()
         self.selected_drive = tk.StringVar()
         self.format_drive = tk.BooleanVar(value=True)
+        self.skip_zeros = tk.BooleanVar(value=False)
+        self.verify_write = tk.BooleanVar(value=True)
+        self.autotune = tk.BooleanVar(value=False)
+        self.delta_write = tk.BooleanVar(value=False)
+        self.cache_friendly = tk.BooleanVar(value=False)
+        self.health_check = tk.BooleanVar(value=False)
+        # Paths of drives whose check is still running
+        self.checking_drives = set()
         self.drive_list = []
+        # Bumped on every refresh so late probe results of an older one are dropped
+        self.probe_generation = 0
         self.is_processing = False
+        # Percent done per running job id, the bar shows their mean
+        self.job_progress = {}
+        self.finished_jobs = []
+        
+        # Worker threads never touch Tk directly, they post here and the
+        # main loop applies the updates every UI_TICK_MS
+        self.ui_events = EventQueue()
+        
+        # Every event is also persisted as JSON lines in the background
+        try:
+            self.event_log = EventLog()
+        except OSError:
+            self.event_log = None
+        
+        # Unattended imaging stations export metrics over HTTP on localhost
+        # and/or to a file, and can keep a profile of every job
+        self.metrics = None
+        metrics_port = os.environ.get("USBCREATOR_METRICS_PORT")
+        metrics_file = os.environ.get("USBCREATOR_METRICS_FILE")
+        if metrics_port or metrics_file:
+            self.metrics = ImagingMetrics()
+            try:
+                if metrics_port:
+                    MetricsServer(self.metrics.registry, int(metrics_port))
+                if metrics_file:
+                    MetricsFile(self.metrics.registry, metrics_file)
+            except (OSError, ValueError) as e:
+                self.log(f"Could not export metrics: {e}")
+        self.profile_jobs = os.environ.get("USBCREATOR_PROFILE") == "1"
+        
+        # On Linux the drive list is kept up to date from sysfs hotplug events;
+        # the index seeds itself on the watcher thread, not here, while the
+        # prober fills the list, so startup drives are not logged as added
+        self.drive_index = None
+        if sys.platform.startswith('linux'):
+            self.drive_index = DriveIndex(scan=False)
         
         # Create UI
         self.create_header()
         self.create_content_frame()
         self.refresh_drives()
         
+        if self.drive_index:
+            # The watcher runs on its own thread, changes are applied from the Tk loop
+            self.drive_index.watch(lambda *changes: self.ui_events.call(self.apply_drive_changes, *changes),
+                                   seed=True)
+        self.after(UI_TICK_MS, self.process_ui_events)
+        
+        # Every selected drive becomes a job in ~/.usbcreator/jobs.json;
+        # drives queued for the same image on different USB buses are
+        # written in one pass
+        self.jobs = JobQueue()
+        self.jobs.clear_finished()
+        self.scheduler = Scheduler(self.jobs, self.process_jobs, bus_of=self.bus_of,
+                                   on_finish=self.on_job_finished,
+                                   on_idle=lambda: self.ui_events.call(self.finish_processing))
+        if self.jobs.jobs("pending"):
+            self.after(UI_TICK_MS, self.offer_resume)
+        
     def create_header(self):
         # Header frame
         header_frame = ttk.Frame(self)
@@ -212,7 +291,8 @@ class BootableUSBCreator(ttk.Frame):
         listbox_frame = ttk.Frame(self.drive_listbox_frame)
         listbox_frame.pack(fill=tk.BOTH, expand=True)
         
-        self.drive_listbox = tk.Listbox(listbox_frame, height=4, selectmode=tk.SINGLE, 
+        # Several drives can be selected to write them all in one pass
+        self.drive_listbox = tk.Listbox(listbox_frame, height=4, selectmode=tk.EXTENDED, 
                                         activestyle='none', borderwidth=1, relief="solid")
         self.drive_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         
@@ -233,6 +313,30 @@ class BootableUSBCreator(ttk.Frame):
         ttk.Checkbutton(config_frame, text="Format drive before creating bootable USB", 
                         variable=self.format_drive).pack(anchor=tk.W, pady=(0, 10))
         
+        # Sparse write checkbox
+        ttk.Checkbutton(config_frame, text="Skip zero blocks (image files, drives that can zero themselves)", 
+                        variable=self.skip_zeros).pack(anchor=tk.W, pady=(0, 10))
+        
+        # Verify checkbox
+        ttk.Checkbutton(config_frame, text="Verify drive after writing", 
+                        variable=self.verify_write).pack(anchor=tk.W, pady=(0, 10))
+        
+        # Autotune checkbox
+        ttk.Checkbutton(config_frame, text="Tune block size for this drive model", 
+                        variable=self.autotune).pack(anchor=tk.W, pady=(0, 10))
+        
+        # Delta re-flash checkbox
+        ttk.Checkbutton(config_frame, text="Only rewrite blocks that changed (re-flash)", 
+                        variable=self.delta_write).pack(anchor=tk.W, pady=(0, 10))
+        
+        # Page cache friendly writes checkbox
+        ttk.Checkbutton(config_frame, text="Flush as I go (keeps memory free on shared machines)", 
+                        variable=self.cache_friendly).pack(anchor=tk.W, pady=(0, 10))
+        
+        # Media check checkbox
+        ttk.Checkbutton(config_frame, text="Check drives first (fake capacity, slow media)", 
+                        variable=self.health_check).pack(anchor=tk.W, pady=(0, 10))
+        
         # File system options
         fs_frame = ttk.Frame(config_frame)
         fs_frame.pack(fill=tk.X, pady=(0, 10))
@@ -282,6 +386,11 @@ class BootableUSBCreator(ttk.Frame):
         status_label = ttk.Label(footer_frame, textvariable=self.status_var)
         status_label.pack(side=tk.LEFT)
         
+        # Throughput, ETA and bytes done/total while copying or verifying
+        self.rate_var = tk.StringVar(value="")
+        rate_label = ttk.Label(footer_frame, textvariable=self.rate_var, style="Subtitle.TLabel")
+        rate_label.pack(side=tk.LEFT)
+        
         # Progress bar
         self.progress = ttk.Progressbar(footer_frame, orient=tk.HORIZONTAL, length=300, mode='determinate')
         self.progress.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=10)
@@ -294,12 +403,68 @@ class BootableUSBCreator(ttk.Frame):
     def browse_iso(self):
         filename = filedialog.askopenfilename(
             title="Select ISO file",
-            filetypes=(("ISO files", "*.iso"), ("All files", "*.*"))
+            filetypes=(("Disk images", IMAGE_PATTERNS), ("ISO files", "*.iso"), ("All files", "*.*"))
         )
         if filename:
             self.iso_path.set(filename)
             self.log(f"ISO file selected: {os.path.basename(filename)}")
-            self.status_var.set(f"ISO selected: {os.path.basename(filename)}")
+            self.status_var.set(f"Analyzing {os.path.basename(filename)}...")
+            analysis_thread = threading.Thread(target=self.analyze_selected_iso, args=(filename,))
+            analysis_thread.daemon = True
+            analysis_thread.start()
+            checksum_thread = threading.Thread(target=self.check_selected_iso, args=(filename,))
+            checksum_thread.daemon = True
+            checksum_thread.start()
+    
+    def analyze_selected_iso(self, filename):
+        # Runs off the UI thread, cached results come back immediately
+        try:
+            info = analyze_iso(filename)
+        except OSError as e:
+            self.log(f"Could not analyze {os.path.basename(filename)}: {e}")
+            self.ui_events.call(self.status_var.set, "Ready")
+            return
+        for line in describe_image(info):
+            self.log(line)
+        self.ui_events.call(self.show_iso_info, filename, info)
+    
+    def check_selected_iso(self, filename):
+        # Hashes the image against SHA256SUMS & co. next to it, off the UI
+        # thread; unchanged images are answered from the checksum cache
+        name = os.path.basename(filename)
+        last_percent = [-1]
+        
+        def on_progress(done, total):
+            percent = int(100 * done / (total or 1))
+            if percent // 10 != last_percent[0] // 10:
+                last_percent[0] = percent
+                self.log(f"Checking checksum of {name}: {percent}%")
+        
+        try:
+            result = verify_checksums(filename, progress_callback=on_progress)
+        except OSError as e:
+            self.log(f"Could not check the checksum of {name}: {e}")
+            return
+        for line in describe_checksums(result):
+            self.log(line)
+        if result["status"] == "mismatch":
+            details = "\n".join(f"{check['algorithm'].upper()} ({check['source']}):\n"
+                                f"  expected {check['expected']}\n  actual   {check['actual']}"
+                                for check in result["checks"] if not check["ok"])
+            self.ui_events.call(messagebox.showerror, "Checksum mismatch",
+                                f"{name} does not match its published checksum. The download is "
+                                f"probably corrupt or incomplete.\n\n{details}")
+    
+    def show_iso_info(self, filename, info):
+        if self.iso_path.get() != filename:
+            # Another ISO was picked in the meantime
+            return
+        label = f" ({info['label']})" if info["label"] else ""
+        self.status_var.set(f"ISO selected: {info['name']}{label} - {', '.join(info['boot_modes']) or 'not bootable'}")
+        if not info["boot_modes"]:
+            messagebox.showwarning("Image may not boot",
+                                   f"{info['name']} has no BIOS or UEFI boot record:\n\n"
+                                   + "\n".join(info["warnings"]))
     
     def refresh_drives(self):
         self.log("Scanning for USB drives...")
@@ -308,157 +473,95 @@ class BootableUSBCreator(ttk.Frame):
         # Clear previous drive list
         self.drive_list = []
         self.drive_listbox.delete(0, tk.END)
-        
-        if sys.platform == 'win32':
-            try:
-                # Correct import for Windows drive detection
-                import win32file
-                import win32api
-                
-                # Get drive letters
-                drives = win32api.GetLogicalDriveStrings()
-                drives = drives.split('\000')[:-1]
-                
-                for drive in drives:
-                    # Use win32file.GetDriveType instead of win32api.GetDriveType
-                    if win32file.GetDriveType(drive) == win32file.DRIVE_REMOVABLE:
-                        drive_info = {"path": drive, "label": drive}
-                        # Get drive info
-                        try:
-                            vol_info = win32api.GetVolumeInformation(drive)
-                            vol_name = vol_info[0] if vol_info[0] else "No Label"
-                            fs_type = vol_info[4]
-                            drive_info["label"] = f"{drive} ({vol_name})"
-                            drive_info["fs"] = fs_type
-                            
-                            # Get drive size
-                            sectors, bytes_per_sector, _, free_clusters, _ = win32api.GetDiskFreeSpace(drive)
-                            total_space = (sectors * bytes_per_sector) / (1024 * 1024 * 1024)  # in GB
-                            free_space = (free_clusters * bytes_per_sector) / (1024 * 1024 * 1024)  # in GB
-                            
-                            drive_info["size"] = f"{total_space:.2f} GB"
-                            drive_info["free"] = f"{free_space:.2f} GB"
-                            drive_info["display"] = f"{drive} ({vol_name}) - {total_space:.1f} GB [{fs_type}]"
-                            
-                            self.drive_list.append(drive_info)
-                            self.drive_listbox.insert(tk.END, drive_info["display"])
-                        except Exception as e:
-                            self.log(f"Warning: Could not get full info for {drive}: {str(e)}")
-                            drive_info["display"] = f"{drive} (Unknown)"
-                            self.drive_list.append(drive_info)
-                            self.drive_listbox.insert(tk.END, drive_info["display"])
-            except ImportError:
-                # Fallback if win32api/win32file is not available
-                self.log("Warning: win32file/win32api modules not available. Using simulated drives.")
-                for drive in ["D:", "E:", "F:"]:
-                    drive_info = {
-                        "path": drive,
-                        "label": drive,
-                        "display": f"{drive} (Simulated Drive)",
-                        "size": "8.0 GB",
-                        "free": "7.5 GB",
-                        "fs": "FAT32"
-                    }
-                    self.drive_list.append(drive_info)
-                    self.drive_listbox.insert(tk.END, drive_info["display"])
-        else:
-            # Linux/Mac implementation
-            if sys.platform.startswith('linux'):
-                try:
-                    # Try to get drives from 'lsblk' command
-                    output = subprocess.check_output(['lsblk', '-d', '-n', '-o', 'NAME,SIZE,MODEL']).decode('utf-8')
-                    for line in output.strip().split('\n'):
-                        parts = line.split()
-                        if parts and parts[0].startswith('sd') and not parts[0].endswith('1'):
-                            dev_name = f"/dev/{parts[0]}"
-                            size = parts[1] if len(parts) > 1 else "?"
-                            model = ' '.join(parts[2:]) if len(parts) > 2 else "USB Drive"
-                            
-                            drive_info = {
-                                "path": dev_name,
-                                "label": model,
-                                "size": size,
-                                "display": f"{dev_name} ({model}) - {size}"
-                            }
-                            self.drive_list.append(drive_info)
-                            self.drive_listbox.insert(tk.END, drive_info["display"])
-                except Exception as e:
-                    self.log(f"Error detecting Linux drives: {str(e)}")
-                    # Fallback
-                    for dev in ["/dev/sdb", "/dev/sdc"]:
-                        drive_info = {
-                            "path": dev,
-                            "label": "USB Drive",
-                            "display": f"{dev} (USB Drive)",
-                            "size": "8.0 GB"
-                        }
-                        self.drive_list.append(drive_info)
-                        self.drive_listbox.insert(tk.END, drive_info["display"])
-            elif sys.platform == 'darwin':  # macOS
-                try:
-                    output = subprocess.check_output(['diskutil', 'list', 'external']).decode('utf-8')
-                    current_disk = None
-                    for line in output.strip().split('\n'):
-                        if line.startswith('/dev/'):
-                            current_disk = line.split()[0]
-                            
-                            # Get disk info
-                            disk_info = subprocess.check_output(['diskutil', 'info', current_disk]).decode('utf-8')
-                            
-                            # Extract name and size
-                            name = "External Drive"
-                            size = "Unknown"
-                            
-                            for info_line in disk_info.split('\n'):
-                                if "Volume Name" in info_line and ":" in info_line:
-                                    name = info_line.split(':', 1)[1].strip()
-                                if "Disk Size" in info_line and ":" in info_line:
-                                    size = info_line.split(':', 1)[1].strip()
-                            
-                            drive_info = {
-                                "path": current_disk,
-                                "label": name,
-                                "size": size,
-                                "display": f"{current_disk} ({name}) - {size}"
-                            }
-                            self.drive_list.append(drive_info)
-                            self.drive_listbox.insert(tk.END, drive_info["display"])
-                except Exception as e:
-                    self.log(f"Error detecting macOS drives: {str(e)}")
-                    # Fallback
-                    for disk in ["/dev/disk2", "/dev/disk3"]:
-                        drive_info = {
-                            "path": disk,
-                            "label": "External Drive",
-                            "display": f"{disk} (External Drive)",
-                            "size": "8.0 GB"
-                        }
-                        self.drive_list.append(drive_info)
-                        self.drive_listbox.insert(tk.END, drive_info["display"])
+        self.update_drive_combobox()
+        
+        # Drives are probed in parallel on worker threads; each one shows up
+        # as "probing..." and is filled in as soon as it answers
+        self.probe_generation += 1
+        generation = self.probe_generation
+        
+        def on_done(drives):
+            if self.metrics:
+                self.metrics.observe_scan(prober)
+            self.ui_events.call(self.finish_refresh, generation)
+        
+        prober = DriveProber(
+            on_update=lambda path, info: self.ui_events.call(self.apply_probe_result, generation, path, info),
+            on_done=on_done, log=self.log)
+        prober.start()
+    
+    def apply_probe_result(self, generation, path, drive_info):
+        if generation != self.probe_generation:
+            return
+        paths = [d["path"] for d in self.drive_list]
+        if path in paths:
+            index = paths.index(path)
+            self.drive_listbox.delete(index)
+            if drive_info:
+                self.drive_list[index] = drive_info
+                self.drive_listbox.insert(index, drive_info["display"])
             else:
-                # Unknown platform, use simulated drives
-                for i in range(1, 3):
-                    drive_info = {
-                        "path": f"DRIVE{i}",
-                        "label": f"Simulated Drive {i}",
-                        "display": f"Simulated Drive {i} - 8.0 GB",
-                        "size": "8.0 GB"
-                    }
-                    self.drive_list.append(drive_info)
-                    self.drive_listbox.insert(tk.END, drive_info["display"])
-                
-        # Update the combobox
+                del self.drive_list[index]
+        elif drive_info:
+            self.drive_list.append(drive_info)
+            self.drive_listbox.insert(tk.END, drive_info["display"])
+        self.update_drive_combobox()
+    
+    def finish_refresh(self, generation):
+        if generation != self.probe_generation:
+            return
+        found = [d for d in self.drive_list if not d.get("probing")]
+        if found:
+            self.log(f"Found {len(found)} removable drives")
+            self.status_var.set(f"Found {len(found)} removable drives")
+        elif self.drive_list:
+            self.status_var.set("Waiting for drives to respond...")
+        else:
+            self.log("No removable drives found. Please insert a USB drive.")
+            self.status_var.set("No USB drives detected")
+    
+    def update_drive_combobox(self):
         if self.drive_list:
-            self.drive_combobox['values'] = [d["display"] for d in self.drive_list]
-            self.drive_combobox.current(0)
-            self.selected_drive.set(self.drive_list[0]["display"])
-            self.log(f"Found {len(self.drive_list)} removable drives")
-            self.status_var.set(f"Found {len(self.drive_list)} removable drives")
+            displays = [d["display"] for d in self.drive_list]
+            self.drive_combobox['values'] = displays
+            if self.selected_drive.get() in displays:
+                self.drive_combobox.current(displays.index(self.selected_drive.get()))
+            else:
+                self.drive_combobox.current(0)
+                self.selected_drive.set(displays[0])
         else:
             self.drive_combobox['values'] = ["No drives found"]
             self.selected_drive.set("No drives found")
-            self.log("No removable drives found. Please insert a USB drive.")
-            self.status_var.set("No USB drives detected")
+    
+    def apply_drive_changes(self, added, removed, changed):
+        # Update only the rows that changed instead of rebuilding the list
+        paths = [d["path"] for d in self.drive_list]
+        for drive_info in removed:
+            if drive_info["path"] in paths:
+                index = paths.index(drive_info["path"])
+                del self.drive_list[index]
+                del paths[index]
+                self.drive_listbox.delete(index)
+                self.log(f"Drive removed: {drive_info['display']}")
+        for drive_info in changed:
+            if drive_info["path"] in paths:
+                index = paths.index(drive_info["path"])
+                self.drive_list[index] = drive_info
+                self.drive_listbox.delete(index)
+                self.drive_listbox.insert(index, drive_info["display"])
+        for drive_info in added:
+            # The prober may already have listed it
+            if drive_info["path"] in paths:
+                index = paths.index(drive_info["path"])
+                self.drive_list[index] = drive_info
+                self.drive_listbox.delete(index)
+                self.drive_listbox.insert(index, drive_info["display"])
+                continue
+            self.drive_list.append(drive_info)
+            paths.append(drive_info["path"])
+            self.drive_listbox.insert(tk.END, drive_info["display"])
+            self.log(f"Drive added: {drive_info['display']}")
+        self.update_drive_combobox()
     
     def on_drive_select(self, event):
         selection = self.drive_listbox.curselection()
@@ -469,18 +572,50 @@ class BootableUSBCreator(ttk.Frame):
                 self.drive_combobox.current(index)
     
     def log(self, message):
+        # Safe from any thread, the line shows up on the next UI tick
         timestamp = time.strftime("%H:%M:%S", time.localtime())
-        formatted_message = f"[{timestamp}] {message}"
-        
-        self.log_text.config(state=tk.NORMAL)
-        self.log_text.insert(tk.END, formatted_message + "\n")
-        self.log_text.see(tk.END)
-        self.log_text.config(state=tk.DISABLED)
+        self.ui_events.log(f"[{timestamp}] {message}")
+        if self.event_log:
+            self.event_log.write({"event": "log", "message": message})
+    
+    def process_ui_events(self):
+        # The next tick is scheduled whatever happens here, otherwise one
+        # failing update would cut the workers off from the UI for good
+        try:
+            self.apply_ui_events()
+        finally:
+            self.after(UI_TICK_MS, self.process_ui_events)
+    
+    def apply_ui_events(self):
+        lines, progress, calls = self.ui_events.drain()
+        
+        # All log lines of this tick go in with a single insert, then the
+        # oldest lines are dropped so the widget never grows past LOG_VIEW_LINES
+        if lines:
+            lines = lines[-LOG_VIEW_LINES:]
+            self.log_text.config(state=tk.NORMAL)
+            self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+            line_count = int(self.log_text.index("end-1c").split(".")[0]) - 1
+            if line_count > LOG_VIEW_LINES:
+                self.log_text.delete("1.0", f"{line_count - LOG_VIEW_LINES + 1}.0")
+            self.log_text.see(tk.END)
+            self.log_text.config(state=tk.DISABLED)
+        
+        # Only the latest progress value matters
+        if progress:
+            self.progress['value'] = progress["percent"]
+            if progress.get("status"):
+                self.status_var.set(progress["status"])
+            self.rate_var.set(describe_rate(progress))
+        
+        # A failing call must not keep the ones after it from running
+        for func, args in calls:
+            try:
+                func(*args)
+            except Exception as e:
+                self.log(f"Error updating the window ({getattr(func, '__name__', func)}): {e}")
     
     def create_bootable_usb(self):
-        if self.is_processing:
-            return
-            
         if not self.iso_path.get():
             messagebox.showerror("Error", "Please select an ISO file")
             return
@@ -489,132 +624,205 @@ class BootableUSBCreator(ttk.Frame):
             messagebox.showerror("Error", "Please select a USB drive")
             return
             
-        # Find the selected drive info
-        selected_drive_info = None
-        for drive in self.drive_list:
-            if drive["display"] == self.selected_drive.get():
-                selected_drive_info = drive
-                break
+        # Find the selected drive info, the listbox selection wins over the combobox
+        selected_drives = [self.drive_list[i] for i in self.drive_listbox.curselection()
+                           if 0 <= i < len(self.drive_list)]
+        if not selected_drives:
+            for drive in self.drive_list:
+                if drive["display"] == self.selected_drive.get():
+                    selected_drives.append(drive)
+                    break
                 
-        if not selected_drive_info:
+        if not selected_drives:
             messagebox.showerror("Error", "Could not find selected drive information")
             return
             
+        # Fallback entries are guesses, never write raw data to them
+        for drive in selected_drives:
+            if drive.get("probing"):
+                messagebox.showerror("Error", f"{drive['path']} has not answered yet, wait for it or pick another drive")
+                return
+            if drive.get("simulated"):
+                messagebox.showerror("Error", f"{drive['path']} is a simulated drive, refusing to write to it")
+                return
+        
+        busy = [drive["path"] for drive in selected_drives
+                if drive["path"] in self.checking_drives
+                or any(job["target"] == drive["path"] for job in self.jobs.jobs("pending") + self.jobs.jobs("running"))]
+        if busy:
+            messagebox.showerror("Error", f"Already queued: {', '.join(busy)}")
+            return
+            
         # Confirm operation with clear warning
-        drive_path = selected_drive_info["path"]
-        drive_label = selected_drive_info["label"] if "label" in selected_drive_info else drive_path
-        
-        warning_message = (
-            f"WARNING: All data on the selected drive will be erased!\n\n"
-            f"Drive: {drive_label}\n"
-            f"Path: {drive_path}\n"
-            f"Size: {selected_drive_info.get('size', 'Unknown')}\n\n"
-            f"Are you absolutely sure you want to continue?"
-        )
+        drive_details = ""
+        for drive in selected_drives:
+            drive_label = drive["label"] if "label" in drive else drive["path"]
+            drive_details += (
+                f"Drive: {drive_label}\n"
+                f"Path: {drive['path']}\n"
+                f"Size: {drive.get('size', 'Unknown')}\n\n"
+            )
+        
+        if len(selected_drives) == 1:
+            warning_message = "WARNING: All data on the selected drive will be erased!\n\n"
+        else:
+            warning_message = f"WARNING: All data on the {len(selected_drives)} selected drives will be erased!\n\n"
+        warning_message += drive_details + "Are you absolutely sure you want to continue?"
         
         if not messagebox.askyesno("WARNING - Data Loss", warning_message, icon=messagebox.WARNING):
             return
             
-        # Disable controls during operation
-        self.is_processing = True
-        self.create_button.config(state=tk.DISABLED)
-        self.progress['value'] = 0
-        
-        # Start the process in a separate thread to avoid freezing UI
-        thread = threading.Thread(target=self.process_drive, args=(selected_drive_info,))
-        thread.daemon = True
-        thread.start()
+        options = {"format_drive": self.format_drive.get(),
+                   "filesystem": self.filesystem_var.get(),
+                   "cluster_size": self.cluster_var.get(),
+                   "skip_zeros": self.skip_zeros.get(),
+                   "verify": self.verify_write.get(),
+                   "autotune": self.autotune.get(),
+                   "delta": self.delta_write.get(),
+                   "cache_friendly": self.cache_friendly.get()}
+        if self.health_check.get():
+            # All selected drives are checked at once, off the UI thread;
+            # the jobs are queued when the results are in
+            self.status_var.set(f"Checking {len(selected_drives)} drive(s)...")
+            self.checking_drives.update(drive["path"] for drive in selected_drives)
+            check_thread = threading.Thread(target=self.check_drives,
+                                            args=(self.iso_path.get(), selected_drives, options))
+            check_thread.daemon = True
+            check_thread.start()
+        else:
+            self.queue_drives(self.iso_path.get(), selected_drives, options)
+    
+    def check_drives(self, image, drives, options):
+        reports = check_targets([drive["path"] for drive in drives], log=self.log)
+        needed = image_bytes(image)
+        problems = {path: health_problems(report, needed) for path, report in reports.items()}
+        self.ui_events.call(self.queue_checked_drives, image, drives, options, problems)
+    
+    def queue_checked_drives(self, image, drives, options, problems):
+        self.checking_drives.difference_update(drive["path"] for drive in drives)
+        failed = [drive for drive in drives if problems[drive["path"]]]
+        if failed:
+            details = "\n\n".join(f"{drive['path']}:\n  " + "\n  ".join(problems[drive["path"]]) for drive in failed)
+            if not messagebox.askyesno("Drive check failed",
+                                       f"{len(failed)} drive(s) did not pass the check:\n\n{details}\n\n"
+                                       "Write to them anyway? No skips them.", icon=messagebox.WARNING):
+                for drive in failed:
+                    self.log(f"Skipping {drive['path']}, it failed the drive check")
+                drives = [drive for drive in drives if drive not in failed]
+        if drives:
+            self.queue_drives(image, drives, options)
+        else:
+            self.status_var.set("No drive passed the check")
+    
+    def queue_drives(self, image, drives, options):
+        for drive in drives:
+            job = self.jobs.add(image, drive["path"], options, drive)
+            self.log(f"Queued job {job['id']}: {os.path.basename(job['image'])} -> {drive['path']}")
+        self.start_jobs()
+    
+    def offer_resume(self):
+        pending = self.jobs.jobs("pending")
+        details = "\n".join(f"{os.path.basename(job['image'])} -> {job['target']}" for job in pending)
+        if messagebox.askyesno("Resume jobs",
+                               f"{len(pending)} job(s) did not finish last time:\n\n{details}\n\n"
+                               "Write them now? All data on these drives will be erased."):
+            self.start_jobs()
+        else:
+            for job in pending:
+                self.jobs.update(job["id"], state="failed", error="Not resumed")
+            self.jobs.clear_finished()
+    
+    def start_jobs(self):
+        # The Create button stays enabled, more drives can be queued while
+        # others are being written
+        if not self.is_processing:
+            self.is_processing = True
+            self.progress['value'] = 0
+        self.scheduler.start()
+        self.scheduler.wake()
     
-    def process_drive(self, drive_info):
+    def find_drive(self, path):
+        for drive in list(self.drive_list):
+            if drive["path"] == path:
+                return drive
+        return None
+    
+    def bus_of(self, job):
+        return (self.find_drive(job["target"]) or {}).get("bus")
+    
+    def process_jobs(self, batch):
+        # Runs on a scheduler worker thread: the jobs of one batch share an
+        # image and are written together
+        for job in batch:
+            self.job_progress[job["id"]] = 0
+        names = "-".join(os.path.basename(job["target"]) for job in batch)
+        trace = JobTrace(f"{batch[0]['id']}-{names}") if self.profile_jobs else None
+        
+        def on_event(event):
+            if trace:
+                trace.observe(event)
+            self.on_job_event(event, batch)
+        
+        drive_infos = [self.find_drive(job["target"]) for job in batch]
         try:
-            drive_path = drive_info["path"]
-            iso = self.iso_path.get()
-            filesystem = self.filesystem_var.get()
-            cluster_size = self.cluster_var.get()
-            
-            self.log(f"Starting to create bootable USB on {drive_path}")
-            self.log(f"Using ISO: {os.path.basename(iso)}")
-            self.status_var.set("Starting bootable USB creation...")
-            self.progress['value'] = 5
-            self.update_progress(10, "Analyzing ISO...")
-            
-            iso_size_mb = os.path.getsize(iso) / (1024 * 1024)
-            self.log(f"ISO size: {iso_size_mb:.1f} MB")
-            
-            # Format the drive if selected
-            if self.format_drive.get():
-                self.update_progress(15, f"Formatting drive with {filesystem}...")
-                self.log(f"Formatting drive {drive_path} with {filesystem}...")
-                
-                # Platform specific formatting commands
-                if sys.platform == 'win32':
-                    # Windows format command
-                    cluster_param = "" if cluster_size == "Default" else f"/A:{cluster_size}"
-                    format_cmd = f'format {drive_path} /FS:{filesystem} /Q {cluster_param}'
-                    self.log(f"Running: {format_cmd}")
-                    
-                    # In a real application, you'd run this command, but for safety we'll simulate it
-                    # subprocess.run(format_cmd, shell=True, check=True)
-                    self.log("Simulating format command (not actually running)")
-                    
-                elif sys.platform.startswith('linux'):
-                    # Linux format command
-                    fs_cmd = {
-                        "FAT32": "mkfs.vfat",
-                        "NTFS": "mkfs.ntfs",
-                        "exFAT": "mkfs.exfat"
-                    }.get(filesystem, "mkfs.vfat")
-                    
-                    format_cmd = f'sudo {fs_cmd} {drive_path}'
-                    self.log(f"Would run: {format_cmd} (simulated)")
-                
-                # Simulated format progress
-                for i in range(20, 50):
-                    self.update_progress(i, "Formatting drive...")
-                    time.sleep(0.05)
-                
-                self.log("Format completed")
-            
-            # Copy the ISO contents
-            self.update_progress(50, "Copying ISO to drive...")
-            self.log("Copying ISO contents to drive...")
-            
-            if sys.platform == 'win32':
-                # For Windows, you'd typically use a tool like dd for Windows or PowerShell
-                copy_cmd = f"Simulated: dd if={iso} of={drive_path} bs=4M status=progress"
+            if trace:
+                with trace:
+                    failed = run_queued_jobs(batch, drive_infos, on_event=on_event)
             else:
-                # Linux/macOS
-                copy_cmd = f"sudo dd if={iso} of={drive_path} bs=4M status=progress"
-                
-            self.log(f"Would run: {copy_cmd} (simulated)")
-            
-            # Simulated copy progress based on ISO size
-            copy_time = min(50, max(3, int(iso_size_mb / 100)))  # Scale copy time with ISO size
-            for i in range(50, 95):
-                self.update_progress(i, "Copying ISO data...")
-                time.sleep(copy_time / 45)  # Divide by steps (95-50)
-                
-            self.update_progress(95, "Setting boot flags...")
-            self.log("Setting boot flags...")
-            time.sleep(0.5)
-            
-            self.update_progress(100, "Complete!")
-            self.log("Bootable USB created successfully!")
-            messagebox.showinfo("Success", "Bootable USB drive created successfully!")
-            
-        except Exception as e:
-            self.log(f"Error: {str(e)}")
-            messagebox.showerror("Error", f"Failed to create bootable USB: {str(e)}")
+                failed = run_queued_jobs(batch, drive_infos, on_event=on_event)
         finally:
-            self.is_processing = False
-            self.create_button.config(state=tk.NORMAL)
-            self.status_var.set("Ready")
+            for job in batch:
+                self.job_progress[job["id"]] = 100
+        for job in batch:
+            if job["id"] in failed:
+                self.log(f"Error on {job['target']}: {str(failed[job['id']])}")
+        return failed
+    
+    def on_job_finished(self, job):
+        self.finished_jobs.append(job)
     
-    def update_progress(self, value, status_text=None):
-        self.progress['value'] = value
-        if status_text:
-            self.status_var.set(status_text)
-        self.update_idletasks()
+    def finish_processing(self):
+        self.is_processing = False
+        self.status_var.set("Ready")
+        self.rate_var.set("")
+        self.job_progress = {}
+        finished, self.finished_jobs = self.finished_jobs, []
+        failed = [job for job in finished if job["state"] == "failed"]
+        self.jobs.clear_finished()
+        if not finished:
+            return
+        if failed:
+            details = "\n".join(f"{job['target']}: {job['error']}" for job in failed)
+            messagebox.showwarning("Partial Success" if len(failed) < len(finished) else "Error",
+                                   f"{len(failed)} of {len(finished)} drives failed:\n\n{details}")
+        elif len(finished) == 1:
+            messagebox.showinfo("Success", "Bootable USB drive created successfully!")
+        else:
+            messagebox.showinfo("Success", f"{len(finished)} bootable USB drives created successfully!")
+    
+    def on_job_event(self, event, batch=None):
+        # Messages only need the batch's targets in front when other
+        # batches are writing too
+        label = ", ".join(job["target"] for job in batch) if batch else None
+        others = batch and len(self.job_progress) > len(batch)
+        if event["event"] == "log":
+            prefix = f"{label}: " if others else ""
+            self.log(prefix + event["message"])
+            return
+        if self.event_log:
+            self.event_log.write(dict(event, target=label) if batch else event)
+        if self.metrics:
+            self.metrics.observe(event, lambda path: media_label(path, self.find_drive(path)))
+        if event["event"] == "progress" and batch:
+            # Overall progress is the mean over all queued drives
+            for job in batch:
+                self.job_progress[job["id"]] = event["percent"]
+            percent = int(sum(self.job_progress.values()) / len(self.job_progress))
+            status = event.get("status")
+            if status and others:
+                status = f"{label}: {status}"
+            event = dict(event, percent=percent, status=status)
+        self.ui_events.post(event)
 
 if __name__ == "__main__":
     app = ModernUIApp()
@@ -0,0 +1,5 @@
+import sys
+
+from usbcreator.cli import main
+
+sys.exit(main())
@@ -0,0 +1,257 @@
+import mmap
+import os
+import struct
+import threading
+
+from usbcreator.compressed import compression_of, open_image, uncompressed_size
+from usbcreator.paths import load_json, save_json, state_dir
+
+# Bump when the analysis result changes, older cache entries are ignored
+ANALYSIS_VERSION = 3
+# Entries kept in the on-disk cache, oldest dropped first
+CACHE_ENTRIES = 200
+# Of compressed images only the start is decompressed for the analysis
+COMPRESSED_HEAD_BYTES = 4 * 1024 * 1024
+
+ISO_SECTOR = 2048
+# GUID of the EFI system partition as stored on disk (mixed endian)
+EFI_SYSTEM_GUID = bytes.fromhex("28732ac11ff8d211ba4b00a0c93ec93b")
+MBR_EFI_TYPES = (0xEF,)
+EL_TORITO_ID = b"EL TORITO SPECIFICATION"
+EL_TORITO_PLATFORMS = {0x00: "BIOS", 0xEF: "UEFI"}
+
+
+def _mbr(data):
+    # Partition table in the first sector, None without a boot signature
+    if len(data) < 512 or data[510:512] != b"\x55\xaa":
+        return None
+    partitions = []
+    for i in range(4):
+        entry = data[446 + 16 * i:446 + 16 * (i + 1)]
+        ptype = entry[4]
+        start, sectors = struct.unpack_from("<II", entry, 8)
+        if ptype and sectors:
+            partitions.append({"type": ptype, "start": start * 512, "size": sectors * 512,
+                               "active": entry[0] == 0x80})
+    return {
+        "partitions": partitions,
+        # isohybrid and most disk images carry BIOS boot code in front of the table
+        "boot_code": any(data[:440]),
+    }
+
+
+def _gpt(data):
+    # GPT header at LBA 1, with 512 byte sectors or 2048 byte ones (some ISOs)
+    for sector in (512, ISO_SECTOR):
+        header = data[sector:sector + 92]
+        if header[:8] != b"EFI PART":
+            continue
+        entries_lba, count, entry_size = struct.unpack_from("<QII", header, 72)
+        partitions = []
+        base = entries_lba * sector
+        for i in range(min(count, 128)):
+            entry = data[base + i * entry_size:base + (i + 1) * entry_size]
+            if len(entry) < 56 or not any(entry[:16]):
+                continue
+            first, last = struct.unpack_from("<QQ", entry, 32)
+            partitions.append({"efi": entry[:16] == EFI_SYSTEM_GUID, "start": first * sector,
+                               "size": (last - first + 1) * sector})
+        return {"sector_size": sector, "partitions": partitions}
+    return None
+
+
+def _iso9660(data):
+    # Walks the volume descriptor set starting at sector 16
+    info = None
+    offset = 16 * ISO_SECTOR
+    while offset + ISO_SECTOR <= len(data):
+        descriptor = data[offset:offset + ISO_SECTOR]
+        kind, ident = descriptor[0], descriptor[1:6]
+        if ident in (b"BEA01", b"NSR02", b"NSR03", b"TEA01"):
+            # UDF bridge descriptors follow the ISO9660 set
+            if info and ident.startswith(b"NSR"):
+                info["udf"] = True
+            offset += ISO_SECTOR
+            continue
+        if ident != b"CD001":
+            break
+        info = info or {"label": "", "blocks": 0, "block_size": ISO_SECTOR, "boot_catalog": None, "udf": False}
+        if kind == 0 and descriptor[7:7 + len(EL_TORITO_ID)] == EL_TORITO_ID:
+            info["boot_catalog"] = struct.unpack_from("<I", descriptor, 71)[0]
+        elif kind == 1:
+            info["label"] = descriptor[40:72].decode("ascii", "replace").strip()
+            info["blocks"] = struct.unpack_from("<I", descriptor, 80)[0]
+            info["block_size"] = struct.unpack_from("<H", descriptor, 128)[0] or ISO_SECTOR
+        # The terminator (type 255) may still be followed by UDF descriptors
+        offset += ISO_SECTOR
+    return info
+
+
+def _el_torito(data, catalog_lba):
+    # Platforms with a bootable entry in the boot catalog
+    base = catalog_lba * ISO_SECTOR
+    catalog = data[base:base + ISO_SECTOR]
+    if len(catalog) < 64 or catalog[0] != 1 or catalog[30:32] != b"\x55\xaa":
+        return []
+    platforms = []
+    if catalog[32] == 0x88:
+        platforms.append(catalog[1])
+    offset = 64
+    while offset + 32 <= len(catalog) and catalog[offset] in (0x90, 0x91):
+        platform = catalog[offset + 1]
+        entries = struct.unpack_from("<H", catalog, offset + 2)[0]
+        final = catalog[offset] == 0x91
+        offset += 32
+        for _ in range(entries):
+            if offset + 32 > len(catalog):
+                break
+            if catalog[offset] == 0x88:
+                platforms.append(platform)
+            offset += 32
+        if final:
+            break
+    return platforms
+
+
+def inspect_image(data):
+    # Everything that can be read from the headers of the image in data
+    # (bytes or an mmap). Decides how to write it:
+    #   hybrid ISO (ISO9660 plus a partition table): raw block copy
+    #   plain disk image (partition table only): raw block copy
+    #   ISO9660 without a partition table: file copy onto a FAT drive,
+    #     a raw copy would not boot from a USB stick
+    mbr = _mbr(data)
+    gpt = _gpt(data)
+    iso = _iso9660(data)
+    boot_modes = set()
+    warnings = []
+
+    if gpt and any(p["efi"] for p in gpt["partitions"]):
+        boot_modes.add("UEFI")
+    if mbr:
+        if any(p["type"] in MBR_EFI_TYPES for p in mbr["partitions"]):
+            boot_modes.add("UEFI")
+        if mbr["boot_code"]:
+            boot_modes.add("BIOS")
+
+    el_torito = []
+    if iso and iso["boot_catalog"] is not None:
+        el_torito = _el_torito(data, iso["boot_catalog"])
+        boot_modes.update(EL_TORITO_PLATFORMS.get(p, f"platform 0x{p:02x}") for p in el_torito)
+
+    has_table = bool(gpt or (mbr and mbr["partitions"]))
+    if iso and has_table:
+        image_type, write_mode = "hybrid", "raw"
+    elif iso:
+        image_type, write_mode = "iso9660", "file-copy"
+    elif has_table:
+        image_type, write_mode = "disk", "raw"
+    else:
+        image_type, write_mode = "unknown", "raw"
+        warnings.append("No ISO9660 volume or partition table found, this does not look like a bootable image")
+
+    if image_type != "unknown" and not boot_modes:
+        warnings.append("No BIOS or UEFI boot record found, the drive will probably not boot")
+    if image_type == "iso9660":
+        warnings.append("Not a hybrid ISO: its files will be copied onto the drive instead of the raw image")
+
+    return {
+        "type": image_type,
+        "write_mode": write_mode,
+        "label": iso["label"] if iso else "",
+        "boot_modes": sorted(boot_modes),
+        "partition_table": "gpt" if gpt else ("mbr" if mbr and mbr["partitions"] else None),
+        "partitions": (gpt or mbr or {}).get("partitions", []),
+        "el_torito": bool(el_torito),
+        "udf": bool(iso and iso["udf"]),
+        "iso_blocks": iso["blocks"] if iso else 0,
+        "warnings": warnings,
+    }
+
+
+def _read_image(path, size):
+    compression = compression_of(path)
+    if compression:
+        # Enough for the partition tables and volume descriptors; a boot
+        # catalog further in is not seen
+        with open_image(path) as src:
+            info = inspect_image(src.read(COMPRESSED_HEAD_BYTES))
+        return dict(info, compression=compression, image_size=uncompressed_size(path, compression))
+    return dict(_map_image(path, size), compression=None, image_size=size)
+
+
+def _map_image(path, size):
+    with open(path, "rb") as f:
+        if not size:
+            return inspect_image(b"")
+        # Only the header sectors and the boot catalog get paged in
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return inspect_image(data)
+
+
+# Shared by all AnalysisCache instances, each job makes its own
+_cache_lock = threading.Lock()
+
+
+class AnalysisCache:
+    # Analysis results in a JSON file, keyed by path and checked against
+    # (size, mtime, inode) so a replaced or modified image is analysed again
+    def __init__(self, path=None):
+        self.path = path or os.path.join(state_dir(), "analysis.json")
+        self.entries = load_json(self.path)
+
+    def get(self, path, stamp):
+        entry = self.entries.get(path)
+        if entry and entry.get("stamp") == stamp and entry.get("version") == ANALYSIS_VERSION:
+            return entry["info"]
+        return None
+
+    def put(self, path, stamp, info):
+        with _cache_lock:
+            # Read again so entries other jobs added since are kept
+            self.entries = load_json(self.path)
+            self.entries.pop(path, None)
+            self.entries[path] = {"stamp": stamp, "version": ANALYSIS_VERSION, "info": info}
+            while len(self.entries) > CACHE_ENTRIES:
+                self.entries.pop(next(iter(self.entries)))
+            save_json(self.path, self.entries)
+
+
+def analyze_iso(path, cache=None):
+    # Facts about the image used to plan the write: size, label, image type,
+    # write_mode ("raw" or "file-copy"), boot_modes and warnings. Served
+    # from the analysis cache when the file has not changed.
+    key = os.path.realpath(path)
+    st = os.stat(key)
+    stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+    try:
+        cache = cache or AnalysisCache()
+    except OSError:
+        cache = None
+
+    info = cache.get(key, stamp) if cache else None
+    cached = info is not None
+    if not cached:
+        info = _read_image(key, st.st_size)
+        if cache:
+            try:
+                cache.put(key, stamp, info)
+            except OSError:
+                pass
+
+    return dict(info, path=path, name=os.path.basename(path), size=st.st_size, cached=cached)
+
+
+def describe_image(info):
+    # Log lines summarising an analyze_iso() result
+    kinds = {"hybrid": "hybrid ISO", "iso9660": "ISO9660 image", "disk": "disk image", "unknown": "unknown image"}
+    lines = [f"Image type: {kinds[info['type']]}, write mode: {info['write_mode']}"
+             + (" (cached analysis)" if info.get("cached") else "")]
+    if info["compression"]:
+        size = f"{info['image_size'] / (1024 * 1024):.1f} MB" if info["image_size"] else "unknown size"
+        lines.append(f"Compressed with {info['compression']}, {size} uncompressed")
+    if info["label"]:
+        lines.append(f"Volume label: {info['label']}")
+    lines.append(f"Boot modes: {', '.join(info['boot_modes']) or 'none'}")
+    lines.extend(f"Warning: {warning}" for warning in info["warnings"])
+    return lines
@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+
+from usbcreator.engine import DEFAULT_CHUNK_SIZE, DEFAULT_QUEUE_DEPTH, FanOutCopier
+from usbcreator.paths import load_json, save_json, state_dir
+
+# Each probe writes this much of the image to the target, which is about to
+# be overwritten anyway, and includes the final fsync in the timing
+PROBE_BYTES = 16 * 1024 * 1024
+PROBE_CHUNK_SIZES = (512 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024)
+PROBE_QUEUE_DEPTHS = (1, 2, DEFAULT_QUEUE_DEPTH, 8)
+
+
+def drive_key(drive_info):
+    # Profiles are per device model and serial; None when we cannot tell
+    # drives apart (image files, fallback entries)
+    if not drive_info or not drive_info.get("serial"):
+        return None
+    return f"{drive_info.get('vendor', '')} {drive_info.get('model', '')}|{drive_info['serial']}".strip()
+
+
+# Shared by all ProfileStore instances, each job makes its own
+_store_lock = threading.Lock()
+
+
+class ProfileStore:
+    # Best chunk size / queue depth per drive, kept in a small JSON file
+    def __init__(self, path=None):
+        self.path = path or os.path.join(state_dir(), "autotune.json")
+        self.profiles = load_json(self.path)
+
+    def get(self, key):
+        return self.profiles.get(key) if key else None
+
+    def put(self, key, profile):
+        with _store_lock:
+            # Read again so profiles other jobs saved since are kept
+            self.profiles = load_json(self.path)
+            self.profiles[key] = profile
+            save_json(self.path, self.profiles, indent=2)
+
+
+def probe_once(source, target, chunk_size, queue_depth, probe_bytes=PROBE_BYTES):
+    # Returns the measured write rate in bytes per second
+    copier = FanOutCopier(source, [target], chunk_size=chunk_size, queue_depth=queue_depth,
+                          length=probe_bytes)
+    started = time.perf_counter()
+    writer = copier.run()[0]
+    if writer.error:
+        raise writer.error
+    return copier.total_bytes / max(time.perf_counter() - started, 1e-6)
+
+
+def probe_target(source, target, log=print, probe_bytes=PROBE_BYTES):
+    # Coordinate search: find the best chunk size at the default queue depth,
+    # then the best queue depth for that chunk size. Seven short writes
+    # instead of trying the whole grid.
+    results = {}
+
+    def measure(chunk_size, queue_depth):
+        key = (chunk_size, queue_depth)
+        if key not in results:
+            results[key] = probe_once(source, target, chunk_size, queue_depth, probe_bytes)
+            log(f"Probe {chunk_size // 1024} KB x {queue_depth}: {results[key] / (1024 * 1024):.1f} MB/s")
+        return results[key]
+
+    best_chunk = max(PROBE_CHUNK_SIZES, key=lambda c: measure(c, DEFAULT_QUEUE_DEPTH))
+    best_depth = max(PROBE_QUEUE_DEPTHS, key=lambda d: measure(best_chunk, d))
+    return {
+        "chunk_size": best_chunk,
+        "queue_depth": best_depth,
+        "rate": results[(best_chunk, best_depth)],
+        "probed": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def tuned_parameters(source, target, drive_info=None, store=None, log=print):
+    # (chunk_size, queue_depth) for target, probing only for drives we have
+    # not seen before. Falls back to the defaults if probing fails.
+    store = store or ProfileStore()
+    key = drive_key(drive_info)
+    profile = store.get(key)
+    if profile:
+        log(f"Using saved profile for {key}: {profile['chunk_size'] // 1024} KB chunks, "
+            f"queue depth {profile['queue_depth']}")
+        return profile["chunk_size"], profile["queue_depth"]
+
+    try:
+        profile = probe_target(source, target, log=log)
+    except OSError as e:
+        log(f"Probing {target} failed, using defaults: {e}")
+        return DEFAULT_CHUNK_SIZE, DEFAULT_QUEUE_DEPTH
+
+    log(f"Best for {target}: {profile['chunk_size'] // 1024} KB chunks, queue depth {profile['queue_depth']} "
+        f"({profile['rate'] / (1024 * 1024):.1f} MB/s)")
+    if key:
+        store.put(key, profile)
+    return profile["chunk_size"], profile["queue_depth"]
@@ -0,0 +1,202 @@
+import hashlib
+import mmap
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from usbcreator.paths import load_json, save_json, state_dir
+
+# Large slices of the mmap go to every hasher at once; hashlib releases
+# the GIL on buffers this size, so sha256 and sha512 run side by side
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+CACHE_ENTRIES = 200
+# Checksum files are small, anything bigger is not one
+MAX_CHECKSUM_FILE_SIZE = 1024 * 1024
+
+# Digest length in hex -> algorithm, for files that do not name it
+ALGORITHMS_BY_LENGTH = {32: "md5", 40: "sha1", 64: "sha256", 128: "sha512"}
+# Sibling files published next to images
+CHECKSUM_FILE_NAMES = ("sha256sums", "sha256sums.txt", "sha256sum.txt", "sha512sums", "sha512sums.txt",
+                       "sha1sums", "md5sums", "checksum", "checksums", "checksums.txt")
+CHECKSUM_EXTENSIONS = (".sha256", ".sha256sum", ".sha512", ".sha512sum", ".sha1", ".md5", ".checksum")
+
+# "<hex>  name" or "<hex> *name" (GNU coreutils)
+GNU_LINE = re.compile(r"^\\?([0-9a-fA-F]{32,128})\s+\*?(.+)$")
+# "SHA256 (name) = <hex>" (BSD, Fedora CHECKSUM files)
+BSD_LINE = re.compile(r"^(MD5|SHA1|SHA256|SHA512)\s*\((.+)\)\s*=\s*([0-9a-fA-F]{32,128})$", re.IGNORECASE)
+HEX_ONLY = re.compile(r"^([0-9a-fA-F]{32,128})$")
+
+
+def named_for(name, image_name):
+    # True for a checksum file of this one image: distro.iso.sha256 or
+    # distro.sha256 for distro.iso, never distro.sha256 for distro-24.04.iso
+    base, ext = os.path.splitext(name.lower())
+    image_name = image_name.lower()
+    return ext in CHECKSUM_EXTENSIONS and base in (image_name, os.path.splitext(image_name)[0])
+
+
+def checksum_files(image):
+    # Checksum files in the directory of image that may list it
+    directory = os.path.dirname(os.path.abspath(image))
+    image_name = os.path.basename(image)
+    found = []
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return found
+    for name in names:
+        lower = name.lower()
+        if lower in CHECKSUM_FILE_NAMES or lower.endswith("-checksum") or named_for(name, image_name):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and os.path.getsize(path) <= MAX_CHECKSUM_FILE_SIZE:
+                found.append(path)
+    return found
+
+
+def parse_checksum_file(path, image_name):
+    # (algorithm, hex digest) pairs the file gives for image_name. A file
+    # holding nothing but one digest applies to the image it is named after,
+    # and only to that one.
+    with open(path, encoding="utf-8", errors="replace") as f:
+        lines = [line.strip() for line in f]
+    expected = []
+    bare = []
+    for line in lines:
+        if not line or line.startswith(("#", "-----", "Hash:")):
+            continue
+        match = BSD_LINE.match(line)
+        if match:
+            algorithm, name, digest = match.group(1).lower(), match.group(2), match.group(3)
+        else:
+            match = GNU_LINE.match(line)
+            if match:
+                digest, name = match.group(1), match.group(2)
+                algorithm = ALGORITHMS_BY_LENGTH.get(len(digest))
+            else:
+                match = HEX_ONLY.match(line)
+                if match and ALGORITHMS_BY_LENGTH.get(len(match.group(1))):
+                    bare.append((ALGORITHMS_BY_LENGTH[len(match.group(1))], match.group(1).lower()))
+                continue
+        if algorithm and os.path.basename(name.strip().lstrip("./")) == image_name:
+            expected.append((algorithm, digest.lower()))
+    if not expected and len(bare) == 1 and named_for(os.path.basename(path), image_name):
+        expected = bare
+    return expected
+
+
+def expected_digests(image):
+    # [{"algorithm", "digest", "source"}] from all sibling checksum files
+    name = os.path.basename(image)
+    expected = []
+    for path in checksum_files(image):
+        try:
+            pairs = parse_checksum_file(path, name)
+        except OSError:
+            continue
+        for algorithm, digest in pairs:
+            expected.append({"algorithm": algorithm, "digest": digest, "source": os.path.basename(path)})
+    return expected
+
+
+def hash_file(path, algorithms, progress_callback=None, chunk_size=HASH_CHUNK_SIZE):
+    # {algorithm: hex digest} of path, reading it once. The file is mapped
+    # and every chunk is hashed by all algorithms in parallel, one worker
+    # per algorithm.
+    hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+    size = os.path.getsize(path)
+    with open(path, "rb") as f, ThreadPoolExecutor(max(1, len(hashers))) as pool:
+        if size:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mapped, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, size, chunk_size):
+                    chunk = view[offset:offset + chunk_size]
+                    for result in [pool.submit(h.update, chunk) for h in hashers.values()]:
+                        result.result()
+                    chunk.release()
+                    if progress_callback:
+                        progress_callback(min(offset + chunk_size, size), size)
+            finally:
+                view.release()
+                mapped.close()
+    return {algorithm: h.hexdigest() for algorithm, h in hashers.items()}
+
+
+# Shared by all ChecksumCache instances, each job makes its own
+_cache_lock = threading.Lock()
+
+
+class ChecksumCache:
+    # Digests of images already hashed, in a JSON file keyed by path and
+    # checked against (size, mtime, inode), so an unchanged image is never
+    # hashed twice
+    def __init__(self, path=None):
+        self.path = path or os.path.join(state_dir(), "checksums.json")
+        self.entries = load_json(self.path)
+
+    def get(self, path, stamp):
+        entry = self.entries.get(path)
+        if entry and entry.get("stamp") == stamp:
+            return dict(entry["digests"])
+        return {}
+
+    def put(self, path, stamp, digests):
+        with _cache_lock:
+            # Read again so entries other jobs added since are kept
+            self.entries = load_json(self.path)
+            self.entries.pop(path, None)
+            self.entries[path] = {"stamp": stamp, "digests": digests}
+            while len(self.entries) > CACHE_ENTRIES:
+                self.entries.pop(next(iter(self.entries)))
+            save_json(self.path, self.entries)
+
+
+def verify_checksums(path, cache=None, progress_callback=None):
+    # Checks path against the checksum files next to it. Returns a dict
+    # with status "ok", "mismatch" or "none" (no checksum files list it),
+    # checks ({algorithm, expected, actual, source, ok} each) and cached
+    # (True when no hashing was needed).
+    key = os.path.realpath(path)
+    expected = expected_digests(key)
+    result = {"path": path, "name": os.path.basename(path), "status": "none", "checks": [], "cached": True}
+    if not expected:
+        return result
+
+    st = os.stat(key)
+    stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+    try:
+        cache = cache or ChecksumCache()
+    except OSError:
+        cache = None
+    digests = cache.get(key, stamp) if cache else {}
+    missing = sorted({check["algorithm"] for check in expected} - set(digests))
+    if missing:
+        result["cached"] = False
+        digests.update(hash_file(key, missing, progress_callback))
+        if cache:
+            try:
+                cache.put(key, stamp, digests)
+            except OSError:
+                pass
+
+    for check in expected:
+        actual = digests[check["algorithm"]]
+        result["checks"].append({"algorithm": check["algorithm"], "expected": check["digest"], "actual": actual,
+                                 "source": check["source"], "ok": actual == check["digest"]})
+    result["status"] = "ok" if all(check["ok"] for check in result["checks"]) else "mismatch"
+    return result
+
+
+def describe_checksums(result):
+    # Log lines for a verify_checksums result
+    if result["status"] == "none":
+        return [f"No checksum file found for {result['name']}"]
+    lines = []
+    for check in result["checks"]:
+        verdict = "matches" if check["ok"] else "DOES NOT MATCH"
+        lines.append(f"{check['algorithm'].upper()} of {result['name']} {verdict} {check['source']}"
+                     + (" (cached)" if result["cached"] else ""))
+    return lines
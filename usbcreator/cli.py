@@ -0,0 +1,337 @@
+import argparse
+import json
+import os
+import stat
+import sys
+import time
+
+from usbcreator.analysis import analyze_iso, describe_image
+from usbcreator.checksums import describe_checksums, verify_checksums
+from usbcreator.drives import drive_info_for, find_drives
+from usbcreator.engine import DEFAULT_CHUNK_SIZE, DEFAULT_QUEUE_DEPTH
+from usbcreator.event_log import EventLog
+from usbcreator.health import MIN_WRITE_RATE, check_targets, health_problems, image_bytes
+from usbcreator.job import ImagingJob
+from usbcreator.jobqueue import DEFAULT_MAX_JOBS, DEFAULT_MAX_PER_BUS, JobQueue, Scheduler, run_queued_jobs
+from usbcreator.stats import describe_rate
+from usbcreator.zerocopy import COPY_BACKENDS
+
+
+def parse_size(text):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper()
+    try:
+        if text and text[-1] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {text}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="usbcreator",
+        description="Write a bootable ISO image to one or more drives or image files without the GUI.")
+    parser.add_argument("--iso", help="ISO or disk image to write, optionally .xz/.gz/.bz2/.zst compressed")
+    parser.add_argument("--target", action="append", default=[],
+                        help="Drive, image file or (file-copy mode) directory to write to, "
+                             "repeat to write several in one pass")
+    parser.add_argument("--mode", choices=("auto", "raw", "file-copy"), default="auto",
+                        help="raw block copy or copy the files inside the ISO (default: what the image needs)")
+    parser.add_argument("--verify", action="store_true", help="Read the targets back and compare after writing")
+    parser.add_argument("--skip-zeros", action="store_true",
+                        help="Skip writing zero blocks: image files are truncated and drives that can zero "
+                             "themselves are zeroed first; other drives still get the zeros written")
+    parser.add_argument("--format", action="store_true", help="Format the targets before writing")
+    parser.add_argument("--delta", action="store_true",
+                        help="Only rewrite blocks that changed since the last image written to the target")
+    parser.add_argument("--autotune", action="store_true",
+                        help="Probe the best chunk size and queue depth first (saved per drive model and serial)")
+    parser.add_argument("--chunk-size", type=parse_size, default=DEFAULT_CHUNK_SIZE,
+                        help="Copy chunk size, e.g. 1M (default 4M)")
+    parser.add_argument("--queue-depth", type=int, default=DEFAULT_QUEUE_DEPTH,
+                        help=f"Chunks in flight between reader and writers (default {DEFAULT_QUEUE_DEPTH})")
+    parser.add_argument("--copy-backend", choices=COPY_BACKENDS, default="auto",
+                        help="How raw writes move data: kernel copy (copy_file_range, sendfile, splice) "
+                             "or buffered; auto tries the kernel first (default)")
+    parser.add_argument("--cache-friendly", action="store_true",
+                        help="Keep the page cache small: drop the image from the cache behind the reader and "
+                             "flush the targets every 32 MB instead of all at the end")
+    parser.add_argument("--health-check", action="store_true",
+                        help="Check the targets first (real capacity, write speed, all at once) and skip "
+                             "the ones that fail; what the check overwrites is restored")
+    parser.add_argument("--min-write-speed", type=float, default=MIN_WRITE_RATE / (1024 * 1024),
+                        help=f"MB/s a target must write at to pass --health-check "
+                             f"(default {MIN_WRITE_RATE // (1024 * 1024)}, 0 to only check capacity)")
+    parser.add_argument("--filesystem", default="FAT32", choices=("FAT32", "NTFS", "exFAT"))
+    parser.add_argument("--partition-table", default="mbr", choices=("mbr", "gpt"),
+                        help="Partition table written by --format (default mbr)")
+    parser.add_argument("--cluster-size", default="Default", choices=("Default", "4K", "8K", "16K", "32K", "64K"))
+    parser.add_argument("--list-drives", action="store_true", help="List detected removable drives and exit")
+    parser.add_argument("--analyze", action="store_true",
+                        help="Print the image type, volume label and boot modes of --iso and exit")
+    parser.add_argument("--checksum", action="store_true",
+                        help="Check --iso against the SHA256SUMS/.sha256 files next to it first, "
+                             "and do not write it if it does not match")
+    parser.add_argument("--sysfs-root", default="/sys", help="Read drives from this sysfs tree (Linux, for testing)")
+    parser.add_argument("--json", action="store_true", help="Print progress and results as JSON lines")
+    parser.add_argument("--log-file", help="Also append every event as JSON lines to this (rotating) file")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve Prometheus metrics (bytes, MB/s, phase times, failures) on "
+                             "http://127.0.0.1:PORT/metrics while running")
+    parser.add_argument("--metrics-file",
+                        help="Write the same metrics to this file every 15 seconds and on exit "
+                             "(e.g. for node_exporter's textfile collector)")
+    parser.add_argument("--profile", action="store_true",
+                        help="Save a cProfile and phase trace spans of every job in ~/.usbcreator/profiles")
+    parser.add_argument("--yes", action="store_true", help="Do not refuse to overwrite block devices")
+    parser.add_argument("--queue", action="store_true",
+                        help="Add one job per target to the persistent job queue and run the queue")
+    parser.add_argument("--resume", action="store_true",
+                        help="Run the jobs left pending in the queue (e.g. after a crash or reboot)")
+    parser.add_argument("--list-jobs", action="store_true", help="List the jobs in the queue and exit")
+    parser.add_argument("--max-per-bus", type=int, default=DEFAULT_MAX_PER_BUS,
+                        help=f"Drives written at once per USB bus (default {DEFAULT_MAX_PER_BUS})")
+    parser.add_argument("--max-jobs", type=int, default=DEFAULT_MAX_JOBS,
+                        help=f"Queued images writing at once in total, each to all of its drives in one "
+                             f"pass (default {DEFAULT_MAX_JOBS})")
+    args = parser.parse_args(argv)
+
+    if not (args.list_drives or args.list_jobs or (args.resume and not args.queue)):
+        if not args.iso:
+            parser.error("--iso is required")
+        if not args.target and not args.analyze:
+            parser.error("at least one --target is required")
+    return args
+
+
+def is_block_device(path):
+    try:
+        return stat.S_ISBLK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+class Reporter:
+    # Prints job events either as human readable lines or as JSON lines.
+    # Every event also goes to metrics (an ImagingMetrics, media(path)
+    # labels the targets) and the JobTrace of its job, when there are any.
+    def __init__(self, as_json, stream=sys.stdout, event_log=None, metrics=None, media=None):
+        self.as_json = as_json
+        self.stream = stream
+        self.event_log = event_log
+        self.metrics = metrics
+        self.media = media
+        self.traces = {}
+        self.last_progress = {}
+
+    def __call__(self, event):
+        if self.event_log:
+            self.event_log.write(event)
+        if self.metrics:
+            self.metrics.observe(event, self.media)
+        trace = self.traces.get(event.get("target"))
+        if trace:
+            trace.observe(event)
+        if self.as_json:
+            event = dict(event, time=round(time.time(), 3))
+            self.stream.write(json.dumps(event, default=str) + "\n")
+            self.stream.flush()
+        elif event["event"] in ("log", "error"):
+            prefix = f"{event['target']}: " if event.get("target") else ""
+            self.stream.write(f"[{time.strftime('%H:%M:%S')}] {prefix}{event['message']}\n")
+        elif event["event"] == "timing":
+            pass
+        elif event["event"] == "result":
+            self.stream.write(f"{len(event['succeeded'])} succeeded, {len(event['failed'])} failed\n")
+            for path, error in event["failed"].items():
+                self.stream.write(f"  {path}: {error}\n")
+        elif event["event"] == "progress":
+            # Only print when the percentage moves, per-chunk updates would flood the terminal
+            # (per target when queued jobs run side by side)
+            key = (event["percent"], event.get("phase"))
+            if key != self.last_progress.get(event.get("target")):
+                self.last_progress[event.get("target")] = key
+                rate = describe_rate(event)
+                prefix = f"{event['target']}: " if event.get("target") else ""
+                self.stream.write(f"{prefix}{event['percent']:3d}% {event.get('status')} {rate}".rstrip() + "\n")
+
+
+def run_queue(args, report):
+    # --queue / --resume: every target is its own job in the persistent
+    # queue; jobs for the same image are written together in one pass.
+    # Jobs left pending by earlier runs only run with --resume.
+    jobs = JobQueue()
+    job_ids = None if args.resume else []
+    if args.queue:
+        # A new batch replaces the history of the previous one
+        jobs.clear_finished()
+        options = {"format_drive": args.format, "filesystem": args.filesystem,
+                   "cluster_size": args.cluster_size, "skip_zeros": args.skip_zeros,
+                   "verify": args.verify, "autotune": args.autotune, "chunk_size": args.chunk_size,
+                   "queue_depth": args.queue_depth, "delta": args.delta,
+                   "write_mode": None if args.mode == "auto" else args.mode,
+                   "partition_table": args.partition_table, "copy_backend": args.copy_backend,
+                   "cache_friendly": args.cache_friendly}
+        for target in args.target:
+            job = jobs.add(args.iso, target, options, drive_info_for(target, args.sysfs_root))
+            if job_ids is not None:
+                job_ids.append(job["id"])
+    pending = [job for job in jobs.jobs("pending") if job_ids is None or job["id"] in job_ids]
+    for job in pending:
+        if job.get("resumed"):
+            report({"event": "log", "target": job["target"],
+                    "message": f"Resuming interrupted job {job['id']} ({os.path.basename(job['image'])})"})
+
+    def runner(batch):
+        # Events are tagged with the batch's targets, several batches may
+        # be writing at once
+        label = ", ".join(job["target"] for job in batch)
+        on_event = lambda event: report(dict(event, target=label))
+        drive_infos = [drive_info_for(job["target"], args.sysfs_root) for job in batch]
+        if not args.profile:
+            return run_queued_jobs(batch, drive_infos, on_event)
+        from usbcreator.metrics import JobTrace
+        with JobTrace(f"{batch[0]['id']}-" + "-".join(os.path.basename(job["target"]) for job in batch)) as trace:
+            report.traces[label] = trace
+            try:
+                return run_queued_jobs(batch, drive_infos, on_event)
+            finally:
+                report.traces.pop(label, None)
+
+    def bus_of(job):
+        return (drive_info_for(job["target"], args.sysfs_root) or {}).get("bus")
+
+    finished = []
+    scheduler = Scheduler(jobs, runner, bus_of, max_per_bus=args.max_per_bus, max_jobs=args.max_jobs,
+                          on_finish=finished.append, job_ids=job_ids)
+    scheduler.run_until_idle()
+    report({"event": "result",
+            "succeeded": [job["target"] for job in finished if job["state"] == "done"],
+            "failed": {job["target"]: job["error"] for job in finished if job["state"] == "failed"}})
+    return 0 if all(job["state"] == "done" for job in finished) else 1
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    metrics = media = None
+    exporters = []
+    if args.metrics_port is not None or args.metrics_file:
+        # Only imported when asked for, it pulls in http.server
+        from usbcreator.metrics import ImagingMetrics, MetricsFile, MetricsServer, media_label
+        metrics = ImagingMetrics()
+        media = lambda path: media_label(path, drive_info_for(path, args.sysfs_root))
+        if args.metrics_port is not None:
+            exporters.append(MetricsServer(metrics.registry, args.metrics_port))
+        if args.metrics_file:
+            exporters.append(MetricsFile(metrics.registry, args.metrics_file))
+    report = Reporter(args.json, event_log=EventLog(args.log_file) if args.log_file else None, metrics=metrics,
+                      media=media)
+    try:
+        return run(args, report)
+    finally:
+        for exporter in exporters:
+            exporter.close()
+
+
+def run(args, report):
+    if args.list_drives:
+        drives = find_drives(log=lambda message: report({"event": "log", "message": message}),
+                             sysfs_root=args.sysfs_root)
+        for drive in drives:
+            if args.json:
+                report(dict(drive, event="drive"))
+            else:
+                print(drive["display"])
+        return 0
+
+    if args.checksum and args.iso:
+        result = verify_checksums(args.iso)
+        if args.json:
+            report(dict(result, event="checksum"))
+        else:
+            for line in describe_checksums(result):
+                report({"event": "log", "message": line})
+        if result["status"] == "mismatch":
+            report({"event": "error", "message": f"{args.iso} does not match its checksum, not writing it"})
+            return 1
+
+    if args.analyze:
+        try:
+            info = analyze_iso(args.iso)
+        except OSError as e:
+            report({"event": "error", "message": f"Cannot analyze {args.iso}: {e}"})
+            return 1
+        if args.json:
+            report(dict(info, event="analysis"))
+        else:
+            print("\n".join(describe_image(info)))
+        return 0
+
+    if args.list_jobs:
+        for job in JobQueue().jobs():
+            if args.json:
+                report(dict(job, event="job"))
+            else:
+                error = f" ({job['error']})" if job["error"] else ""
+                print(f"{job['id']}  {job['state']:8s} {job['image']} -> {job['target']}{error}")
+        return 0
+
+    if not args.yes:
+        targets = args.target
+        if args.resume:
+            targets = targets + [job["target"] for job in JobQueue().jobs("pending")]
+        devices = [target for target in targets if is_block_device(target)]
+        if devices:
+            report({"event": "error", "message": f"Refusing to overwrite {', '.join(devices)} without --yes"})
+            return 2
+
+    skipped = {}
+    if args.health_check and args.target:
+        needed = image_bytes(args.iso)
+        results = check_targets(args.target, log=lambda message: report({"event": "log", "message": message}))
+        for target, result in results.items():
+            if args.json:
+                report(dict(result, event="health"))
+            problems = health_problems(result, needed, int(args.min_write_speed * 1024 * 1024))
+            if problems:
+                skipped[target] = "Failed the media check: " + "; ".join(problems)
+                report({"event": "error", "target": target, "message": f"Skipping it: {'; '.join(problems)}"})
+        args.target = [target for target in args.target if target not in skipped]
+        if not args.target and not args.resume:
+            report({"event": "result", "succeeded": [], "failed": skipped})
+            return 1
+
+    if args.queue or args.resume:
+        return max(run_queue(args, report), 1 if skipped else 0)
+
+    job = ImagingJob(args.iso, args.target, format_drive=args.format, filesystem=args.filesystem,
+                     cluster_size=args.cluster_size, skip_zeros=args.skip_zeros, verify=args.verify,
+                     on_event=report, autotune=args.autotune,
+                     drives=[drive_info_for(target, args.sysfs_root) for target in args.target],
+                     chunk_size=args.chunk_size, queue_depth=args.queue_depth, delta=args.delta,
+                     write_mode=None if args.mode == "auto" else args.mode,
+                     partition_table=args.partition_table, copy_backend=args.copy_backend,
+                     cache_friendly=args.cache_friendly)
+    try:
+        if args.profile:
+            from usbcreator.metrics import JobTrace
+            with JobTrace("-".join(os.path.basename(target) for target in args.target)) as trace:
+                # Events of the job as a whole carry no target field
+                for target in [None] + args.target:
+                    report.traces[target] = trace
+                job.run()
+        else:
+            job.run()
+    except Exception as e:
+        job.failed = job.failed or {target: e for target in args.target}
+        report({"event": "log", "message": f"Error: {e}"})
+
+    report({"event": "result",
+            "succeeded": job.succeeded,
+            "failed": dict(skipped, **{path: str(error) for path, error in job.failed.items()})})
+    return 0 if not job.failed and not skipped else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
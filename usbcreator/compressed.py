@@ -0,0 +1,256 @@
+import bz2
+import gzip
+import lzma
+import os
+import queue
+import struct
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compressed input is decompressed in these steps; at most
+# DECOMPRESS_QUEUE_DEPTH of them wait for the copy reader at any time
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+DECOMPRESS_QUEUE_DEPTH = 8
+
+MAGIC = (
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x1f\x8b", "gz"),
+    (b"BZh", "bz2"),
+    (b"\x28\xb5\x2f\xfd", "zst"),
+)
+EXTENSIONS = {".xz": "xz", ".gz": "gz", ".bz2": "bz2", ".zst": "zst"}
+# File dialog pattern for everything open_image() can read
+IMAGE_PATTERNS = "*.iso *.img *.xz *.gz *.bz2 *.zst"
+
+
+def compression_of(path):
+    # "xz", "gz", "bz2", "zst" or None, by magic bytes and then by extension
+    try:
+        with open(path, "rb") as f:
+            head = f.read(6)
+    except OSError:
+        head = b""
+    for magic, kind in MAGIC:
+        if head.startswith(magic):
+            return kind
+    if head:
+        return None
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def _varint(data, offset):
+    # xz multibyte integer, returns (value, next offset)
+    value = 0
+    for i in range(9):
+        byte = data[offset + i]
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value, offset + i + 1
+    raise ValueError("Bad xz integer")
+
+
+def _xz_size(f, compressed_size):
+    # Sum of the uncompressed sizes in the index of the last stream
+    f.seek(compressed_size - 12)
+    footer = f.read(12)
+    if footer[10:12] != b"YZ":
+        return None
+    index_size = (struct.unpack_from("<I", footer, 4)[0] + 1) * 4
+    f.seek(compressed_size - 12 - index_size)
+    index = f.read(index_size)
+    if not index or index[0] != 0:
+        return None
+    records, offset = _varint(index, 1)
+    total = 0
+    for _ in range(records):
+        _, offset = _varint(index, offset)
+        size, offset = _varint(index, offset)
+        total += size
+    return total
+
+
+def _zst_size(f):
+    # Frame_Content_Size of the first frame, if the encoder recorded it
+    header = f.read(18)
+    descriptor = header[4]
+    single_segment = descriptor >> 5 & 1
+    offset = 5 + (0 if single_segment else 1) + (0, 1, 2, 4)[descriptor & 3]
+    field_size = (1 if single_segment else 0, 2, 4, 8)[descriptor >> 6]
+    if not field_size:
+        return None
+    value = int.from_bytes(header[offset:offset + field_size], "little")
+    return value + 256 if field_size == 2 else value
+
+
+def uncompressed_size(path, kind=None):
+    # Best effort size of the decompressed image, None when the format does
+    # not record it (bz2) or the trailer cannot be read
+    kind = kind or compression_of(path)
+    compressed_size = os.path.getsize(path)
+    try:
+        with open(path, "rb") as f:
+            if kind == "xz":
+                return _xz_size(f, compressed_size)
+            if kind == "zst":
+                return _zst_size(f)
+            if kind == "gz":
+                # ISIZE is the size modulo 4 GiB, images are bigger than
+                # their compressed form so add the wraps back
+                f.seek(compressed_size - 4)
+                size = struct.unpack("<I", f.read(4))[0]
+                while size < compressed_size:
+                    size += 1 << 32
+                return size
+    except (OSError, ValueError, IndexError, struct.error):
+        pass
+    return None
+
+
+def _decompressing_file(raw, kind):
+    if kind == "xz":
+        return lzma.LZMAFile(raw)
+    if kind == "gz":
+        return gzip.GzipFile(fileobj=raw)
+    if kind == "bz2":
+        return bz2.BZ2File(raw)
+    if kind == "zst":
+        if zstandard is None:
+            raise OSError("Reading .zst images needs the zstandard package (pip install zstandard)")
+        return zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+    raise ValueError(f"Unknown compression {kind}")
+
+
+class DecompressingReader:
+    # File-like reader (readinto/read/close) for a compressed image. A
+    # background thread decompresses into a bounded queue, so decompression
+    # overlaps with the writes and memory stays at a few chunks. lzma, zlib,
+    # bz2 and zstandard all release the GIL while they work.
+    #
+    # compressed_done / compressed_size give the progress through the input;
+    # estimated_size() is the decompressed size, exact once the trailer told
+    # us or the end was reached, otherwise extrapolated from the ratio so far.
+    def __init__(self, path, kind=None, chunk_size=DECOMPRESS_CHUNK_SIZE, queue_depth=DECOMPRESS_QUEUE_DEPTH):
+        self.path = path
+        self.kind = kind or compression_of(path)
+        self.chunk_size = chunk_size
+        self.compressed_size = os.path.getsize(path)
+        self.recorded_size = uncompressed_size(path, self.kind)
+        self.bytes_read = 0
+        self.eof = False
+        self._raw = open(path, "rb")
+        self._stream = _decompressing_file(self._raw, self.kind)
+        self._chunks = queue.Queue(max(1, queue_depth))
+        self._current = memoryview(b"")
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._decompress)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def compressed_done(self):
+        try:
+            return min(self._raw.tell(), self.compressed_size)
+        except (OSError, ValueError):
+            return self.compressed_size
+
+    def estimated_size(self):
+        if self.eof:
+            return self.bytes_read
+        if self.recorded_size:
+            return max(self.recorded_size, self.bytes_read)
+        done = self.compressed_done
+        if not done or not self.bytes_read:
+            return self.compressed_size
+        return max(self.bytes_read, int(self.bytes_read * self.compressed_size / done))
+
+    def _decompress(self):
+        try:
+            while not self._stop.is_set():
+                data = self._stream.read(self.chunk_size)
+                if not data:
+                    break
+                self._put(data)
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        # Give up when the consumer has gone away
+        while not self._stop.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readinto(self, view):
+        view = memoryview(view).cast("B")
+        total = 0
+        while total < len(view) and not self.eof:
+            if not self._current:
+                item = self._chunks.get()
+                if item is None:
+                    self.eof = True
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                self._current = memoryview(item)
+            count = min(len(view) - total, len(self._current))
+            view[total:total + count] = self._current[:count]
+            self._current = self._current[count:]
+            total += count
+        self.bytes_read += total
+        return total
+
+    def drop_cached_input(self):
+        # Drop the compressed file from the page cache up to where the
+        # decompressor has read it
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(self._raw.fileno(), 0, self.compressed_done, os.POSIX_FADV_DONTNEED)
+            except (OSError, ValueError):
+                pass
+
+    def read(self, size):
+        buf = bytearray(size)
+        return bytes(buf[:self.readinto(buf)])
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._stream.close()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_image(path):
+    # Unbuffered binary reader for plain and compressed images alike
+    kind = compression_of(path)
+    if kind:
+        return DecompressingReader(path, kind)
+    return open(path, "rb", buffering=0)
+
+
+def read_at(path, offset, count):
+    # count bytes at offset of the (decompressed) image; compressed streams
+    # cannot seek, so this reads through everything before offset
+    with open_image(path) as src:
+        if not isinstance(src, DecompressingReader):
+            src.seek(offset)
+            return src.read(count)
+        skip = bytearray(DECOMPRESS_CHUNK_SIZE)
+        while offset:
+            step = src.readinto(memoryview(skip)[:min(offset, len(skip))])
+            if not step:
+                return b""
+            offset -= step
+        return src.read(count)
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import time
+
+from usbcreator.autotune import drive_key
+from usbcreator.compressed import compression_of, open_image, uncompressed_size
+from usbcreator.engine import (CopyCancelled, chunk_digest, drop_cached_pages, is_regular_file,
+                               read_full, write_all)
+from usbcreator.paths import save_json, state_dir
+
+# Granularity of the manifests: small enough that a point release only
+# touches a fraction of the blocks, large enough that the manifest of a
+# 4 GiB image stays around 256 KB of JSON
+DELTA_BLOCK_SIZE = 1024 * 1024
+
+
+def target_key(path, drive_info=None):
+    # Drives are recognised by model and serial, so a stick keeps its
+    # manifest when it shows up under another /dev name. Image files (and
+    # drives without a serial) go by path.
+    return drive_key(drive_info) or f"file:{os.path.realpath(path)}"
+
+
+def target_stamp(path):
+    # What has to be unchanged for a manifest to still describe the target.
+    # Image files can be checked by size and mtime; for block devices only
+    # the size is known, so delta writes are always verified (ImagingJob)
+    # to catch a different stick or anything written elsewhere.
+    st = os.stat(path)
+    if os.path.isfile(path):
+        return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    with open(path, 'rb') as f:
+        return {"size": f.seek(0, os.SEEK_END)}
+
+
+class ManifestStore:
+    # Block hashes of the last image successfully written to each target,
+    # one JSON file per target under ~/.usbcreator/manifests
+    def __init__(self, directory=None):
+        self.directory = directory or state_dir("manifests")
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    def load(self, key, path, block_size=DELTA_BLOCK_SIZE):
+        # Hash list (bytes) if the manifest is still valid for path, else None
+        try:
+            with open(self._path(key)) as f:
+                manifest = json.load(f)
+            if manifest["block_size"] != block_size or manifest["stamp"] != target_stamp(path):
+                return None
+            return [bytes.fromhex(h) for h in manifest["hashes"]]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, key, path, image, hashes, block_size=DELTA_BLOCK_SIZE):
+        manifest = {
+            "key": key,
+            "image": os.path.basename(image),
+            "written": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "block_size": block_size,
+            "stamp": target_stamp(path),
+            "hashes": [h.hex() for h in hashes],
+        }
+        save_json(self._path(key), manifest)
+
+    def discard(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class DeltaCopier:
+    # Rewrites only the blocks of target that differ from source. With
+    # old_hashes (the manifest of the previous write) unchanged blocks are
+    # found by comparing hashes without touching the target; without one
+    # the target is read back and compared block by block.
+    #
+    # source_digests and chunk_size line up with FanOutCopier, so the
+    # result can be checked with TargetVerifier.
+    def __init__(self, source, target, old_hashes=None, block_size=DELTA_BLOCK_SIZE,
+                 progress_callback=None):
+        self.source = source
+        self.target = target
+        self.old_hashes = old_hashes
+        self.chunk_size = block_size
+        self.progress_callback = progress_callback
+        # Compressed images: an estimate until the end of the image is reached
+        self.compression = compression_of(source)
+        self.total_bytes = ((uncompressed_size(source, self.compression) if self.compression else None)
+                            or os.path.getsize(source))
+        self.source_digests = []
+        self.bytes_written = 0
+        self.bytes_unchanged = 0
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        src_buf = bytearray(self.chunk_size)
+        tgt_buf = bytearray(self.chunk_size)
+        fd = os.open(self.target, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        try:
+            with open_image(self.source) as src, open(fd, 'rb', buffering=0, closefd=False) as tgt:
+                if self.old_hashes is None:
+                    drop_cached_pages(fd)
+                offset = 0
+                index = 0
+                while True:
+                    if self._cancelled:
+                        raise CopyCancelled("Copy cancelled")
+                    view = memoryview(src_buf)
+                    count = read_full(src, view)
+                    if not count:
+                        break
+                    digest = chunk_digest(view[:count])
+                    self.source_digests.append(digest)
+                    if self._unchanged(tgt, index, offset, view[:count], digest, tgt_buf):
+                        self.bytes_unchanged += count
+                    else:
+                        os.lseek(fd, offset, os.SEEK_SET)
+                        write_all(fd, view[:count])
+                        self.bytes_written += count
+                    offset += count
+                    index += 1
+                    if self.compression:
+                        self.total_bytes = max(offset, src.estimated_size())
+                    if self.progress_callback:
+                        self.progress_callback(offset, self.total_bytes)
+
+            self.total_bytes = offset
+            if is_regular_file(fd) and os.fstat(fd).st_size < self.total_bytes:
+                os.ftruncate(fd, self.total_bytes)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return self.bytes_written
+
+    def _unchanged(self, tgt, index, offset, data, digest, tgt_buf):
+        if self.old_hashes is not None:
+            return index < len(self.old_hashes) and self.old_hashes[index] == digest
+        tgt.seek(offset)
+        view = memoryview(tgt_buf)[:len(data)]
+        return read_full(tgt, view) == len(data) and view == data
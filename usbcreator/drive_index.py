@@ -0,0 +1,217 @@
+import os
+import re
+import select
+import socket
+import threading
+
+# Block devices that are never imaging targets
+IGNORED_PREFIXES = ("loop", "ram", "zram", "dm-", "md", "sr", "fd", "nbd")
+# NETLINK_KOBJECT_UEVENT, not exported by the socket module
+NETLINK_KOBJECT_UEVENT = 15
+# Root hub (one per host controller bus) or MMC host in a sysfs device path
+BUS_PATTERN = re.compile(r"^(.*?/(?:usb\d+|mmc_host/mmc\d+|mmc\d+))(?:/|$)")
+
+
+def read_attr(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def format_size(size_bytes):
+    if size_bytes >= 1024 ** 4:
+        return f"{size_bytes / 1024 ** 4:.1f} TB"
+    return f"{size_bytes / 1024 ** 3:.1f} GB"
+
+
+class DriveIndex:
+    # Removable drives read straight from /sys/block, without running lsblk.
+    # The index is cached; refresh() only reads devices that appeared and
+    # re-checks the size of known ones (card readers change size when media
+    # is inserted). watch() calls refresh() whenever the kernel reports a
+    # block device uevent, or every interval seconds where netlink is not
+    # available, e.g. when sysfs_root points at a fake tree for testing.
+    # With scan=False the index starts empty and the first refresh(), which
+    # watch() does on its own thread, reports every drive as added, unless
+    # watch() is told to seed the index with it silently.
+    def __init__(self, sysfs_root="/sys", dev_root="/dev", removable_only=True, scan=True):
+        self.sysfs_root = sysfs_root
+        self.dev_root = dev_root
+        self.removable_only = removable_only
+        self._drives = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if scan:
+            self.refresh()
+
+    def drives(self):
+        with self._lock:
+            return sorted(self._drives.values(), key=lambda d: d["name"])
+
+    def refresh(self):
+        # Returns (added, removed, changed) lists of drive_info dicts
+        block_dir = os.path.join(self.sysfs_root, "block")
+        names = set(name for name in os.listdir(block_dir) if not name.startswith(IGNORED_PREFIXES))
+        added, removed, changed = [], [], []
+
+        with self._lock:
+            for name in list(self._drives):
+                if name not in names:
+                    removed.append(self._drives.pop(name))
+
+            for name in sorted(names):
+                known = self._drives.get(name)
+                if known:
+                    size_bytes = self._read_size(name)
+                    if size_bytes == known["size_bytes"]:
+                        continue
+                    if not size_bytes:
+                        removed.append(self._drives.pop(name))
+                        continue
+                    info = self.read_drive(name)
+                    if info:
+                        self._drives[name] = info
+                        changed.append(info)
+                    continue
+
+                info = self.read_drive(name)
+                if info:
+                    self._drives[name] = info
+                    added.append(info)
+
+        return added, removed, changed
+
+    def _read_size(self, name):
+        # sysfs always reports the size in 512 byte sectors
+        sectors = read_attr(os.path.join(self.sysfs_root, "block", name, "size"), "0")
+        return int(sectors) * 512 if sectors.isdigit() else 0
+
+    def read_drive(self, name):
+        # drive_info for one /sys/block entry, None if it is not a target
+        base = os.path.join(self.sysfs_root, "block", name)
+        size_bytes = self._read_size(name)
+        removable = read_attr(os.path.join(base, "removable")) == "1"
+        transport = self._transport(base)
+        bus = self._bus(base)
+        # No media (empty card reader) or not something we would write to
+        if not size_bytes or transport == "virtual":
+            return None
+        if self.removable_only and not (removable or transport == "usb"):
+            return None
+
+        vendor = read_attr(os.path.join(base, "device", "vendor"), "")
+        model = read_attr(os.path.join(base, "device", "model"), "") or "USB Drive"
+        serial = self._serial(base)
+        path = os.path.join(self.dev_root, name)
+        size = format_size(size_bytes)
+        label = f"{vendor} {model}".strip()
+        return {
+            "path": path,
+            "name": name,
+            "label": label,
+            "model": model,
+            "vendor": vendor,
+            "serial": serial,
+            "transport": transport,
+            "bus": bus,
+            "removable": removable,
+            "size": size,
+            "size_bytes": size_bytes,
+            "partitions": self._partitions(base),
+            "display": f"{path} ({label}) - {size}"
+        }
+
+    def _partitions(self, base):
+        try:
+            names = os.listdir(base)
+        except OSError:
+            return []
+        return sorted(name for name in names if os.path.exists(os.path.join(base, name, "partition")))
+
+    def _transport(self, base):
+        real = os.path.realpath(base)
+        for marker, transport in (("/usb", "usb"), ("/mmc", "mmc"), ("/nvme", "nvme"),
+                                  ("/ata", "ata"), ("/virtual/", "virtual")):
+            if marker in real:
+                return transport
+        return "unknown"
+
+    def _bus(self, base):
+        # Drives on the same root hub share its bandwidth; None when the
+        # drive is not behind a USB or MMC host
+        match = BUS_PATTERN.match(os.path.realpath(base))
+        if not match:
+            return None
+        return os.path.relpath(match.group(1), os.path.realpath(os.path.join(self.sysfs_root, "devices")))
+
+    def _serial(self, base):
+        # USB sticks keep the serial on the USB device a few levels above the
+        # SCSI device, MMC cards right on the device
+        path = os.path.realpath(os.path.join(base, "device"))
+        root = os.path.realpath(self.sysfs_root)
+        for _ in range(8):
+            serial = read_attr(os.path.join(path, "serial"))
+            if serial:
+                return serial
+            parent = os.path.dirname(path)
+            if parent == path or not parent.startswith(root):
+                break
+            path = parent
+        return ""
+
+    def watch(self, callback, interval=2.0, seed=False):
+        # callback(added, removed, changed) runs on the watcher thread; with
+        # seed the first refresh only fills the index and is not reported
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, args=(callback, interval, seed))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _uevent_socket(self):
+        if self.sysfs_root != "/sys" or not hasattr(socket, "AF_NETLINK"):
+            return None
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, 1))
+            return sock
+        except OSError:
+            return None
+
+    def _watch(self, callback, interval, seed):
+        sock = self._uevent_socket()
+        try:
+            first = True
+            while not self._stop.is_set():
+                if first:
+                    first = False
+                elif sock:
+                    ready, _, _ = select.select([sock], [], [], interval)
+                    if ready and b"SUBSYSTEM=block" not in sock.recv(65536):
+                        continue
+                else:
+                    self._stop.wait(interval)
+                try:
+                    added, removed, changed = self.refresh()
+                except OSError:
+                    continue
+                if seed:
+                    # The socket was bound first, so nothing plugged in
+                    # meanwhile is missed
+                    seed = False
+                    continue
+                if added or removed or changed:
+                    callback(added, removed, changed)
+        finally:
+            if sock:
+                sock.close()
@@ -0,0 +1,265 @@
+import os
+import re
+import sys
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+
+from usbcreator.drive_index import IGNORED_PREFIXES, DriveIndex
+
+# Devices are probed in parallel. One that has not answered after
+# PROBE_TIMEOUT seconds is left as a "probing..." entry instead of holding
+# up the others; diskutil calls are killed after that long.
+PROBE_WORKERS = 8
+PROBE_TIMEOUT = 5.0
+
+
+def simulated_drives():
+    # Fallback entries when drives cannot be detected; never written to
+    if sys.platform == 'win32':
+        return [{"path": drive, "label": drive, "display": f"{drive} (Simulated Drive)", "size": "8.0 GB",
+                 "free": "7.5 GB", "fs": "FAT32", "simulated": True} for drive in ["D:", "E:", "F:"]]
+    if sys.platform.startswith('linux'):
+        return [{"path": dev, "label": "USB Drive", "display": f"{dev} (USB Drive)", "size": "8.0 GB",
+                 "simulated": True} for dev in ["/dev/sdb", "/dev/sdc"]]
+    if sys.platform == 'darwin':
+        return [{"path": disk, "label": "External Drive", "display": f"{disk} (External Drive)",
+                 "size": "8.0 GB", "simulated": True} for disk in ["/dev/disk2", "/dev/disk3"]]
+    return [{"path": f"DRIVE{i}", "label": f"Simulated Drive {i}", "display": f"Simulated Drive {i} - 8.0 GB",
+             "size": "8.0 GB", "simulated": True} for i in range(1, 3)]
+
+
+def probing_placeholder(path, status="probing..."):
+    # List entry for a drive whose details are not in yet
+    return {"path": path, "label": path, "display": f"{path} ({status})", "probing": True}
+
+
+def list_devices(sysfs_root="/sys", timeout=PROBE_TIMEOUT):
+    # Cheap first pass: the paths of the devices worth probing. Raises when
+    # detection is not available on this system.
+    if sys.platform == 'win32':
+        import win32file
+        import win32api
+        letters = win32api.GetLogicalDriveStrings().split('\000')[:-1]
+        return [drive for drive in letters if win32file.GetDriveType(drive) == win32file.DRIVE_REMOVABLE]
+    if sys.platform.startswith('linux'):
+        names = os.listdir(os.path.join(sysfs_root, "block"))
+        return [os.path.join("/dev", name) for name in sorted(names) if not name.startswith(IGNORED_PREFIXES)]
+    if sys.platform == 'darwin':
+        output = subprocess.check_output(['diskutil', 'list', 'external'], timeout=timeout).decode('utf-8')
+        return [line.split()[0] for line in output.strip().split('\n') if line.startswith('/dev/')]
+    raise OSError(f"Drive detection is not supported on {sys.platform}")
+
+
+def probe_device(path, sysfs_root="/sys", timeout=PROBE_TIMEOUT, log=print):
+    # Details of one device: size, model, serial, transport, partitions and
+    # mount points where the platform tells us. None when it is not a
+    # removable drive (or has no media).
+    if sys.platform == 'win32':
+        return _probe_windows(path, log)
+    if sys.platform.startswith('linux'):
+        drive_info = DriveIndex(sysfs_root, scan=False).read_drive(os.path.basename(path))
+        if drive_info:
+            drive_info["path"] = path
+            drive_info["mount_points"] = mount_points_for(path)
+        return drive_info
+    if sys.platform == 'darwin':
+        return _probe_macos(path, timeout)
+    return None
+
+
+def _probe_windows(drive, log):
+    import win32api
+    drive_info = {"path": drive, "label": drive}
+    try:
+        vol_info = win32api.GetVolumeInformation(drive)
+        vol_name = vol_info[0] if vol_info[0] else "No Label"
+        fs_type = vol_info[4]
+        drive_info["label"] = f"{drive} ({vol_name})"
+        drive_info["fs"] = fs_type
+        drive_info["mount_points"] = [drive]
+        
+        # Get drive size
+        sectors, bytes_per_sector, _, free_clusters, _ = win32api.GetDiskFreeSpace(drive)
+        total_space = (sectors * bytes_per_sector) / (1024 * 1024 * 1024)  # in GB
+        free_space = (free_clusters * bytes_per_sector) / (1024 * 1024 * 1024)  # in GB
+        
+        drive_info["size"] = f"{total_space:.2f} GB"
+        drive_info["free"] = f"{free_space:.2f} GB"
+        drive_info["display"] = f"{drive} ({vol_name}) - {total_space:.1f} GB [{fs_type}]"
+    except Exception as e:
+        log(f"Warning: Could not get full info for {drive}: {str(e)}")
+        drive_info["display"] = f"{drive} (Unknown)"
+    return drive_info
+
+
+def _probe_macos(disk, timeout):
+    disk_info = subprocess.check_output(['diskutil', 'info', disk], timeout=timeout).decode('utf-8')
+    fields = {}
+    for info_line in disk_info.split('\n'):
+        if ":" in info_line:
+            key, value = info_line.split(':', 1)
+            fields[key.strip()] = value.strip()
+    name = fields.get("Volume Name") or fields.get("Device / Media Name") or "External Drive"
+    size = fields.get("Disk Size", "Unknown")
+    return {
+        "path": disk,
+        "label": name,
+        "model": fields.get("Device / Media Name", ""),
+        "transport": fields.get("Protocol", "").lower(),
+        "removable": fields.get("Removable Media", "") in ("Removable", "Yes"),
+        "mount_points": [fields["Mount Point"]] if fields.get("Mount Point") else [],
+        "size": size.split("(")[0].strip(),
+        "display": f"{disk} ({name}) - {size.split('(')[0].strip()}"
+    }
+
+
+class DriveProber:
+    # Finds drives without blocking the caller for more than the listing:
+    # every device is probed on a worker thread, and on_update(path,
+    # drive_info) reports each one as soon as it is known. A placeholder
+    # (probing_placeholder) comes first for every device, drive_info None
+    # means the device is not a target after all. Devices still probing
+    # after timeout seconds keep their placeholder; if they answer later
+    # on_update is still called. on_done(drives) gets the drives that
+    # answered in time.
+    #
+    # run() does all this on the calling thread, start() on a new one.
+    # Afterwards probe_seconds holds how long each answering device took,
+    # stragglers the ones that timed out and elapsed the whole run.
+    def __init__(self, on_update=None, on_done=None, log=print, sysfs_root="/sys",
+                 timeout=PROBE_TIMEOUT, workers=PROBE_WORKERS):
+        self.on_update = on_update or (lambda path, drive_info: None)
+        self.on_done = on_done
+        self.log = log
+        self.sysfs_root = sysfs_root
+        self.timeout = timeout
+        self.workers = workers
+        self.drives = []
+        self.probe_seconds = {}
+        self.stragglers = []
+        self.elapsed = 0.0
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self):
+        started = time.monotonic()
+        try:
+            paths = list_devices(self.sysfs_root, self.timeout)
+        except ImportError:
+            self.log("Warning: win32file/win32api modules not available. Using simulated drives.")
+            paths = self._use_fallback()
+        except Exception as e:
+            self.log(f"Error detecting drives: {str(e)}")
+            paths = self._use_fallback()
+
+        if paths:
+            for path in paths:
+                self.on_update(path, probing_placeholder(path))
+            found = {}
+            pool = ThreadPoolExecutor(min(self.workers, len(paths)))
+            futures = {pool.submit(self._probe, path): path for path in paths}
+            try:
+                for future in as_completed(futures, timeout=self.timeout):
+                    path = futures[future]
+                    found[path] = self._result(path, future)
+            except TimeoutError:
+                for future, path in futures.items():
+                    if not future.done():
+                        self.stragglers.append(path)
+                        self.log(f"{path} is not responding, still probing in the background")
+                        future.add_done_callback(lambda future, path=path: self._result(path, future))
+            # Hung probes must not keep anyone waiting, their threads finish on their own
+            pool.shutdown(wait=False)
+            self.drives.extend(found[path] for path in paths if found.get(path))
+        self.elapsed = time.monotonic() - started
+        if self.on_done:
+            self.on_done(self.drives)
+        return self.drives
+
+    def _use_fallback(self):
+        self.drives = simulated_drives()
+        for drive_info in self.drives:
+            self.on_update(drive_info["path"], drive_info)
+        return []
+
+    def _probe(self, path):
+        started = time.monotonic()
+        drive_info = probe_device(path, self.sysfs_root, self.timeout, self.log)
+        self.probe_seconds[path] = time.monotonic() - started
+        return drive_info
+
+    def _result(self, path, future):
+        try:
+            drive_info = future.result()
+        except Exception as e:
+            self.log(f"Could not probe {path}: {str(e)}")
+            drive_info = None
+        self.on_update(path, drive_info)
+        return drive_info
+
+
+def find_drives(log=print, sysfs_root="/sys"):
+    # Returns a list of drive_info dicts (path, label, size, display, ...).
+    # Entries marked "simulated" are fallbacks, not detected devices.
+    return DriveProber(log=log, sysfs_root=sysfs_root).run()
+
+
+def drive_info_for(path, sysfs_root="/sys"):
+    # Detected drive_info for a device path, None for image files and
+    # anything that is not a known removable drive
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        for drive_info in DriveIndex(sysfs_root).drives():
+            if drive_info["path"] == path:
+                return drive_info
+    except OSError:
+        pass
+    return None
+
+
+def unescape_mount_field(field):
+    # The kernel escapes space, tab, newline and backslash as \NNN octal;
+    # everything else, UTF-8 included, is passed through as raw bytes
+    return re.sub(rb"\\([0-7]{3})", lambda m: bytes([int(m.group(1), 8)]), field)
+
+
+def mounted_partitions(path, mounts="/proc/mounts"):
+    # (device, mount point) for the drive and each of its mounted partitions
+    try:
+        with open(mounts, "rb") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+    name = os.path.basename(path)
+    found = []
+    for line in lines:
+        fields = [os.fsdecode(unescape_mount_field(field)) for field in line.split()[:2]]
+        if len(fields) < 2:
+            continue
+        device = os.path.basename(fields[0])
+        # sdb1 belongs to sdb, mmcblk0p1 to mmcblk0
+        if device == name or (device.startswith(name) and device[len(name):].lstrip("p").isdigit()):
+            found.append((fields[0], fields[1]))
+    return found
+
+
+def mount_points_for(path, mounts="/proc/mounts"):
+    # Where a drive and its partitions are mounted
+    return [mount_point for _, mount_point in mounted_partitions(path, mounts)]
+
+
+def mount_point_for(path, mounts="/proc/mounts"):
+    # Where a drive (or one of its partitions) is mounted, None if it is not.
+    # Directories are returned as they are, so file-copy mode can also write
+    # into any folder.
+    if os.path.isdir(path):
+        return path
+    found = mount_points_for(path, mounts)
+    return found[0] if found else None
@@ -0,0 +1,676 @@
+import os
+import errno
+import mmap
+import threading
+import queue
+import stat
+import struct
+import sys
+import time
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from usbcreator.compressed import compression_of, open_image, read_at, uncompressed_size
+
+# Copy engine defaults: 4 MiB chunks matches the old "dd bs=4M" invocation
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+DEFAULT_QUEUE_DEPTH = 4
+# Granularity used when looking for zero-filled runs in sparse mode
+SPARSE_BLOCK_SIZE = 64 * 1024
+# hashlib releases the GIL on large buffers, so chunks hash in parallel
+HASH_WORKERS = min(4, os.cpu_count() or 1)
+# O_DIRECT needs buffers, offsets and lengths aligned to the logical block size
+DIRECT_ALIGNMENT = 4096
+# Cache-friendly writes flush each target every FLUSH_WINDOW bytes, with at
+# most two windows of dirty data per target at any time
+FLUSH_WINDOW = 32 * 1024 * 1024
+# BLKZEROOUT ioctl, _IO(0x12, 127): zero a byte range of a block device
+BLKZEROOUT = 0x127F
+# sync_file_range(2) flags
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+
+class CopyCancelled(Exception):
+    pass
+
+
+class VerificationError(Exception):
+    def __init__(self, offset, message=None):
+        self.offset = offset
+        super().__init__(message or f"Target differs from image at byte offset {offset}")
+
+
+def open_target(path, direct=False):
+    # Works for both block devices and plain image files (created if missing)
+    flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    if direct:
+        flags |= os.O_DIRECT
+    return os.open(path, flags, 0o644)
+
+
+def write_all(fd, view):
+    # os.write may return short counts on devices, keep going until done
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def read_full(f, view):
+    # Fill view unless EOF is reached, readinto may return short counts
+    total = 0
+    while total < len(view):
+        count = f.readinto(view[total:])
+        if not count:
+            break
+        total += count
+    return total
+
+
+def chunk_digest(view):
+    return hashlib.sha256(view).digest()
+
+
+def drop_cached_pages(fd):
+    # Make read-back hit the device instead of the page cache where possible
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+
+def drop_cached_range(fd, offset, length):
+    # Like drop_cached_pages, for part of a file; dirty pages are kept
+    if hasattr(os, 'posix_fadvise') and length > 0:
+        try:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+
+def _load_sync_file_range():
+    # Python has no os.sync_file_range, call the Linux libc one directly.
+    # The symbols of the running process include libc, so there is no
+    # library search (ctypes.util.find_library takes tens of ms).
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        func = ctypes.CDLL(None, use_errno=True).sync_file_range
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+    func.restype = ctypes.c_int
+    return func
+
+
+# Loaded on first use, not at import: most runs never flush as they go
+_sync_file_range = None
+_sync_file_range_loaded = False
+
+
+def sync_range(fd, offset, length, flags):
+    # False when sync_file_range is not available (or not for this fd)
+    global _sync_file_range, _sync_file_range_loaded
+    if not _sync_file_range_loaded:
+        _sync_file_range = _load_sync_file_range()
+        _sync_file_range_loaded = True
+    func = _sync_file_range
+    if func is None:
+        return False
+    import ctypes
+    if func(fd, offset, length, flags) != 0:
+        if ctypes.get_errno() in (errno.ENOSYS, errno.EINVAL, errno.ESPIPE):
+            return False
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    return True
+
+
+class WriteBehind:
+    # Keeps the dirty data of one target bounded. Whenever another window
+    # has been written, its writeback is started (SYNC_FILE_RANGE_WRITE,
+    # does not block) and the window before it is waited for and dropped
+    # from the page cache. The device is busy all the time, the writer
+    # only waits when the device is a whole window behind, and the final
+    # fsync has at most two windows left to do.
+    #
+    # Without sync_file_range each window is fdatasync'd instead.
+    # flushed is the offset up to which data is known to be on the device;
+    # latencies holds the seconds spent waiting for each window.
+    def __init__(self, fd, window=FLUSH_WINDOW, start=0):
+        self.fd = fd
+        self.window = window
+        self.started = start
+        self.flushed = start
+        self.latencies = []
+
+    def advance(self, written):
+        while written - self.started >= self.window:
+            start = self.started
+            self.started += self.window
+            began = time.monotonic()
+            if not sync_range(self.fd, start, self.window, SYNC_FILE_RANGE_WRITE):
+                os.fdatasync(self.fd)
+                self._flushed(self.started, began)
+                continue
+            if start > self.flushed:
+                sync_range(self.fd, self.flushed, start - self.flushed,
+                           SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER)
+                self._flushed(start, began)
+
+    def _flushed(self, offset, began):
+        self.latencies.append(time.monotonic() - began)
+        drop_cached_range(self.fd, self.flushed, offset - self.flushed)
+        self.flushed = offset
+
+
+def is_regular_file(fd):
+    return stat.S_ISREG(os.fstat(fd).st_mode)
+
+
+def device_zeroes_fast(fd):
+    # True for a block device that zeroes ranges itself (WRITE ZEROES or
+    # WRITE SAME); elsewhere BLKZEROOUT sends every zero over the bus, which
+    # costs more than writing the image's zero blocks
+    st = os.fstat(fd)
+    if not stat.S_ISBLK(st.st_mode):
+        return False
+    base = f"/sys/dev/block/{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}"
+    # Partitions share the queue of their disk
+    for queue_dir in (os.path.join(base, "queue"), os.path.join(base, "..", "queue")):
+        try:
+            with open(os.path.join(queue_dir, "write_zeroes_max_bytes")) as f:
+                return int(f.read().strip() or 0) > 0
+        except (OSError, ValueError):
+            continue
+    return False
+
+
+def zero_range(fd, offset, length):
+    import fcntl
+    fcntl.ioctl(fd, BLKZEROOUT, struct.pack("=QQ", offset, length))
+
+
+def allocate_buffer(size, aligned=False):
+    # Anonymous mmaps are page aligned, as O_DIRECT requires
+    return mmap.mmap(-1, size) if aligned else bytearray(size)
+
+
+def zero_runs(buf, count, block_size=SPARSE_BLOCK_SIZE):
+    # Split buf[:count] into (start, end, is_zero) runs at block_size granularity.
+    # bytearray.startswith compares in place, so no slices get copied; mmap
+    # buffers have no startswith and compare a copied slice instead.
+    zero_block = bytes(block_size)
+    in_place = isinstance(buf, bytearray)
+    runs = []
+    for start in range(0, count, block_size):
+        end = min(start + block_size, count)
+        zero = zero_block if end - start == block_size else bytes(end - start)
+        if in_place:
+            is_zero = buf.startswith(zero, start, end)
+        else:
+            is_zero = buf[start:end] == zero
+        if runs and runs[-1][2] == is_zero:
+            runs[-1] = (runs[-1][0], end, is_zero)
+        else:
+            runs.append((start, end, is_zero))
+    return runs
+
+
+class TargetWriter:
+    # One copy destination. With skip_zeros the writer seeks past all-zero
+    # blocks instead of writing them. That is only safe when the target already
+    # reads back as zeros: either the caller says so (target_is_blank), the
+    # target is an image file we can truncate, or a drive that zeroes
+    # zero_length bytes (None: up to its end) itself when opened. Otherwise
+    # zeros are written.
+    #
+    # With direct the target is opened with O_DIRECT, bypassing the page
+    # cache, if the OS and filesystem support it; direct reports whether
+    # that worked. Buffers must then be page aligned (allocate_buffer).
+    #
+    # start_offset continues an earlier write at that offset. checkpoint is
+    # a journal (see WriteJournal): every checkpoint.segment_bytes the
+    # target is fsync'd and checkpoint.commit(offset, digest) is called
+    # with the hash of the segment just written.
+    #
+    # flush_window bounds the dirty data on the target (see WriteBehind);
+    # bytes_on_device then lags bytes_written by what is not flushed yet.
+    def __init__(self, path, skip_zeros=False, target_is_blank=False, direct=False,
+                 start_offset=0, checkpoint=None, flush_window=None):
+        self.path = path
+        self.skip_zeros = skip_zeros
+        self.target_is_blank = target_is_blank
+        self.direct = direct and hasattr(os, 'O_DIRECT')
+        self.sparse = False
+        self.start_offset = start_offset
+        self.checkpoint = checkpoint
+        self.flush_window = flush_window
+        self.write_behind = None
+        self._segment_hash = hashlib.sha256()
+        # Bytes of the image now on the target, skipped zero blocks included
+        self.bytes_written = start_offset
+        self.bytes_skipped = 0
+        self.zero_length = None
+        self.error = None
+        self.fd = None
+
+    def open(self):
+        if self.direct:
+            try:
+                self.fd = open_target(self.path, direct=True)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                # e.g. tmpfs on older kernels, fall back to buffered writes
+                self.direct = False
+        if self.fd is None:
+            self.fd = open_target(self.path)
+        if self.skip_zeros:
+            self.sparse = self._prepare_sparse()
+        if self.start_offset:
+            os.lseek(self.fd, self.start_offset, os.SEEK_SET)
+        if self.checkpoint:
+            self.checkpoint.start(self.start_offset)
+        if self.flush_window and not self.direct:
+            self.write_behind = WriteBehind(self.fd, self.flush_window, self.start_offset)
+
+    @property
+    def bytes_on_device(self):
+        return self.write_behind.flushed if self.write_behind else self.bytes_written
+
+    @property
+    def flush_latencies(self):
+        return self.write_behind.latencies if self.write_behind else []
+
+    def _prepare_sparse(self):
+        if self.target_is_blank:
+            return True
+        if is_regular_file(self.fd):
+            # Discard the old image contents (past what is being resumed),
+            # the file then reads as zeros
+            os.ftruncate(self.fd, self.start_offset)
+            return True
+        if sys.platform.startswith('linux') and device_zeroes_fast(self.fd):
+            end = os.lseek(self.fd, 0, os.SEEK_END)
+            if self.zero_length:
+                # Whole 4 KB blocks, the ioctl wants logical block multiples
+                end = min(end, -(-self.zero_length // DIRECT_ALIGNMENT) * DIRECT_ALIGNMENT)
+            try:
+                zero_range(self.fd, self.start_offset, max(0, end - self.start_offset))
+            except OSError:
+                return False
+            return True
+        return False
+
+    def write_chunk(self, buf, count):
+        view = memoryview(buf)
+        if self.direct and count % DIRECT_ALIGNMENT:
+            # Only the final chunk can be short, write it through the cache
+            self._drop_direct_flag()
+        if not self.sparse:
+            write_all(self.fd, view[:count])
+        else:
+            offset = self.bytes_written
+            for start, end, is_zero in zero_runs(buf, count):
+                if is_zero:
+                    self.bytes_skipped += end - start
+                else:
+                    os.lseek(self.fd, offset + start, os.SEEK_SET)
+                    write_all(self.fd, view[start:end])
+        self.bytes_written += count
+        if self.write_behind:
+            self.write_behind.advance(self.bytes_written)
+        if self.checkpoint:
+            self._segment_hash.update(view[:count])
+            if self.bytes_written % self.checkpoint.segment_bytes == 0:
+                os.fsync(self.fd)
+                self.checkpoint.commit(self.bytes_written, self._segment_hash.digest())
+                self._segment_hash = hashlib.sha256()
+
+    def _drop_direct_flag(self):
+        import fcntl
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+
+    def finish(self, total_bytes):
+        if self.sparse and is_regular_file(self.fd):
+            # Trailing zero blocks were skipped, make the image full length
+            if os.fstat(self.fd).st_size < total_bytes:
+                os.ftruncate(self.fd, total_bytes)
+        os.fsync(self.fd)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class SharedBuffer:
+    # A preallocated chunk handed to several consumers at once; it goes back
+    # to the free pool once every consumer has released it.
+    def __init__(self, size, free_buffers, aligned=False):
+        self.data = allocate_buffer(size, aligned)
+        self.count = 0
+        self._free_buffers = free_buffers
+        self._refs = 0
+        self._lock = threading.Lock()
+
+    def hand_out(self, consumers):
+        self._refs = consumers
+
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            done = self._refs == 0
+        if done:
+            self._free_buffers.put(self)
+
+
+class FanOutCopier:
+    # Pipelined copy of one image to any number of targets (block devices or
+    # plain image files). A single reader thread fills a fixed pool of
+    # preallocated buffers with readinto() and broadcasts each one to a writer
+    # thread per target. The pool size is the window by which the fastest
+    # target may run ahead of the slowest before the reader has to wait.
+    #
+    # With hash_source every chunk is also hashed on a worker pool as it is
+    # read, so TargetVerifier can check the targets without re-reading the
+    # source. A failing target is dropped without stopping the others.
+    #
+    # sync_callback() is called once all data is written and the final
+    # flush to the targets starts; sync_seconds records how long it took.
+    #
+    # direct opens the targets with O_DIRECT (see TargetWriter), chunk_size
+    # must then be a multiple of DIRECT_ALIGNMENT. length limits the copy to
+    # the first length bytes of the source.
+    #
+    # Compressed sources (.xz, .gz, .bz2, .zst) are decompressed on the fly.
+    # total_bytes is then an estimate while copying and exact afterwards.
+    #
+    # start_offset (a multiple of chunk_size) resumes an interrupted copy:
+    # nothing before it is written, though it is still read and hashed
+    # when hash_source needs the digests. checkpoints maps target paths to
+    # their write journals (see TargetWriter).
+    #
+    # cache_friendly keeps a copy from filling the page cache: the source
+    # is dropped from the cache behind the reader, targets are flushed in
+    # FLUSH_WINDOW steps, and progress counts bytes on the device.
+    def __init__(self, source, targets, chunk_size=DEFAULT_CHUNK_SIZE,
+                 queue_depth=DEFAULT_QUEUE_DEPTH, progress_callback=None,
+                 skip_zeros=False, target_is_blank=False, hash_source=False,
+                 sync_callback=None, direct=False, length=None, start_offset=0, checkpoints=None,
+                 cache_friendly=False):
+        if direct and chunk_size % DIRECT_ALIGNMENT:
+            raise ValueError(f"chunk_size must be a multiple of {DIRECT_ALIGNMENT} for direct I/O")
+        self.source = source
+        self.direct = direct
+        self.chunk_size = chunk_size
+        self.queue_depth = max(1, queue_depth)
+        self.progress_callback = progress_callback
+        self.sync_callback = sync_callback
+        self.sync_seconds = 0.0
+        self.hash_source = hash_source
+        if not targets:
+            raise ValueError("No copy targets given")
+        if start_offset % chunk_size:
+            raise ValueError("start_offset must be a multiple of chunk_size")
+        self.start_offset = start_offset
+        self.cache_friendly = cache_friendly
+        checkpoints = checkpoints or {}
+        flush_window = FLUSH_WINDOW if cache_friendly else None
+        self.writers = [TargetWriter(t, skip_zeros, target_is_blank, direct, start_offset, checkpoints.get(t),
+                                     flush_window)
+                        for t in targets]
+        self.source_digests = []
+        self.length = length
+        self.compression = compression_of(source)
+        if self.compression:
+            size = uncompressed_size(source, self.compression)
+            self.total_bytes = size or os.path.getsize(source)
+        else:
+            size = self.total_bytes = os.path.getsize(source)
+        if length is not None:
+            size = self.total_bytes = min(length, self.total_bytes)
+        for writer in self.writers:
+            writer.zero_length = size
+        self._abort = threading.Event()
+        self._errors = []
+
+    def cancel(self):
+        self._abort.set()
+
+    def run(self):
+        free_buffers = queue.Queue()
+        for _ in range(self.queue_depth):
+            free_buffers.put(SharedBuffer(self.chunk_size, free_buffers, aligned=self.direct))
+        writer_queues = [queue.Queue() for _ in self.writers]
+        digest_futures = []
+        self._hash_pool = ThreadPoolExecutor(HASH_WORKERS) if self.hash_source else None
+
+        try:
+            for writer in self.writers:
+                try:
+                    writer.open()
+                except OSError as e:
+                    writer.error = e
+            self._check_targets()
+
+            threads = [threading.Thread(target=self._reader,
+                                        args=(free_buffers, writer_queues, digest_futures))]
+            for writer, pending in zip(self.writers, writer_queues):
+                threads.append(threading.Thread(target=self._writer, args=(writer, pending)))
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            if self._errors:
+                raise self._errors[0]
+            if all(writer.error for writer in self.writers):
+                raise self.writers[0].error
+            if self._abort.is_set():
+                raise CopyCancelled("Copy cancelled")
+
+            self.source_digests = [future.result() for future in digest_futures]
+            if self.sync_callback:
+                self.sync_callback()
+            started = time.monotonic()
+            live = [writer for writer in self.writers if writer.error is None]
+            # Flush all targets at once, each fsync waits on its own device
+            with ThreadPoolExecutor(len(live)) as pool:
+                results = [(writer, pool.submit(writer.finish, self.total_bytes)) for writer in live]
+            for writer, result in results:
+                try:
+                    result.result()
+                except OSError as e:
+                    writer.error = e
+            self.sync_seconds = time.monotonic() - started
+        finally:
+            for writer in self.writers:
+                writer.close()
+            if self._hash_pool:
+                self._hash_pool.shutdown()
+
+        return self.writers
+
+    def _reader(self, free_buffers, writer_queues, digest_futures):
+        try:
+            with open_image(self.source) as src:
+                # The size of a compressed image is only known at its end
+                if not self.compression:
+                    remaining = self.total_bytes
+                else:
+                    remaining = self.length if self.length is not None else float("inf")
+                read_total = 0
+                dropped = 0
+                if self.start_offset and not self.compression and not self._hash_pool:
+                    src.seek(self.start_offset)
+                    remaining -= self.start_offset
+                    read_total = self.start_offset
+                while not self._abort.is_set():
+                    buf = free_buffers.get()
+                    buf.count = read_full(src, memoryview(buf.data)[:min(self.chunk_size, remaining)])
+                    remaining -= buf.count
+                    read_total += buf.count
+                    if self.compression and buf.count:
+                        self.total_bytes = min(max(read_total, src.estimated_size()), remaining + read_total)
+                    elif self.compression:
+                        self.total_bytes = read_total
+                    if not buf.count:
+                        free_buffers.put(buf)
+                        break
+                    if self.cache_friendly and read_total - dropped >= FLUSH_WINDOW:
+                        # Our buffers hold copies, the source pages are done with
+                        dropped = self._drop_source_cache(src, dropped, read_total)
+                    # Chunks before start_offset are already on the targets
+                    consumers = writer_queues if read_total > self.start_offset else []
+                    # The hash job holds a reference too, so the buffer is not
+                    # refilled before it has been hashed
+                    buf.hand_out(len(consumers) + (1 if self._hash_pool else 0))
+                    if self._hash_pool:
+                        future = self._hash_pool.submit(chunk_digest, memoryview(buf.data)[:buf.count])
+                        future.add_done_callback(lambda _, buf=buf: buf.release())
+                        digest_futures.append(future)
+                    elif not consumers:
+                        free_buffers.put(buf)
+                    for pending in consumers:
+                        pending.put(buf)
+        except Exception as e:
+            self._errors.append(e)
+            self._abort.set()
+        finally:
+            # Always wake the writers up, even on error
+            for pending in writer_queues:
+                pending.put(None)
+
+    def _drop_source_cache(self, src, dropped, read_total):
+        # Returns the new offset up to which the source has been dropped
+        if self.compression:
+            src.drop_cached_input()
+        else:
+            drop_cached_range(src.fileno(), dropped, read_total - dropped)
+        return read_total
+
+    def _writer(self, writer, pending):
+        while True:
+            buf = pending.get()
+            if buf is None:
+                break
+            try:
+                if writer.error is None and not self._abort.is_set():
+                    writer.write_chunk(buf.data, buf.count)
+                    if self.progress_callback:
+                        self.progress_callback(writer.path, writer.bytes_on_device, self.total_bytes)
+            except Exception as e:
+                # Only this target is lost, keep draining so the reader never stalls
+                writer.error = e
+                self._check_targets()
+            finally:
+                buf.release()
+
+    def _check_targets(self):
+        # No point reading on once every target has failed
+        if all(writer.error for writer in self.writers):
+            self._abort.set()
+
+
+class BlockCopier(FanOutCopier):
+    # Single-target copy, the common case of FanOutCopier
+    def __init__(self, source, target, chunk_size=DEFAULT_CHUNK_SIZE,
+                 queue_depth=DEFAULT_QUEUE_DEPTH, progress_callback=None,
+                 skip_zeros=False, target_is_blank=False, hash_source=False):
+        on_progress = None
+        if progress_callback:
+            on_progress = lambda path, done, total: progress_callback(done, total)
+        super().__init__(source, [target], chunk_size, queue_depth, on_progress,
+                         skip_zeros, target_is_blank, hash_source)
+        self.target = target
+
+    @property
+    def sparse(self):
+        return self.writers[0].sparse
+
+    @property
+    def bytes_written(self):
+        return self.writers[0].bytes_written
+
+    @property
+    def bytes_skipped(self):
+        return self.writers[0].bytes_skipped
+
+    def run(self):
+        writer = super().run()[0]
+        if writer.error:
+            raise writer.error
+        return writer.bytes_written
+
+
+class TargetVerifier:
+    # Reads the target back chunk by chunk and compares against the digests
+    # BlockCopier recorded. Reading stays on the calling thread while up to
+    # queue_depth chunks are being hashed on the worker pool.
+    # total_bytes defaults to the source size; pass the copier's total_bytes
+    # for compressed sources.
+    def __init__(self, source, target, digests, chunk_size=DEFAULT_CHUNK_SIZE,
+                 queue_depth=DEFAULT_QUEUE_DEPTH, progress_callback=None, total_bytes=None):
+        self.source = source
+        self.target = target
+        self.digests = digests
+        self.chunk_size = chunk_size
+        self.queue_depth = max(1, queue_depth)
+        self.progress_callback = progress_callback
+        self.total_bytes = total_bytes if total_bytes is not None else os.path.getsize(source)
+        self.bytes_verified = 0
+
+    def run(self):
+        if len(self.digests) * self.chunk_size < self.total_bytes:
+            raise ValueError("Source digests do not cover the whole image")
+
+        buffers = [bytearray(self.chunk_size) for _ in range(self.queue_depth)]
+        pending = deque()
+
+        with open(self.target, 'rb', buffering=0) as tgt, ThreadPoolExecutor(HASH_WORKERS) as pool:
+            drop_cached_pages(tgt.fileno())
+            offset = 0
+            index = 0
+            while offset < self.total_bytes:
+                if len(pending) == self.queue_depth:
+                    self._check(*pending.popleft())
+
+                view = memoryview(buffers[index % self.queue_depth])
+                wanted = min(self.chunk_size, self.total_bytes - offset)
+                count = read_full(tgt, view[:wanted])
+                if count < wanted:
+                    raise VerificationError(offset + count,
+                                            f"Target ends at byte {offset + count}, image is {self.total_bytes} bytes")
+                pending.append((index, offset, count, pool.submit(chunk_digest, view[:count])))
+                offset += count
+                index += 1
+
+            while pending:
+                self._check(*pending.popleft())
+
+        return self.bytes_verified
+
+    def _check(self, index, offset, count, digest):
+        if digest.result() != self.digests[index]:
+            raise VerificationError(self._first_difference(offset, count))
+        self.bytes_verified += count
+        if self.progress_callback:
+            self.progress_callback(self.bytes_verified, self.total_bytes)
+
+    def _first_difference(self, offset, count):
+        # Only reached on a mismatch, so re-reading one source chunk is fine
+        expected = read_at(self.source, offset, count)
+        with open(self.target, 'rb') as tgt:
+            tgt.seek(offset)
+            actual = tgt.read(count)
+        for i, (a, b) in enumerate(zip(expected, actual)):
+            if a != b:
+                return offset + i
+        return offset + min(len(expected), len(actual))
@@ -0,0 +1,46 @@
+import atexit
+import json
+import logging
+import os
+import queue
+from logging.handlers import QueueListener, RotatingFileHandler
+
+from usbcreator.paths import state_dir
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUPS = 5
+
+
+def default_log_path():
+    return os.path.join(state_dir("logs"), "events.jsonl")
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(dict(record.event, time=round(record.created, 3)), default=str)
+
+
+class EventLog:
+    # Persists job events as JSON lines. write() only queues the event; a
+    # background listener thread formats and writes it, rotating the file
+    # once it reaches max_bytes so the history stays bounded on disk.
+    def __init__(self, path=None, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS):
+        self.path = path or default_log_path()
+        handler = RotatingFileHandler(self.path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        handler.setFormatter(JsonLinesFormatter())
+        self._queue = queue.Queue()
+        self._listener = QueueListener(self._queue, handler)
+        self._listener.start()
+        self._handler = handler
+        atexit.register(self.close)
+
+    def write(self, event):
+        self._queue.put_nowait(logging.makeLogRecord({"event": dict(event)}))
+
+    def close(self):
+        # Flushes whatever is still queued
+        if self._listener:
+            self._listener.stop()
+            self._listener = None
+            self._handler.close()
+            atexit.unregister(self.close)
@@ -0,0 +1,37 @@
+import threading
+
+
+class EventQueue:
+    # Hand-off point between worker threads and a UI loop. Workers post from
+    # any thread; the UI thread calls drain() on a fixed tick. Progress is
+    # coalesced to the latest value and log lines are batched, so a copy loop
+    # posting thousands of updates a second costs one redraw per tick.
+    # Anything else that has to touch the UI is queued as a call().
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lines = []
+        self._progress = None
+        self._calls = []
+
+    def post(self, event):
+        with self._lock:
+            if event["event"] == "progress":
+                self._progress = event
+            elif event["event"] == "log":
+                self._lines.append(event["message"])
+
+    def log(self, message):
+        self.post({"event": "log", "message": message})
+
+    def call(self, func, *args):
+        # Run func(*args) on the UI thread, in posting order
+        with self._lock:
+            self._calls.append((func, args))
+
+    def drain(self):
+        # Returns (log lines, latest progress event or None, [(func, args)])
+        with self._lock:
+            lines, self._lines = self._lines, []
+            progress, self._progress = self._progress, None
+            calls, self._calls = self._calls, []
+        return lines, progress, calls
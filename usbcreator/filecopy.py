@@ -0,0 +1,152 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from usbcreator.engine import CopyCancelled, VerificationError, drop_cached_pages
+from usbcreator.isofs import ImageFormatError, IsoImage
+
+# FAT32 cannot hold files of 4 GiB or more; larger files are split into
+# name.001, name.002, ... parts of this size
+FAT32_MAX_FILE_SIZE = 4 * 1024 ** 3 - 1
+FAT32_SPLIT_SIZE = 4095 * 1024 * 1024
+FILE_CHUNK_SIZE = 1024 * 1024
+# Copies are I/O bound, a few files in flight keep a USB stick busy
+COPY_WORKERS = 4
+
+
+class FileCopier:
+    # Copies the files inside a non-hybrid ISO into dest_dir, which is the
+    # mounted file system of the target drive or any other directory. The
+    # directory tree is read with IsoImage, then files (or parts of split
+    # files) are copied by a thread pool. Every chunk is hashed on the way
+    # so verify() can check the copies without reading the image again.
+    def __init__(self, source, dest_dir, filesystem="FAT32", workers=COPY_WORKERS,
+                 chunk_size=FILE_CHUNK_SIZE, progress_callback=None, split_size=None):
+        self.source = source
+        self.dest_dir = dest_dir
+        self.filesystem = filesystem
+        self.workers = max(1, workers)
+        self.chunk_size = chunk_size
+        self.progress_callback = progress_callback
+        if split_size is None and filesystem == "FAT32":
+            split_size = FAT32_SPLIT_SIZE
+        self.split_size = split_size
+        self.entries = None
+        self.image_filesystem = None
+        self.total_bytes = 0
+        self.bytes_copied = 0
+        self.files_copied = 0
+        self.split_files = []
+        # (destination path, [chunk digests]) per copied file or part
+        self.digests = []
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def scan(self):
+        # Reads the directory tree once, returns the number of bytes to copy
+        if self.entries is None:
+            with IsoImage(self.source) as image:
+                self.entries = image.walk()
+                self.image_filesystem = image.filesystem
+            self.total_bytes = sum(entry["size"] for entry in self.entries)
+        return self.total_bytes
+
+    def _tasks(self):
+        # (entry, start, length, destination) per file or file part
+        tasks = []
+        for entry in self.entries:
+            if entry["is_dir"]:
+                continue
+            destination = os.path.join(self.dest_dir, *entry["path"].split("/"))
+            if self.split_size and entry["size"] > FAT32_MAX_FILE_SIZE:
+                self.split_files.append(entry["path"])
+                parts = range(0, entry["size"], self.split_size)
+                for number, start in enumerate(parts, 1):
+                    length = min(self.split_size, entry["size"] - start)
+                    tasks.append((entry, start, length, f"{destination}.{number:03d}"))
+            else:
+                tasks.append((entry, 0, entry["size"], destination))
+        # Biggest first, so one huge file does not start last and run alone
+        tasks.sort(key=lambda task: task[2], reverse=True)
+        return tasks
+
+    def run(self, progress_callback=None):
+        if progress_callback:
+            self.progress_callback = progress_callback
+        self.scan()
+        for entry in self.entries:
+            if entry["is_dir"]:
+                os.makedirs(os.path.join(self.dest_dir, *entry["path"].split("/")), exist_ok=True)
+        tasks = self._tasks()
+
+        with IsoImage(self.source) as image, ThreadPoolExecutor(self.workers) as pool:
+            results = [pool.submit(self._copy, image, *task) for task in tasks]
+            try:
+                for result in results:
+                    self.digests.append(result.result())
+            except BaseException:
+                self._cancelled.set()
+                raise
+        return self.bytes_copied
+
+    def _copy(self, image, entry, start, length, destination):
+        digests = []
+        with open(destination, "wb") as f:
+            done = 0
+            while done < length:
+                if self._cancelled.is_set():
+                    raise CopyCancelled("Copy cancelled")
+                wanted = min(self.chunk_size, length - done)
+                data = image.read_range(entry, start + done, wanted)
+                # Extents shorter than the recorded size would never finish
+                if len(data) != wanted:
+                    raise ImageFormatError(f"{destination}: the image has {start + done + len(data)} bytes of "
+                                           f"this file, its directory entry says {start + length}")
+                f.write(data)
+                digests.append(hashlib.sha256(data).digest())
+                done += len(data)
+                self._advance(len(data))
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            self.files_copied += 1
+        return destination, digests
+
+    def _advance(self, count):
+        with self._lock:
+            self.bytes_copied += count
+            done = self.bytes_copied
+        if self.progress_callback:
+            self.progress_callback(done, self.total_bytes)
+
+    def verify(self, progress_callback=None):
+        # Reads every copied file back; raises VerificationError with the
+        # offset of the first differing chunk within the file
+        verified = [0]
+        lock = threading.Lock()
+
+        def check(destination, digests):
+            with open(destination, "rb", buffering=0) as f:
+                drop_cached_pages(f.fileno())
+                for index, expected in enumerate(digests):
+                    data = f.read(self.chunk_size)
+                    if hashlib.sha256(data).digest() != expected:
+                        offset = index * self.chunk_size
+                        raise VerificationError(offset, f"{destination} differs from the image near byte {offset}")
+                    with lock:
+                        verified[0] += len(data)
+                        done = verified[0]
+                    if progress_callback:
+                        progress_callback(done, self.total_bytes)
+                if f.read(1):
+                    raise VerificationError(os.path.getsize(destination),
+                                            f"{destination} is longer than the file in the image")
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            for result in [pool.submit(check, *item) for item in self.digests]:
+                result.result()
+        return verified[0]
@@ -0,0 +1,105 @@
+import os
+import subprocess
+import sys
+import time
+
+from usbcreator.drives import mount_points_for, mounted_partitions
+from usbcreator.mkfs import FormatError, format_cluster_size, format_volume
+
+# Asks the kernel to read a new partition table (Linux)
+BLKRRPART = 0x125F
+# How long to wait for the new partition's device node to show up
+PARTITION_WAIT = 5.0
+
+
+def format_command(drive_path, filesystem, cluster_size="Default"):
+    # Platform specific formatting commands, None where there is no equivalent
+    if sys.platform == 'win32':
+        cluster_param = "" if cluster_size == "Default" else f"/A:{cluster_size}"
+        return f'format {drive_path} /FS:{filesystem} /Q {cluster_param}'
+    elif sys.platform.startswith('linux'):
+        fs_cmd = {
+            "FAT32": "mkfs.vfat",
+            "NTFS": "mkfs.ntfs",
+            "exFAT": "mkfs.exfat"
+        }.get(filesystem, "mkfs.vfat")
+        return f'sudo {fs_cmd} {drive_path}'
+    return None
+
+
+def format_drive(drive_path, filesystem, cluster_size="Default", log=print, label="", partition_table="mbr"):
+    log(f"Formatting drive {drive_path} with {filesystem}...")
+    if filesystem in ("FAT32", "exFAT"):
+        # Written in-process, only the metadata regions are touched
+        started = time.monotonic()
+        result = format_volume(drive_path, filesystem, cluster_size, label=label, partition_table=partition_table)
+        log(f"Created {result['partition_table'].upper()} partition of "
+            f"{result['partition_size'] / 1024 ** 3:.2f} GB with {filesystem}, {result['clusters']} clusters "
+            f"of {format_cluster_size(result['cluster_size'])} in {time.monotonic() - started:.2f}s")
+        return result
+    format_cmd = format_command(drive_path, filesystem, cluster_size)
+    if format_cmd:
+        # In a real application, you'd run this command, but for safety we'll simulate it
+        # subprocess.run(format_cmd, shell=True, check=True)
+        log(f"Would run: {format_cmd} (simulated)")
+
+
+def partition_path(drive_path, number=1):
+    # /dev/sdb -> /dev/sdb1, /dev/mmcblk0 -> /dev/mmcblk0p1
+    return f"{drive_path}{'p' if drive_path[-1:].isdigit() else ''}{number}"
+
+
+def _udisks(*args):
+    try:
+        subprocess.run(["udisksctl", *args, "--no-user-interaction"], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=30)
+    except subprocess.CalledProcessError as e:
+        raise FormatError(f"udisksctl {args[0]} failed: {e.stderr.decode(errors='replace').strip()}")
+    except subprocess.TimeoutExpired:
+        raise FormatError(f"udisksctl {args[0]} did not finish")
+
+
+def format_for_file_copy(drive_path, filesystem, cluster_size="Default", log=print, label="",
+                         partition_table="mbr"):
+    # File-copy mode copies into the drive's mounted file system, so the
+    # drive is unmounted, formatted and its new partition mounted again
+    # (udisks on Linux). Returns the new mount point. Elsewhere a mounted
+    # drive is refused rather than rewritten under the file system using it.
+    mounted = mounted_partitions(drive_path)
+    if filesystem not in ("FAT32", "exFAT"):
+        # Only simulated, the drive is left as it is
+        format_drive(drive_path, filesystem, cluster_size, log=log, label=label, partition_table=partition_table)
+        return mounted[0][1] if mounted else None
+    if not sys.platform.startswith('linux'):
+        if mounted:
+            raise FormatError(f"{drive_path} is mounted at {mounted[0][1]}, eject it before formatting "
+                              "or turn formatting off")
+        format_drive(drive_path, filesystem, cluster_size, log=log, label=label, partition_table=partition_table)
+        return None
+
+    for device, mount_point in mounted:
+        log(f"Unmounting {mount_point}...")
+        _udisks("unmount", "-b", device)
+    format_drive(drive_path, filesystem, cluster_size, log=log, label=label, partition_table=partition_table)
+
+    import fcntl
+    fd = os.open(drive_path, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, BLKRRPART)
+    except OSError as e:
+        # Not fatal yet, the wait below tells whether the partition showed up
+        log(f"Could not make the kernel read the new partition table of {drive_path}: {e}")
+    finally:
+        os.close(fd)
+    partition = partition_path(drive_path)
+    deadline = time.monotonic() + PARTITION_WAIT
+    while not os.path.exists(partition):
+        if time.monotonic() > deadline:
+            raise FormatError(f"{partition} did not appear after formatting")
+        time.sleep(0.1)
+    _udisks("mount", "-b", partition)
+    found = mount_points_for(partition)
+    if not found:
+        raise FormatError(f"{partition} was mounted but is not listed in /proc/mounts")
+    log(f"Mounted {partition} at {found[0]}")
+    return found[0]
@@ -0,0 +1,257 @@
+import os
+import random
+import stat
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from usbcreator.compressed import compression_of, uncompressed_size
+from usbcreator.engine import drop_cached_pages
+
+# Seeded blocks written across the whole claimed capacity; a fake stick
+# loses the ones past its real size or maps them onto lower addresses
+HEALTH_SAMPLES = 64
+SAMPLE_BYTES = 64 * 1024
+# Speed test: one sequential run at the start of the drive and scattered
+# 4 KB writes, each timed including the fsync
+SPEED_BYTES = 16 * 1024 * 1024
+RANDOM_WRITES = 128
+RANDOM_BLOCK = 4096
+# Default threshold; slower media takes ages to flash and is often failing
+MIN_WRITE_RATE = 2 * 1024 * 1024
+# Blocks start with magic, seed and their own offset so a block read back
+# at the wrong address tells where it was really written
+MAGIC = b"USBCHK01"
+HEADER = struct.Struct("<8sQQ")
+
+
+def sample_offsets(capacity, samples=HEALTH_SAMPLES, block=SAMPLE_BYTES):
+    # Evenly spread, block aligned, the last one at the very end. Fake
+    # sticks usually wrap at a power of two, so those offsets (and 1.5
+    # times them) are added too: past the real size they land on offset 0.
+    last = (capacity - block) // block * block
+    if last < 0:
+        return []
+    offsets = {last * i // max(1, samples - 1) // block * block for i in range(samples)}
+    offsets.add(last)
+    power = 1024 * 1024
+    while power <= last:
+        offsets.add(power)
+        if power * 3 // 2 <= last:
+            offsets.add(power * 3 // 2)
+        power *= 2
+    return sorted(offsets)
+
+
+def pattern(seed, offset, size=SAMPLE_BYTES):
+    header = HEADER.pack(MAGIC, seed, offset)
+    return header + random.Random(seed * 1000003 + offset).randbytes(size - len(header))
+
+
+def _pread_full(fd, count, offset):
+    data = b""
+    while len(data) < count:
+        part = os.pread(fd, count - len(data), offset + len(data))
+        if not part:
+            break
+        data += part
+    return data
+
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+class MediaCheck:
+    # Pre-flash check of one target, a drive or an image file. Writes the
+    # seeded pattern blocks, reads them back past the page cache and
+    # measures sequential and random write speed. Everything it overwrites
+    # is read first and put back afterwards, so a drive that fails the
+    # check keeps its data; image files are truncated back to their size,
+    # and one that did not exist yet is created for the check and removed.
+    #
+    # run() returns a report: device (a block or character device rather
+    # than an image file, which grows as needed), capacity (what it claims),
+    # real_capacity (where the first block was lost, None if none was),
+    # bad_offsets, wrapped (blocks turned up at other addresses), read_rate,
+    # write_rate, random_iops and error (an I/O error that ended the check).
+    def __init__(self, path, seed=None, samples=HEALTH_SAMPLES):
+        self.path = path
+        self.seed = seed if seed is not None else random.getrandbits(63)
+        self.samples = samples
+
+    def run(self):
+        report = {"path": self.path, "device": False, "capacity": 0, "real_capacity": None, "bad_offsets": [],
+                  "wrapped": False, "read_rate": None, "write_rate": None, "random_iops": None, "error": None}
+        created = not os.path.exists(self.path)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        original_size = None
+        try:
+            mode = os.fstat(fd).st_mode
+            report["device"] = stat.S_ISBLK(mode) or stat.S_ISCHR(mode)
+            report["capacity"] = os.lseek(fd, 0, os.SEEK_END)
+            if not report["device"]:
+                original_size = report["capacity"]
+            try:
+                self._check_capacity(fd, report)
+                self._check_speed(fd, report)
+            except OSError as e:
+                report["error"] = str(e)
+        finally:
+            try:
+                if original_size is not None:
+                    os.ftruncate(fd, original_size)
+            finally:
+                os.close(fd)
+                if created:
+                    os.remove(self.path)
+        return report
+
+    def _check_capacity(self, fd, report):
+        offsets = sample_offsets(report["capacity"], self.samples)
+        if not offsets:
+            return
+        saved = [(offset, _pread_full(fd, SAMPLE_BYTES, offset)) for offset in offsets]
+        try:
+            # Highest first: where a high address really lands on a lower
+            # one, the lower block is written last and wins
+            for offset in reversed(offsets):
+                _pwrite_all(fd, pattern(self.seed, offset), offset)
+            os.fsync(fd)
+            drop_cached_pages(fd)
+            bad = set()
+            for offset in offsets:
+                try:
+                    data = _pread_full(fd, SAMPLE_BYTES, offset)
+                except OSError:
+                    bad.add(offset)
+                    continue
+                if data == pattern(self.seed, offset):
+                    continue
+                bad.add(offset)
+                magic, seed, written_at = HEADER.unpack_from(data.ljust(HEADER.size, b"\0"))
+                if magic == MAGIC and seed == self.seed and written_at < offset:
+                    # Reading here returns a block written further in
+                    report["wrapped"] = True
+            report["bad_offsets"] = sorted(bad)
+            if bad:
+                report["real_capacity"] = min(bad)
+        finally:
+            # Highest first again, on a wrapped stick the low blocks win
+            for offset, data in reversed(saved):
+                _pwrite_all(fd, data, offset)
+            os.fsync(fd)
+
+    def _check_speed(self, fd, report):
+        usable = report["real_capacity"] if report["real_capacity"] is not None else report["capacity"]
+        length = min(SPEED_BYTES, usable) if usable else SPEED_BYTES
+        drop_cached_pages(fd)
+        started = time.perf_counter()
+        saved = _pread_full(fd, length, 0)
+        if saved:
+            report["read_rate"] = len(saved) / max(time.perf_counter() - started, 1e-6)
+        blocks = []
+        try:
+            data = random.Random(self.seed).randbytes(length)
+            started = time.perf_counter()
+            _pwrite_all(fd, data, 0)
+            os.fsync(fd)
+            report["write_rate"] = length / max(time.perf_counter() - started, 1e-6)
+
+            if usable >= RANDOM_BLOCK:
+                rng = random.Random(self.seed + 1)
+                offsets = [rng.randrange(usable // RANDOM_BLOCK) * RANDOM_BLOCK for _ in range(RANDOM_WRITES)]
+                blocks = [(offset, _pread_full(fd, RANDOM_BLOCK, offset)) for offset in offsets]
+                block = rng.randbytes(RANDOM_BLOCK)
+                started = time.perf_counter()
+                for offset in offsets:
+                    _pwrite_all(fd, block, offset)
+                os.fsync(fd)
+                report["random_iops"] = len(offsets) / max(time.perf_counter() - started, 1e-6)
+        finally:
+            # Later backups were taken after the earlier writes, put them
+            # back in reverse
+            for offset, original in reversed(blocks):
+                _pwrite_all(fd, original, offset)
+            _pwrite_all(fd, saved, 0)
+            os.fsync(fd)
+
+
+def check_targets(paths, log=print, samples=HEALTH_SAMPLES):
+    # {path: report}, all targets checked at the same time
+    def check(path):
+        log(f"Checking {path} (capacity and speed)...")
+        try:
+            report = MediaCheck(path, samples=samples).run()
+        except OSError as e:
+            report = {"path": path, "error": str(e)}
+        for line in describe_health(report):
+            log(line)
+        return report
+
+    if not paths:
+        return {}
+    with ThreadPoolExecutor(len(paths)) as pool:
+        return dict(zip(paths, pool.map(check, paths)))
+
+
+def image_bytes(image):
+    # Space the image needs on the target, 0 when unknown (bz2)
+    try:
+        if compression_of(image):
+            return uncompressed_size(image) or 0
+        return os.path.getsize(image)
+    except OSError:
+        return 0
+
+
+def health_problems(report, needed_bytes=0, min_write_rate=MIN_WRITE_RATE):
+    # Why the target should not be written, [] when it passed
+    problems = []
+    if report.get("error"):
+        problems.append(f"I/O error during the check: {report['error']}")
+    if report.get("real_capacity") is not None:
+        problems.append(f"only {report['real_capacity'] / (1024 ** 3):.2f} GB of the claimed "
+                        f"{report['capacity'] / (1024 ** 3):.2f} GB can be read back"
+                        + (" (fake capacity)" if report.get("wrapped") else ""))
+    usable = report.get("real_capacity")
+    if usable is None:
+        usable = report.get("capacity", 0)
+    # A file target grows as needed, only a device has a hard limit
+    if needed_bytes and usable < needed_bytes and report.get("device"):
+        problems.append(f"too small for the image ({usable / (1024 ** 3):.2f} GB, "
+                        f"needs {needed_bytes / (1024 ** 3):.2f} GB)")
+    if min_write_rate and report.get("write_rate") is not None and report["write_rate"] < min_write_rate:
+        problems.append(f"writes at {report['write_rate'] / (1024 * 1024):.1f} MB/s, "
+                        f"below {min_write_rate / (1024 * 1024):.1f} MB/s")
+    return problems
+
+
+def describe_health(report):
+    # Log lines for a MediaCheck report
+    if report.get("error") and not report.get("capacity"):
+        return [f"{report['path']}: check failed: {report['error']}"]
+    lines = []
+    if report.get("real_capacity") is not None:
+        lines.append(f"{report['path']}: {len(report['bad_offsets'])} of the test blocks were lost, at most the first "
+                     f"{report['real_capacity'] / (1024 ** 3):.2f} GB are real"
+                     + (", addresses wrap around" if report.get("wrapped") else ""))
+    elif report.get("capacity"):
+        lines.append(f"{report['path']}: all test blocks read back, "
+                     f"{report['capacity'] / (1024 ** 3):.2f} GB are real")
+    speeds = []
+    if report.get("write_rate"):
+        speeds.append(f"write {report['write_rate'] / (1024 * 1024):.1f} MB/s")
+    if report.get("read_rate"):
+        speeds.append(f"read {report['read_rate'] / (1024 * 1024):.1f} MB/s")
+    if report.get("random_iops"):
+        speeds.append(f"{report['random_iops']:.0f} random 4 KB writes/s")
+    if speeds:
+        lines.append(f"{report['path']}: " + ", ".join(speeds))
+    if report.get("error"):
+        lines.append(f"{report['path']}: I/O error: {report['error']}")
+    return lines
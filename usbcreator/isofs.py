@@ -0,0 +1,350 @@
+import os
+import struct
+
+SECTOR = 2048
+# Directory records of a broken or hostile image must not send us in circles
+MAX_DEPTH = 64
+
+# UDF descriptor tag identifiers
+TAG_AVDP = 2
+TAG_PARTITION = 5
+TAG_LOGICAL_VOLUME = 6
+TAG_TERMINATOR = 8
+TAG_FILE_SET = 256
+TAG_FILE_ID = 257
+TAG_ALLOC_EXTENT = 258
+TAG_FILE_ENTRY = 261
+TAG_EXT_FILE_ENTRY = 266
+
+
+class ImageFormatError(Exception):
+    pass
+
+
+def clean_name(name):
+    # A single path component, or None for names we must not create on disk
+    name = name.replace("\x00", "")
+    if not name or name in (".", "..") or "/" in name or "\\" in name:
+        return None
+    return name
+
+
+class IsoImage:
+    # Reads the directory tree of an ISO image without mounting it. Uses the
+    # UDF file system when there is one (Windows installers keep their files
+    # there, the ISO9660 side only holds a README), then Joliet, then
+    # ISO9660 with Rock Ridge names.
+    #
+    # walk() returns entries as dicts: path (relative, "/" separated),
+    # is_dir, size and extents, a list of (image offset, length) with
+    # offset None for unrecorded extents that read as zeros. read_range()
+    # uses pread, so several threads can read files at the same time.
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.filesystem = None
+        self._rock_ridge = False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        self.size = os.fstat(self.fd).st_size
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _read(self, offset, length):
+        data = os.pread(self.fd, length, offset)
+        if len(data) < length:
+            raise ImageFormatError(f"Image ends at byte {offset + len(data)}, expected {offset + length}")
+        return data
+
+    def read_range(self, entry, start, length):
+        # length bytes of the file in entry starting at start
+        chunks = []
+        position = 0
+        end = start + length
+        for offset, extent_length in entry["extents"]:
+            extent_end = position + extent_length
+            if extent_end > start and position < end:
+                lo = max(start, position) - position
+                hi = min(end, extent_end) - position
+                if offset is None:
+                    chunks.append(bytes(hi - lo))
+                else:
+                    chunks.append(self._read(offset + lo, hi - lo))
+            position = extent_end
+            if position >= end:
+                break
+        return b"".join(chunks)
+
+    def walk(self):
+        for reader in (self._walk_udf, self._walk_iso9660):
+            entries = reader()
+            if entries is not None:
+                return entries
+        raise ImageFormatError("No ISO9660 or UDF file system found")
+
+    # ISO9660 / Joliet / Rock Ridge
+
+    def _walk_iso9660(self):
+        primary = joliet = None
+        sector = 16
+        while (sector + 1) * SECTOR <= self.size:
+            descriptor = self._read(sector * SECTOR, SECTOR)
+            if descriptor[1:6] != b"CD001" or descriptor[0] == 255:
+                break
+            if descriptor[0] == 1 and primary is None:
+                primary = descriptor
+            elif descriptor[0] == 2 and descriptor[88:90] == b"%/" and descriptor[90:91] in (b"@", b"C", b"E"):
+                joliet = descriptor
+            sector += 1
+        if primary is None:
+            return None
+
+        descriptor = joliet or primary
+        self.filesystem = "joliet" if joliet else "iso9660"
+        root = self._parse_record(descriptor[156:190])
+        entries = []
+        self._walk_directory(root, "", entries, joliet is not None, set(), 0)
+        if not joliet and self._rock_ridge:
+            self.filesystem = "rockridge"
+        return entries
+
+    def _parse_record(self, record):
+        extent, size = struct.unpack_from("<I", record, 2)[0], struct.unpack_from("<I", record, 10)[0]
+        flags = record[25]
+        name_length = record[32]
+        return {
+            "extent": extent,
+            "size": size,
+            "flags": flags,
+            "name": record[33:33 + name_length],
+            "system_use": record[33 + name_length + (1 - name_length % 2):],
+        }
+
+    def _records(self, directory):
+        # Records never cross a sector boundary, a zero length byte means
+        # the rest of the sector is padding
+        data = self._read(directory["extent"] * SECTOR, directory["size"])
+        offset = 0
+        while offset < len(data):
+            length = data[offset]
+            if not length:
+                offset = (offset // SECTOR + 1) * SECTOR
+                continue
+            yield self._parse_record(data[offset:offset + length])
+            offset += length
+
+    def _rock_ridge_name(self, system_use):
+        name = b""
+        offset = 0
+        while offset + 4 <= len(system_use):
+            signature, length = system_use[offset:offset + 2], system_use[offset + 2]
+            if length < 4:
+                break
+            if signature == b"NM":
+                name += system_use[offset + 5:offset + length]
+            offset += length
+        if name:
+            self._rock_ridge = True
+            return name.decode("utf-8", "replace")
+        return None
+
+    def _decode_name(self, record, joliet):
+        raw = record["name"]
+        if raw in (b"\x00", b"\x01"):
+            return None
+        if joliet:
+            name = raw.decode("utf-16-be", "replace")
+        else:
+            name = self._rock_ridge_name(record["system_use"])
+            if name is not None:
+                return clean_name(name)
+            name = raw.decode("ascii", "replace")
+        name = name.split(";", 1)[0]
+        if not record["flags"] & 0x02 and name.endswith("."):
+            name = name[:-1]
+        return clean_name(name)
+
+    def _walk_directory(self, directory, prefix, entries, joliet, visited, depth):
+        if depth > MAX_DEPTH or directory["extent"] in visited:
+            return
+        visited.add(directory["extent"])
+        pending = None
+        for record in self._records(directory):
+            name = self._decode_name(record, joliet)
+            if name is None:
+                continue
+            path = prefix + name
+            if record["flags"] & 0x02:
+                entries.append({"path": path, "is_dir": True, "size": 0, "extents": []})
+                self._walk_directory(record, path + "/", entries, joliet, visited, depth + 1)
+                continue
+            # Files over 4 GiB are stored as several records with the same
+            # name, all but the last flagged multi-extent
+            extent = (record["extent"] * SECTOR, record["size"])
+            if pending and pending["path"] == path:
+                pending["extents"].append(extent)
+                pending["size"] += record["size"]
+            else:
+                pending = {"path": path, "is_dir": False, "size": record["size"], "extents": [extent]}
+                entries.append(pending)
+            if not record["flags"] & 0x80:
+                pending = None
+
+    # UDF
+
+    def _tag(self, data):
+        return struct.unpack_from("<H", data, 0)[0]
+
+    def _walk_udf(self):
+        if 257 * SECTOR > self.size:
+            return None
+        anchor = self._read(256 * SECTOR, SECTOR)
+        if self._tag(anchor) != TAG_AVDP:
+            return None
+        try:
+            return self._read_udf(anchor)
+        except (ImageFormatError, struct.error, KeyError, IndexError, UnicodeDecodeError):
+            # Not something we can read (e.g. metadata partitions), the
+            # ISO9660 side may still do
+            return None
+
+    def _read_udf(self, anchor):
+        vds_length, vds_location = struct.unpack_from("<II", anchor, 16)
+        partitions = {}
+        volume = None
+        for sector in range(vds_location, vds_location + vds_length // SECTOR):
+            descriptor = self._read(sector * SECTOR, SECTOR)
+            tag = self._tag(descriptor)
+            if tag == TAG_PARTITION:
+                number = struct.unpack_from("<H", descriptor, 22)[0]
+                partitions[number] = struct.unpack_from("<I", descriptor, 188)[0]
+            elif tag == TAG_LOGICAL_VOLUME:
+                volume = descriptor
+            elif tag == TAG_TERMINATOR:
+                break
+        if volume is None or struct.unpack_from("<I", volume, 212)[0] != SECTOR:
+            return None
+
+        # Partition reference numbers map to partition numbers; only plain
+        # type 1 maps are supported
+        self._partition_starts = []
+        offset = 440
+        for _ in range(struct.unpack_from("<I", volume, 268)[0]):
+            map_type, map_length = volume[offset], volume[offset + 1]
+            if map_type != 1:
+                return None
+            self._partition_starts.append(partitions[struct.unpack_from("<H", volume, offset + 4)[0]])
+            offset += map_length
+
+        fileset = self._read(self._long_ad_offset(volume[248:264]), SECTOR)
+        if self._tag(fileset) != TAG_FILE_SET:
+            return None
+        root = self._file_entry(fileset[400:416])
+        self.filesystem = "udf"
+        entries = []
+        self._walk_udf_directory(root, "", entries, set(), 0)
+        return entries
+
+    def _long_ad_offset(self, long_ad):
+        block, reference = struct.unpack_from("<IH", long_ad, 4)
+        return (self._partition_starts[reference] + block) * SECTOR
+
+    def _file_entry(self, long_ad):
+        # Returns (is_dir, size, extents) of the file entry the ICB points at
+        reference = struct.unpack_from("<H", long_ad, 8)[0]
+        location = self._long_ad_offset(long_ad)
+        entry = self._read(location, SECTOR)
+        tag = self._tag(entry)
+        if tag == TAG_FILE_ENTRY:
+            ea_length, ad_length = struct.unpack_from("<II", entry, 168)
+            ad_start = 176 + ea_length
+        elif tag == TAG_EXT_FILE_ENTRY:
+            ea_length, ad_length = struct.unpack_from("<II", entry, 208)
+            ad_start = 216 + ea_length
+        else:
+            raise ImageFormatError(f"No UDF file entry at byte {location}")
+        file_type = entry[27]
+        ad_type = struct.unpack_from("<H", entry, 34)[0] & 0x7
+        size = struct.unpack_from("<Q", entry, 56)[0]
+        ads = entry[ad_start:ad_start + ad_length]
+
+        if ad_type == 3:
+            # Small files and directories live inside the file entry itself
+            extents = [(location + ad_start, size)]
+        else:
+            extents = self._allocation_descriptors(ads, ad_type, reference)
+        return {"is_dir": file_type == 4, "size": size, "extents": extents}
+
+    def _allocation_descriptors(self, ads, ad_type, reference):
+        extents = []
+        step = 8 if ad_type == 0 else 16
+        offset = 0
+        while offset + step <= len(ads):
+            length_field, block = struct.unpack_from("<II", ads, offset)
+            if ad_type == 1:
+                reference = struct.unpack_from("<H", ads, offset + 8)[0]
+            offset += step
+            kind, length = length_field >> 30, length_field & 0x3FFFFFFF
+            if not length:
+                break
+            position = (self._partition_starts[reference] + block) * SECTOR
+            if kind == 3:
+                # The list continues in an allocation extent descriptor
+                continuation = self._read(position, length)
+                if self._tag(continuation) != TAG_ALLOC_EXTENT:
+                    raise ImageFormatError("Broken UDF allocation extent")
+                next_length = struct.unpack_from("<I", continuation, 20)[0]
+                extents.extend(self._allocation_descriptors(continuation[24:24 + next_length], ad_type, reference))
+                break
+            extents.append((position if kind == 0 else None, length))
+        return extents
+
+    def _walk_udf_directory(self, directory, prefix, entries, visited, depth):
+        key = directory["extents"][0][0] if directory["extents"] else None
+        if depth > MAX_DEPTH or key in visited:
+            return
+        visited.add(key)
+        data = self.read_range(directory, 0, directory["size"])
+        offset = 0
+        while offset + 38 <= len(data):
+            if self._tag(data[offset:offset + 2]) != TAG_FILE_ID:
+                break
+            characteristics, id_length = data[offset + 18], data[offset + 19]
+            icb = data[offset + 20:offset + 36]
+            use_length = struct.unpack_from("<H", data, offset + 36)[0]
+            name_start = offset + 38 + use_length
+            identifier = data[name_start:name_start + id_length]
+            offset += (38 + use_length + id_length + 3) & ~3
+            # Skip the parent entry and deleted files
+            if characteristics & 0x0C:
+                continue
+            name = clean_name(self._udf_name(identifier))
+            if name is None:
+                continue
+            path = prefix + name
+            child = self._file_entry(icb)
+            if characteristics & 0x02 or child["is_dir"]:
+                entries.append({"path": path, "is_dir": True, "size": 0, "extents": []})
+                self._walk_udf_directory(child, path + "/", entries, visited, depth + 1)
+            else:
+                entries.append({"path": path, "is_dir": False, "size": child["size"],
+                                "extents": child["extents"]})
+
+    def _udf_name(self, identifier):
+        # OSTA compressed unicode: 8 bit or 16 bit big endian characters
+        if not identifier:
+            return ""
+        if identifier[0] == 16:
+            return identifier[1:].decode("utf-16-be", "replace")
+        return identifier[1:].decode("latin-1")
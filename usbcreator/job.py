@@ -0,0 +1,499 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from usbcreator.analysis import analyze_iso, describe_image
+from usbcreator.autotune import tuned_parameters
+from usbcreator.delta import DeltaCopier, ManifestStore, target_key
+from usbcreator.drives import mount_point_for
+from usbcreator.engine import (DEFAULT_CHUNK_SIZE, DEFAULT_QUEUE_DEPTH, FLUSH_WINDOW, FanOutCopier,
+                               TargetVerifier, VerificationError)
+from usbcreator.filecopy import FileCopier
+from usbcreator.formatting import format_for_file_copy
+from usbcreator.journal import WriteJournal
+from usbcreator.mkfs import FormatError
+from usbcreator.stats import PhaseTimer, ThroughputMeter
+from usbcreator.zerocopy import KernelCopier, ZeroCopyUnsupported
+
+
+class ImagingJob:
+    # One image written to one or more targets: analyze, format, copy, sync,
+    # verify. Everything the GUI and CLI need to show is reported through
+    # on_event as plain dicts, e.g. {"event": "log", "message": ...} or
+    # {"event": "progress", "phase": "copy", "percent": 63, "status": ...}.
+    #
+    # The overall percentage is the share of bytes copied (and verified)
+    # so far. Copy and verify progress events also carry bytes_done,
+    # bytes_total, rate (bytes/s) and eta (seconds) for the slowest target.
+    #
+    # With autotune the chunk size and queue depth come from a saved profile
+    # for the first target's model and serial (drives holds the drive_info
+    # dicts, in target order), or from a short probe when there is none.
+    #
+    # With delta each target only gets the blocks that differ from what is
+    # already on it, judged by the manifest of block hashes saved after the
+    # last successful write, or by reading the target when there is none.
+    # Delta writes are always verified.
+    #
+    # write_mode is "raw" (block copy) or "file-copy" (the files inside the
+    # ISO copied onto the mounted drive or into a directory); None picks
+    # what the image analysis recommends.
+    #
+    # copy_backend picks how raw writes move the data: "buffered" is the
+    # FanOutCopier pipeline, "copy_file_range", "sendfile" or "splice" let
+    # the kernel copy (KernelCopier), "auto" uses the kernel when one image
+    # is written as is to one drive and falls back to buffered when it
+    # cannot. Several drives stay on the buffered pipeline, which reads the
+    # image once for all of them, and so do autotuned writes, whose queue
+    # depth only the pipeline has.
+    #
+    # cache_friendly keeps raw writes from filling the page cache (see
+    # FanOutCopier) and logs how long each flush window took.
+    #
+    # Raw writes keep a WriteJournal per target. When the same image is
+    # written to the same targets again after an interruption, the copy
+    # continues from the last checkpoint all of them reached.
+    def __init__(self, iso, targets, format_drive=False, filesystem="FAT32",
+                 cluster_size="Default", skip_zeros=False, verify=False, on_event=None,
+                 autotune=False, drives=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 queue_depth=DEFAULT_QUEUE_DEPTH, delta=False, write_mode=None, partition_table="mbr",
+                 copy_backend="auto", cache_friendly=False):
+        self.iso = iso
+        self.targets = list(targets)
+        self.requested = list(self.targets)
+        self.drives = drives or [None] * len(self.targets)
+        self.autotune = autotune
+        self.chunk_size = chunk_size
+        self.queue_depth = queue_depth
+        self.delta = delta
+        self.write_mode = write_mode
+        self.format_drive = format_drive
+        self.filesystem = filesystem
+        self.cluster_size = cluster_size
+        self.partition_table = partition_table
+        self.copy_backend = copy_backend
+        self.cache_friendly = cache_friendly
+        self.backend_used = None
+        self.skip_zeros = skip_zeros
+        self.verify = verify
+        self.on_event = on_event
+        self.info = None
+        self.copier = None
+        self.journals = {}
+        self.resume_offset = 0
+        self.succeeded = []
+        self.failed = {}
+        # Copy throughput per target, bytes per second
+        self.rates = {}
+        self.timer = PhaseTimer()
+
+    def emit(self, event, **fields):
+        if self.on_event:
+            self.on_event(dict(event=event, **fields))
+
+    def log(self, message):
+        self.emit("log", message=message)
+
+    def progress(self, percent, status=None, phase=None, **fields):
+        self.emit("progress", percent=percent, status=status, phase=phase, **fields)
+
+    def start_phase(self, phase, percent, status):
+        self.timer.start(phase)
+        self.progress(percent, status, phase)
+
+    def run(self):
+        # Returns once every target is done; raises if none of them succeeded.
+        # The "timing" event at the end sums the job up for metrics.
+        failed = []
+        try:
+            return self._run()
+        except Exception:
+            failed = list(self.requested)
+            raise
+        finally:
+            self.timer.stop()
+            self.log(f"Timing: {self.timer.summary()}")
+            failed = failed or list(self.failed)
+            self.emit("timing", phases=self.timer.durations, bytes=self.timer.bytes, total=self.timer.total,
+                      backend=self.backend_used, rates=self.rates,
+                      succeeded=[path for path in self.requested if path not in failed], failed=failed,
+                      failed_phase=list(self.timer.durations)[-1] if failed and self.timer.durations else None,
+                      resumed=self.resume_offset > 0)
+
+    def _run(self):
+        iso = self.iso
+        self.log(f"Starting to create bootable USB on {', '.join(self.targets)}")
+        self.log(f"Using ISO: {os.path.basename(iso)}")
+        self.start_phase("analyze", 0, "Analyzing ISO...")
+
+        info = self.info = analyze_iso(iso)
+        # For compressed images a best effort estimate until the copy is done
+        iso_size = info["image_size"] or info["size"]
+        size_label = "Compressed image size" if info["compression"] else "ISO size"
+        self.log(f"{size_label}: {info['size'] / (1024 * 1024):.1f} MB")
+        for line in describe_image(info):
+            self.log(line)
+
+        self.write_mode = self.write_mode or info["write_mode"]
+        if self.write_mode == "file-copy" and info["compression"]:
+            raise OSError("File-copy mode needs random access to the ISO, decompress the image first")
+
+        if self.write_mode == "raw" and not self.delta:
+            self._load_journals()
+
+        # Format the drive if selected. Only file-copy writes need a file
+        # system; a raw write brings the image's own partition table, and
+        # directories and image files are left as they are.
+        if self.format_drive and self.write_mode == "raw":
+            self.log("Raw writes replace the whole drive, formatting skipped")
+        elif self.format_drive:
+            self.start_phase("format", 0, f"Formatting drive with {self.filesystem}...")
+            for target in self.targets:
+                if os.path.isdir(target) or os.path.isfile(target):
+                    self.log(f"{target} is not a drive, formatting skipped")
+                    continue
+                try:
+                    format_for_file_copy(target, self.filesystem, self.cluster_size, log=self.log,
+                                         label=info["label"][:11], partition_table=self.partition_table)
+                except (OSError, FormatError) as e:
+                    self.failed[target] = e
+                    self.log(f"Formatting {target} failed: {e}")
+            # Drives that could not be formatted are not written either
+            kept = [(t, d) for t, d in zip(self.targets, self.drives) if t not in self.failed]
+            self.targets, self.drives = [t for t, _ in kept], [d for _, d in kept]
+            if not self.targets:
+                raise next(iter(self.failed.values()))
+            self.log("Format completed")
+
+        if self.write_mode == "file-copy":
+            self._copy_files()
+        else:
+            self._write_image(iso_size)
+
+        self.succeeded = [path for path in self.requested if path not in self.failed]
+        for path in self.succeeded:
+            if path in self.journals:
+                self.journals[path].discard()
+        if self.delta and self.write_mode != "file-copy":
+            self._save_manifests(self.copier)
+        if not self.succeeded:
+            raise next(iter(self.failed.values()))
+
+        if self.failed:
+            self.progress(100, "Completed with errors", "done")
+            self.log(f"{len(self.succeeded)} of {len(self.requested)} drives created successfully")
+        else:
+            self.progress(100, "Complete!", "done")
+            self.log("Bootable USB created successfully!")
+        return self.succeeded
+
+    def _write_image(self, iso_size):
+        iso = self.iso
+        if self.delta and not self.verify:
+            # A drive's manifest is only matched by its size, another stick
+            # of the same size would pass for it
+            self.log("Delta writes are always verified")
+            self.verify = True
+        # Copy and verify each go over the whole image once
+        work_total = iso_size * (2 if self.verify else 1) or 1
+
+        if self.autotune and not self.delta and not self.resume_offset:
+            self.start_phase("tune", 0, "Tuning block size...")
+            if len(self.targets) > 1:
+                self.log(f"Tuning on {self.targets[0]}, the result is used for all drives")
+            self.chunk_size, self.queue_depth = tuned_parameters(iso, self.targets[0], self.drives[0],
+                                                                 log=self.log)
+
+        # Copy the ISO contents
+        self.start_phase("copy", 0, "Copying ISO to drive...")
+        if self.delta:
+            copier, copied = self._copy_delta(iso_size, work_total)
+        else:
+            copier, copied = self._copy(iso_size, work_total)
+        self.copier = copier
+        if not copied:
+            # Nothing left to verify, each target failed with its own error
+            self.timer.stop()
+            raise next(iter(self.failed.values()))
+        # Exact now, even for compressed images
+        iso_size = copier.total_bytes
+        work_total = iso_size * (2 if self.verify else 1) or 1
+        # Delta writes leave unchanged blocks alone, they are not counted
+        self.timer.bytes["copy"] = copier.bytes_written if self.delta else iso_size - self.resume_offset
+        self.timer.stop()
+
+        if self.verify:
+            self.start_phase("verify", int(100 * iso_size / work_total), "Verifying...")
+            self._verify(copier, copied, iso_size, work_total)
+            self.timer.bytes["verify"] = iso_size
+            self.timer.stop()
+
+    def _load_journals(self):
+        # Finds unfinished writes of this image and how far each got. All
+        # targets are written in one pass, so it continues from the lowest
+        # offset, and only if they all used the same chunk size.
+        offsets = []
+        for path, drive_info in zip(self.targets, self.drives):
+            journal = WriteJournal(target_key(path, drive_info), self.iso, path, self.chunk_size)
+            offset = 0
+            try:
+                if os.path.exists(path) and journal.load():
+                    offset = journal.resume_offset()
+                    self.log(f"{path} holds an interrupted write of this image, "
+                             f"{offset / (1024 * 1024):.0f} MB of it are in place")
+            except OSError as e:
+                self.log(f"Could not check {path} for an interrupted write: {e}")
+            self.journals[path] = journal
+            offsets.append((offset, journal.chunk_size))
+        if min(offsets)[0] and len({chunk for _, chunk in offsets}) == 1:
+            self.resume_offset = min(offsets)[0]
+            self.chunk_size = offsets[0][1]
+
+    def _copy_files(self):
+        # File-copy mode: one FileCopier per target, all running at once
+        copiers = {}
+        for path in self.targets:
+            destination = mount_point_for(path)
+            if destination is None:
+                self.failed[path] = OSError(f"{path} is neither a directory nor a mounted drive, "
+                                            "file-copy mode needs a file system to copy into")
+                self.log(f"Error writing {path}: {self.failed[path]}")
+                continue
+            copiers[path] = FileCopier(self.iso, destination, self.filesystem)
+        if not copiers:
+            return
+        if self.delta or self.autotune or self.skip_zeros:
+            self.log("Delta, autotune and zero skipping only apply to raw writes, ignored for file copy")
+
+        first = next(iter(copiers.values()))
+        total = first.scan()
+        for copier in copiers.values():
+            copier.entries, copier.total_bytes = first.entries, first.total_bytes
+        files = sum(1 for entry in first.entries if not entry["is_dir"])
+        self.log(f"Copying {files} files ({total / (1024 * 1024):.1f} MB) from the {first.image_filesystem} "
+                 f"file system to {len(copiers)} drive(s)")
+        work_total = total * (2 if self.verify else 1) or 1
+
+        self.start_phase("copy", 0, "Copying files...")
+        self._file_phase(copiers, "copy", "Copying files...", 0, work_total,
+                         lambda copier, callback: copier.run(callback))
+        for copier in copiers.values():
+            self.log(f"Copied {copier.files_copied} files to {copier.dest_dir}")
+            for split in copier.split_files:
+                self.log(f"Split {split} into parts, FAT32 cannot hold files over 4 GB")
+
+        if self.verify and copiers:
+            self.start_phase("verify", int(100 * total / work_total), "Verifying...")
+            self._file_phase(copiers, "verify", "Verifying...", total, work_total,
+                             lambda copier, callback: copier.verify(callback))
+            for path in copiers:
+                self.log(f"Verified {total / (1024 * 1024):.1f} MB of files on {path}")
+
+    def _file_phase(self, copiers, phase, status, base, work_total, action):
+        # Runs action(copier, progress_callback) for all targets in parallel.
+        # Targets that fail are logged and dropped from copiers.
+        total = next(iter(copiers.values())).total_bytes
+        done = dict.fromkeys(copiers, 0)
+        meter = ThroughputMeter(total)
+
+        def on_progress(path, count):
+            done[path] = count
+            slowest = min(done.values())
+            meter.update(slowest)
+            self.progress(int(100 * (base + slowest) / work_total), status, phase,
+                          target=path, done=count, total=total, **self._rates(meter))
+
+        with ThreadPoolExecutor(len(copiers)) as pool:
+            results = {path: pool.submit(action, copier, lambda count, _, path=path: on_progress(path, count))
+                       for path, copier in copiers.items()}
+        for path, result in results.items():
+            try:
+                result.result()
+            except Exception as e:
+                self.failed[path] = e
+                copiers.pop(path)
+                done.pop(path)
+                self.log(f"{'Copying files to' if phase == 'copy' else 'Verification of'} {path} failed: {e}")
+        self.timer.bytes[phase] = total
+        self.timer.stop()
+
+    def _copy(self, iso_size, work_total):
+        # Returns the copier and the targets that were written
+        iso = self.iso
+        self.log("Copying ISO contents to drive...")
+
+        # With several drives the overall figures follow the slowest one
+        copy_done = dict.fromkeys(self.targets, 0)
+        meter = ThroughputMeter(iso_size)
+
+        def on_copy_progress(path, done, total):
+            # total is still an estimate for compressed images
+            copy_done[path] = done
+            slowest = min(copy_done.values())
+            meter.total = total
+            meter.update(slowest)
+            self.progress(int(100 * min(1.0, slowest / (total or 1)) * iso_size / work_total), "Copying ISO data...",
+                          "copy", target=path, done=done, total=total, **self._rates(meter))
+
+        def on_sync():
+            self.start_phase("sync", int(100 * iso_size / work_total), "Flushing data to drive...")
+
+        if not self.resume_offset:
+            # Fresh journals, with the chunk size this copy really uses
+            for path, drive_info in zip(self.targets, self.drives):
+                self.journals[path] = WriteJournal(target_key(path, drive_info), iso, path, self.chunk_size)
+
+        if self.resume_offset:
+            self.log(f"Resuming at {self.resume_offset / (1024 * 1024):.0f} MB of the image")
+        writers = None
+        started = time.monotonic()
+        # The kernel can only copy bytes as they are in the file
+        kernel = self.copy_backend != "buffered" and not self.info["compression"] and not self.skip_zeros
+        if kernel and self.copy_backend == "auto" and (len(self.targets) > 1 or self.autotune):
+            kernel = False
+        if kernel:
+            copier = KernelCopier(iso, self.targets, chunk_size=self.chunk_size,
+                                  progress_callback=on_copy_progress, hash_source=self.verify,
+                                  sync_callback=on_sync, start_offset=self.resume_offset,
+                                  checkpoints=self.journals, backend=self.copy_backend,
+                                  cache_friendly=self.cache_friendly)
+            self.log(f"Writing {iso_size / (1024 * 1024):.1f} MB in {copier.chunk_size // 1024} KB chunks "
+                     f"to {len(self.targets)} drive(s), kernel copy")
+            try:
+                writers = copier.run()
+            except ZeroCopyUnsupported as e:
+                if self.copy_backend != "auto":
+                    raise OSError(str(e))
+                self.log(f"Kernel copy not available ({e}), using buffered copy")
+                started = time.monotonic()
+        elif self.copy_backend not in ("auto", "buffered"):
+            self.log(f"{self.copy_backend} cannot decompress or skip zero blocks, using buffered copy")
+        if writers is None:
+            copier = FanOutCopier(iso, self.targets, chunk_size=self.chunk_size, queue_depth=self.queue_depth,
+                                  progress_callback=on_copy_progress,
+                                  skip_zeros=self.skip_zeros,
+                                  hash_source=self.verify, sync_callback=on_sync,
+                                  start_offset=self.resume_offset, checkpoints=self.journals,
+                                  cache_friendly=self.cache_friendly)
+            self.log(f"Writing {iso_size / (1024 * 1024):.1f} MB in {copier.chunk_size // 1024} KB chunks "
+                     f"(queue depth {copier.queue_depth}) to {len(self.targets)} drive(s)")
+            writers = copier.run()
+        backend = getattr(copier, "backend", "buffered")
+        elapsed = max(time.monotonic() - started, 1e-6)
+        for writer in writers:
+            if writer.error:
+                self.failed[writer.path] = writer.error
+                copy_done.pop(writer.path)
+                self.log(f"Error writing {writer.path}: {writer.error}")
+                continue
+            written = writer.bytes_written - self.resume_offset
+            self.rates[writer.path] = written / elapsed
+            self.log(f"Copied {writer.bytes_written / (1024 * 1024):.1f} MB and flushed to {writer.path} "
+                     f"({getattr(writer, 'backend', None) or backend}, "
+                     f"{written / elapsed / (1024 * 1024):.1f} MB/s)")
+            if writer.sparse:
+                self.log(f"Skipped {writer.bytes_skipped / (1024 * 1024):.1f} MB of zero blocks on {writer.path}")
+            elif self.skip_zeros:
+                self.log(f"{writer.path} cannot be zeroed cheaply first, its zero blocks were written too")
+            if writer.flush_latencies:
+                latencies = writer.flush_latencies
+                self.log(f"Flushed {writer.path} in {len(latencies)} windows of {FLUSH_WINDOW // (1024 * 1024)} MB, "
+                         f"waited {1000 * sum(latencies) / len(latencies):.0f} ms on average, "
+                         f"{1000 * max(latencies):.0f} ms at most")
+        if self.cache_friendly:
+            self.log(f"Final flush took {copier.sync_seconds:.2f}s")
+        self.backend_used = backend
+        return copier, list(copy_done)
+
+    def _copy_delta(self, iso_size, work_total):
+        # One DeltaCopier per target, in parallel. A manifest is dropped as
+        # soon as its target is being rewritten, so an interrupted write never
+        # leaves a manifest that claims the old contents.
+        store = ManifestStore()
+        copy_done = dict.fromkeys(self.targets, 0)
+        meter = ThroughputMeter(iso_size)
+        copiers = {}
+
+        for path, drive_info in zip(self.targets, self.drives):
+            key = target_key(path, drive_info)
+            old_hashes = None
+            if os.path.exists(path):
+                old_hashes = store.load(key, path)
+                if old_hashes is None:
+                    self.log(f"No usable manifest for {path}, comparing against its contents")
+            store.discard(key)
+
+            def on_progress(done, total, path=path):
+                copy_done[path] = done
+                slowest = min(copy_done.values())
+                meter.total = total
+                meter.update(slowest)
+                self.progress(int(100 * min(1.0, slowest / (total or 1)) * iso_size / work_total),
+                              "Writing changed blocks...",
+                              "copy", target=path, done=done, total=total, **self._rates(meter))
+
+            copiers[path] = DeltaCopier(self.iso, path, old_hashes, progress_callback=on_progress)
+
+        self.log(f"Writing changed {copiers[self.targets[0]].chunk_size // 1024} KB blocks "
+                 f"to {len(self.targets)} drive(s)")
+        with ThreadPoolExecutor(len(self.targets)) as pool:
+            results = {path: pool.submit(copier.run) for path, copier in copiers.items()}
+        for path, result in results.items():
+            try:
+                result.result()
+            except OSError as e:
+                self.failed[path] = e
+                copy_done.pop(path)
+                self.log(f"Error writing {path}: {e}")
+                continue
+            copier = copiers[path]
+            self.log(f"Rewrote {copier.bytes_written / (1024 * 1024):.1f} MB, "
+                     f"{copier.bytes_unchanged / (1024 * 1024):.1f} MB unchanged on {path}")
+        # Every copier hashed the same source, any complete one can feed verification
+        complete = [copiers[path] for path in copy_done] or [copiers[self.targets[0]]]
+        return complete[0], list(copy_done)
+
+    def _save_manifests(self, copier):
+        store = ManifestStore()
+        for path, drive_info in zip(self.targets, self.drives):
+            if path in self.succeeded:
+                store.save(target_key(path, drive_info), path, self.iso, copier.source_digests,
+                           copier.chunk_size)
+
+    def _rates(self, meter):
+        return {"bytes_done": meter.done, "bytes_total": meter.total, "rate": meter.rate, "eta": meter.eta}
+
+    def _verify(self, copier, targets, iso_size, work_total):
+        verify_done = dict.fromkeys(targets, 0)
+        meter = ThroughputMeter(iso_size)
+
+        def on_verify_progress(path, done, total):
+            verify_done[path] = done
+            slowest = min(verify_done.values())
+            meter.update(slowest)
+            self.progress(int(100 * (iso_size + slowest) / work_total), "Verifying...",
+                          "verify", target=path, done=done, total=total, **self._rates(meter))
+
+        def verify_drive(path):
+            verifier = TargetVerifier(self.iso, path, copier.source_digests, chunk_size=copier.chunk_size,
+                                      progress_callback=lambda done, total: on_verify_progress(path, done, total),
+                                      total_bytes=iso_size)
+            return verifier.run()
+
+        self.log("Verifying data written to drive...")
+        with ThreadPoolExecutor(len(targets)) as pool:
+            results = {path: pool.submit(verify_drive, path) for path in targets}
+        for path, result in results.items():
+            try:
+                verified = result.result()
+            except Exception as e:
+                self.failed[path] = e
+                # Wrong data somewhere, a retry has to start over
+                if path in self.journals:
+                    self.journals[path].discard()
+                if isinstance(e, VerificationError):
+                    self.log(f"Verification of {path} failed at byte offset {e.offset}")
+                else:
+                    self.log(f"Verification of {path} failed: {e}")
+                continue
+            self.log(f"Verified {verified / (1024 * 1024):.1f} MB on {path}")
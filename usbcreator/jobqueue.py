@@ -0,0 +1,359 @@
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+from usbcreator.autotune import drive_key
+from usbcreator.job import ImagingJob
+from usbcreator.paths import save_json, state_dir
+
+# One write per root hub keeps a shared USB 2.0 bus from being split
+# between sticks that would each saturate it alone
+DEFAULT_MAX_PER_BUS = 1
+DEFAULT_MAX_JOBS = 4
+# ImagingJob keyword arguments a queued job may carry
+JOB_OPTIONS = ("format_drive", "filesystem", "cluster_size", "skip_zeros", "verify", "autotune",
+               "chunk_size", "queue_depth", "delta", "write_mode", "partition_table",
+               "copy_backend", "cache_friendly")
+
+
+def process_alive(pid):
+    # Whether the process with this pid is still running; when in doubt it
+    # is, so a job is never written twice
+    if not pid:
+        return False
+    if sys.platform == 'win32':
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        # PROCESS_QUERY_LIMITED_INFORMATION
+        handle = kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        try:
+            code = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+                return True
+            # STILL_ACTIVE
+            return code.value == 259
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class FileLock:
+    # Exclusive lock between processes on path + ".lock" while in the with
+    # block (flock, where there is one)
+    def __init__(self, path):
+        self.path = path + ".lock"
+        self.fd = None
+
+    def __enter__(self):
+        try:
+            import fcntl
+        except ImportError:
+            return self
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        return False
+
+
+class JobQueue:
+    # Imaging jobs, one (image, target, options) each, kept in
+    # ~/.usbcreator/jobs.json so pending work survives a restart. Jobs go
+    # pending -> running -> done/failed. A running job carries the pid of
+    # the process writing it (owner); one found "running" on load whose
+    # owner is gone was interrupted and is pending again.
+    #
+    # Several processes (the GUI, CLI runs) may share the file: saving
+    # keeps the jobs other processes added, and claim() takes a job for
+    # this process only if no other one has taken it since.
+    def __init__(self, path=None):
+        self.path = path or os.path.join(state_dir(), "jobs.json")
+        self._lock = threading.Lock()
+        self._removed = set()
+        with self._lock, FileLock(self.path):
+            self._jobs = self._read()
+            recovered = False
+            for job in self._jobs:
+                if job["state"] == "running" and not process_alive(job.get("owner")):
+                    job.update(state="pending", resumed=True, owner=None)
+                    recovered = True
+            if recovered:
+                save_json(self.path, self._jobs, indent=2)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                jobs = json.load(f)
+        except (OSError, ValueError):
+            return []
+        return jobs if isinstance(jobs, list) else []
+
+    def _merged(self, on_disk):
+        # Jobs other processes added since are kept, ours are saved as this
+        # process has them
+        known = {job["id"] for job in self._jobs} | self._removed
+        return [job for job in on_disk if job["id"] not in known] + self._jobs
+
+    def _save(self):
+        # Call with self._lock held
+        with FileLock(self.path):
+            save_json(self.path, self._merged(self._read()), indent=2)
+
+    def claim(self, job_id):
+        # Marks a pending job as running in this process; False when another
+        # process has run or is running it since this queue was loaded
+        with self._lock, FileLock(self.path):
+            on_disk = {job["id"]: job for job in self._read()}
+            for job in self._jobs:
+                if job["id"] != job_id:
+                    continue
+                current = on_disk.get(job_id)
+                if current and current["state"] != "pending":
+                    job.update(current)
+                    return False
+                job.update(state="running", owner=os.getpid())
+                save_json(self.path, self._merged(on_disk.values()), indent=2)
+                return True
+            return False
+
+    def add(self, image, target, options=None, drive_info=None):
+        # drive_info, when known, pins the job to that drive: a different
+        # stick showing up under the same path later is not overwritten
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "image": image,
+            "target": target,
+            "options": {k: v for k, v in (options or {}).items() if k in JOB_OPTIONS},
+            "drive_key": drive_key(drive_info),
+            "state": "pending",
+            "error": None,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "finished": None,
+        }
+        with self._lock:
+            self._jobs.append(job)
+            self._save()
+        return dict(job)
+
+    def jobs(self, state=None):
+        with self._lock:
+            return [dict(job) for job in self._jobs if state is None or job["state"] == state]
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            for job in self._jobs:
+                if job["id"] == job_id:
+                    job.update(fields)
+            self._save()
+
+    def clear_finished(self):
+        with self._lock:
+            self._removed.update(job["id"] for job in self._jobs if job["state"] not in ("pending", "running"))
+            self._jobs = [job for job in self._jobs if job["state"] in ("pending", "running")]
+            self._save()
+
+
+def run_queued_jobs(jobs, drive_infos=None, on_event=None):
+    # Runs queued jobs for the same image with the same options as one
+    # ImagingJob, so the image is read once for all of their targets.
+    # Returns {job id: exception} for the jobs that failed. A job queued for
+    # a drive only runs on that same drive (model and serial), device names
+    # get reused when sticks are swapped.
+    failed = {}
+    runnable = []
+    for job, drive_info in zip(jobs, drive_infos or [None] * len(jobs)):
+        if job.get("drive_key"):
+            if drive_info is None:
+                failed[job["id"]] = OSError(f"No drive found at {job['target']}")
+                continue
+            if drive_key(drive_info) != job["drive_key"]:
+                failed[job["id"]] = OSError(f"The drive at {job['target']} is not the one this job was queued for")
+                continue
+        runnable.append((job, drive_info))
+    if not runnable:
+        return failed
+
+    first = runnable[0][0]
+    imaging = ImagingJob(first["image"], [job["target"] for job, _ in runnable], on_event=on_event,
+                         drives=[drive_info for _, drive_info in runnable], **first["options"])
+    try:
+        imaging.run()
+    except Exception as e:
+        # Targets that did not fail on their own failed with the job
+        for job, _ in runnable:
+            failed[job["id"]] = imaging.failed.get(job["target"], e)
+        return failed
+    for job, _ in runnable:
+        if job["target"] in imaging.failed:
+            failed[job["id"]] = imaging.failed[job["target"]]
+    return failed
+
+
+class Scheduler:
+    # Runs pending jobs from a JobQueue on worker threads. Pending jobs for
+    # the same image with the same options are run together as one batch,
+    # so the image is read once and fanned out to all of their drives. At
+    # most max_jobs batches run at once, and at most max_per_bus drives are
+    # written on any one USB root hub, so one batch may span several buses
+    # while the other drives of a bus wait for the next one. bus_of(job)
+    # returns the bus key (drive_info["bus"]) or None for image files and
+    # drives we cannot place, which only count against max_jobs.
+    #
+    # job_ids, when given, limits the scheduler to those jobs; other
+    # pending jobs in the queue are left alone.
+    #
+    # runner(jobs) writes a batch and returns {job id: exception} for the
+    # jobs that failed; raising fails all of them. on_finish(job) and
+    # on_idle() are called on the worker threads.
+    def __init__(self, jobs, runner, bus_of=None, max_per_bus=DEFAULT_MAX_PER_BUS,
+                 max_jobs=DEFAULT_MAX_JOBS, on_finish=None, on_idle=None, job_ids=None):
+        self.jobs = jobs
+        self.runner = runner
+        self.bus_of = bus_of or (lambda job: None)
+        self.max_per_bus = max(1, max_per_bus)
+        self.max_jobs = max(1, max_jobs)
+        self.on_finish = on_finish
+        self.on_idle = on_idle
+        self.job_ids = set(job_ids) if job_ids is not None else None
+        self._running = {}
+        self._batches = 0
+        self._wakeup = threading.Condition()
+        self._stop = False
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop = False
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wake(self):
+        # Call after adding jobs
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def stop(self):
+        # Running jobs finish, nothing new is started
+        with self._wakeup:
+            self._stop = True
+            self._wakeup.notify()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def busy(self):
+        with self._wakeup:
+            return bool(self._running)
+
+    def run_until_idle(self):
+        # Blocking variant for the CLI: runs everything pending, then returns
+        done = threading.Event()
+        on_idle = self.on_idle
+
+        def idle():
+            if on_idle:
+                on_idle()
+            done.set()
+
+        self.on_idle = idle
+        if not self._pending() and not self.busy():
+            done.set()
+        self.start()
+        done.wait()
+        self.stop()
+        self.on_idle = on_idle
+
+    def _pending(self):
+        return [job for job in self.jobs.jobs("pending") if self.job_ids is None or job["id"] in self.job_ids]
+
+    def _runnable(self):
+        # New batches, each a list of (job, bus); running holds (job, bus)
+        # for every job already writing or picked here
+        running = list(self._running.values())
+        pending = self._pending()
+        taken = set()
+        batches = []
+        for job in pending:
+            if self._batches + len(batches) >= self.max_jobs:
+                break
+            if job["id"] in taken:
+                continue
+            batch = []
+            for other in pending:
+                if other["id"] in taken or (other["image"], other["options"]) != (job["image"], job["options"]):
+                    continue
+                # Two jobs for the same target run one after the other
+                if any(o["target"] == other["target"] for o, _ in running):
+                    continue
+                bus = self.bus_of(other)
+                if bus is not None and [b for _, b in running].count(bus) >= self.max_per_bus:
+                    continue
+                batch.append((other, bus))
+                running.append((other, bus))
+                taken.add(other["id"])
+            if batch:
+                batches.append(batch)
+        return batches
+
+    def _loop(self):
+        with self._wakeup:
+            while not self._stop:
+                lost = False
+                for batch in self._runnable():
+                    # Another process may have taken some of them meanwhile
+                    claimed = [(job, bus) for job, bus in batch if self.jobs.claim(job["id"])]
+                    lost = lost or len(claimed) < len(batch)
+                    batch = claimed
+                    if not batch:
+                        continue
+                    self._batches += 1
+                    for job, bus in batch:
+                        self._running[job["id"]] = (job, bus)
+                    worker = threading.Thread(target=self._run, args=([job for job, _ in batch],))
+                    worker.daemon = True
+                    worker.start()
+                # Nothing left to wait for when the rest went to other processes
+                if lost and not self._running and not self._pending() and self.on_idle:
+                    self.on_idle()
+                self._wakeup.wait()
+
+    def _run(self, batch):
+        try:
+            failed = self.runner(batch) or {}
+        except Exception as e:
+            failed = {job["id"]: e for job in batch}
+        finished = time.strftime("%Y-%m-%dT%H:%M:%S")
+        for job in batch:
+            if job["id"] in failed:
+                job.update(state="failed", error=str(failed[job["id"]]))
+            else:
+                job.update(state="done", error=None)
+            job["finished"] = finished
+            self.jobs.update(job["id"], state=job["state"], error=job["error"], finished=job["finished"])
+            if self.on_finish:
+                self.on_finish(job)
+        with self._wakeup:
+            for job in batch:
+                self._running.pop(job["id"], None)
+            self._batches -= 1
+            idle = not self._running and not self._pending()
+            self._wakeup.notify()
+        if idle and self.on_idle:
+            self.on_idle()
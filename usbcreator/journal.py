@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import time
+
+from usbcreator.engine import chunk_digest, drop_cached_pages, read_full
+from usbcreator.paths import state_dir
+
+# A checkpoint (fsync plus journal update) every 64 MiB costs a few
+# percent on a USB stick and limits the rework after a crash to that much
+CHECKPOINT_BYTES = 64 * 1024 * 1024
+# Segments read back from the target before a write is resumed; what was
+# fsync'd earlier is trusted
+VERIFY_SEGMENTS = 2
+
+
+def image_stamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+class WriteJournal:
+    # Progress of one raw write of image to a target, kept in
+    # ~/.usbcreator/journals so an interrupted write can continue where it
+    # stopped. After every segment_bytes the target is fsync'd and the
+    # journal records the committed offset and the hash of that segment.
+    #
+    # key identifies the target like delta manifests do (drive model and
+    # serial, or the image file path). The journal is only used again for
+    # the same image (path, size, mtime); the resumed write then has to use
+    # the chunk_size of the journal.
+    def __init__(self, key, image, target, chunk_size, directory=None):
+        self.key = key
+        self.image = os.path.realpath(image)
+        self.target = target
+        self.chunk_size = chunk_size
+        # Checkpoints fall on chunk boundaries, writers see whole chunks
+        self.segment_bytes = chunk_size * max(1, CHECKPOINT_BYTES // chunk_size)
+        self.committed = 0
+        self.segments = []
+        self.directory = directory or state_dir("journals")
+        self.path = os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    def load(self):
+        # True if there is a journal of an earlier, unfinished write of the
+        # same image to this target
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            if saved["image"] != self.image or saved["image_stamp"] != image_stamp(self.image):
+                return False
+            # A resumed write keeps the chunk size it was started with
+            self.chunk_size = saved["chunk_size"]
+            self.segment_bytes = saved["segment_bytes"]
+            self.segments = [bytes.fromhex(h) for h in saved["segments"]]
+            self.committed = len(self.segments) * self.segment_bytes
+        except (OSError, ValueError, KeyError):
+            return False
+        return self.committed > 0
+
+    def resume_offset(self):
+        # Reads the last VERIFY_SEGMENTS committed segments back from the
+        # target and returns the offset to continue from: the end of the
+        # journal, or the first segment that no longer matches
+        buf = bytearray(self.segment_bytes)
+        first = max(0, len(self.segments) - VERIFY_SEGMENTS)
+        with open(self.target, 'rb', buffering=0) as tgt:
+            drop_cached_pages(tgt.fileno())
+            for index in range(first, len(self.segments)):
+                tgt.seek(index * self.segment_bytes)
+                view = memoryview(buf)
+                if read_full(tgt, view) < len(view) or chunk_digest(view) != self.segments[index]:
+                    del self.segments[index:]
+                    break
+        self.committed = len(self.segments) * self.segment_bytes
+        return self.committed
+
+    def start(self, offset=0):
+        # Called before writing from offset; drops segments past it
+        del self.segments[offset // self.segment_bytes:]
+        self.committed = len(self.segments) * self.segment_bytes
+        self._save()
+
+    def commit(self, offset, digest):
+        # The target has been fsync'd up to offset
+        if offset != (len(self.segments) + 1) * self.segment_bytes:
+            return
+        self.segments.append(digest)
+        self.committed = offset
+        self._save()
+
+    def _save(self):
+        journal = {
+            "key": self.key,
+            "image": self.image,
+            "image_stamp": image_stamp(self.image),
+            "target": self.target,
+            "chunk_size": self.chunk_size,
+            "segment_bytes": self.segment_bytes,
+            "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "segments": [h.hex() for h in self.segments],
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(journal, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
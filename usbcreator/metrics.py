@@ -0,0 +1,324 @@
+import atexit
+import cProfile
+import json
+import os
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from usbcreator.paths import state_dir
+
+DEFAULT_METRICS_PORT = 9464
+# How often the metrics file is rewritten
+DEFAULT_FILE_INTERVAL = 15.0
+
+PHASE_SECONDS_BUCKETS = (0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+RATE_MBPS_BUCKETS = (1, 2, 5, 10, 20, 40, 80, 160, 320, 640, 1280)
+PROBE_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    # One metric family; samples are kept per label set (a sorted tuple of
+    # (name, value) pairs). The registry lock guards all of them.
+    kind = "untyped"
+
+    def __init__(self, registry, name, help_text):
+        self.registry = registry
+        self.name = name
+        self.help = help_text
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(sorted(dict(self.registry.const_labels, **labels).items()))
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, help_text, buckets):
+        super().__init__(registry, name, help_text)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        for key, (counts, total) in self.values.items():
+            for bound, count in zip(self.buckets, counts):
+                samples.append((self.name + "_bucket", key + (("le", _format_value(bound)),), count))
+            samples.append((self.name + "_sum", key, total))
+            samples.append((self.name + "_count", key, counts[-1]))
+        return samples
+
+
+class Registry:
+    # Metric families rendered in the Prometheus text format. const_labels
+    # go on every sample; host is there so files collected from several
+    # imaging stations can be told apart.
+    def __init__(self, const_labels=None):
+        self.const_labels = const_labels if const_labels is not None else {"host": socket.gethostname()}
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def counter(self, name, help_text):
+        return self._add(Counter(self, name, help_text))
+
+    def gauge(self, name, help_text):
+        return self._add(Gauge(self, name, help_text))
+
+    def histogram(self, name, help_text, buckets):
+        return self._add(Histogram(self, name, help_text, buckets))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for metric in self.metrics:
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                for name, key, value in metric.samples():
+                    lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def media_label(path, drive_info=None):
+    # What kind of media a target is, for labels: "Vendor Model" of a
+    # drive, "file" for image files and directories
+    if drive_info and (drive_info.get("vendor") or drive_info.get("model")):
+        return f"{drive_info.get('vendor', '')} {drive_info.get('model', '')}".strip()
+    if os.path.isfile(path) or os.path.isdir(path):
+        return "file"
+    return None
+
+
+class ImagingMetrics:
+    # The metrics of imaging jobs and drive discovery. observe() takes job
+    # events as they are and picks out the "timing" summary each job ends
+    # with; media labels a target (drive model, "file" for image files) so
+    # slow media stands out across the fleet.
+    def __init__(self, registry=None):
+        self.registry = registry or Registry()
+        r = self.registry
+        self.phase_seconds = r.histogram("usbcreator_phase_seconds", "Time spent in each job phase",
+                                         PHASE_SECONDS_BUCKETS)
+        self.bytes = r.counter("usbcreator_bytes_total", "Bytes copied and verified, by phase")
+        self.write_rate = r.histogram("usbcreator_write_rate_mbps", "Copy throughput per target in MB/s",
+                                      RATE_MBPS_BUCKETS)
+        self.targets = r.counter("usbcreator_targets_total", "Targets written, by outcome")
+        self.failures = r.counter("usbcreator_failures_total", "Failed targets, by the last phase their job reached")
+        self.retries = r.counter("usbcreator_retries_total", "Interrupted writes resumed from a checkpoint")
+        self.probe_seconds = r.histogram("usbcreator_drive_probe_seconds", "Time to probe one device",
+                                         PROBE_SECONDS_BUCKETS)
+        self.probe_timeouts = r.counter("usbcreator_drive_probe_timeouts_total",
+                                        "Devices that did not answer the probe in time")
+        self.scan_seconds = r.histogram("usbcreator_drive_scan_seconds", "Time to list and probe all devices",
+                                        PROBE_SECONDS_BUCKETS)
+        self.drives = r.gauge("usbcreator_drives_detected", "Removable drives found by the last scan")
+
+    def observe(self, event, media=None):
+        # media(path) -> label, or None for "unknown"
+        if event.get("event") != "timing":
+            return
+        media = media or (lambda path: None)
+        for phase, seconds in event.get("phases", {}).items():
+            self.phase_seconds.observe(seconds, phase=phase)
+        for phase, count in event.get("bytes", {}).items():
+            self.bytes.inc(count, phase=phase)
+        backend = event.get("backend") or "none"
+        for path, rate in event.get("rates", {}).items():
+            self.write_rate.observe(rate / (1024 * 1024), backend=backend, media=media(path) or "unknown")
+        for path in event.get("succeeded", []):
+            self.targets.inc(outcome="succeeded", media=media(path) or "unknown")
+        for path in event.get("failed", []):
+            self.targets.inc(outcome="failed", media=media(path) or "unknown")
+            self.failures.inc(phase=event.get("failed_phase") or "unknown")
+        if event.get("resumed"):
+            self.retries.inc()
+
+    def observe_scan(self, prober):
+        # A finished DriveProber
+        for seconds in prober.probe_seconds.values():
+            self.probe_seconds.observe(seconds)
+        if prober.stragglers:
+            self.probe_timeouts.inc(len(prober.stragglers))
+        self.scan_seconds.observe(prober.elapsed)
+        self.drives.set(len([d for d in prober.drives if not d.get("simulated")]))
+
+
+class MetricsServer:
+    # Serves registry.render() at http://host:port/metrics on a daemon
+    # thread; localhost only unless told otherwise
+    def __init__(self, registry, port=DEFAULT_METRICS_PORT, host="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsFile:
+    # Rewrites path with registry.render() every interval seconds and on
+    # close() (at exit at the latest), atomically, e.g. for node_exporter's
+    # textfile collector
+    def __init__(self, registry, path, interval=DEFAULT_FILE_INTERVAL):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.registry.render())
+        os.replace(tmp_path, self.path)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    def close(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        atexit.unregister(self.close)
+        try:
+            self.write()
+        except OSError:
+            pass
+
+
+class JobTrace:
+    # Optional per-job capture in ~/.usbcreator/profiles: the phases of the
+    # job as trace spans (Chrome trace event JSON, opens in Perfetto or
+    # chrome://tracing) and a cProfile of the thread running the job. The
+    # copy and verify worker threads are not in the profile, their time
+    # shows up in the spans.
+    #
+    # Use as a context manager around the job and feed it the job events.
+    def __init__(self, name, directory=None, profile=True):
+        self.name = re.sub(r"[^A-Za-z0-9_.-]+", "_", name).strip("_") or "job"
+        self.directory = directory or state_dir("profiles")
+        self.profiler = cProfile.Profile() if profile else None
+        self.spans = []
+        self._phase = None
+        self._started = None
+        self._lock = threading.Lock()
+
+    def observe(self, event):
+        phase = event.get("phase")
+        if event.get("event") != "progress" or not phase or phase == self._phase:
+            return
+        with self._lock:
+            self._close_span()
+            # "done" ends the last phase, it is not one itself
+            self._phase = phase if phase != "done" else None
+            self._started = time.time()
+
+    def _close_span(self):
+        if self._phase:
+            self.spans.append({"name": self._phase, "ph": "X", "pid": os.getpid(), "tid": self.name,
+                               "ts": int(self._started * 1e6),
+                               "dur": int((time.time() - self._started) * 1e6)})
+
+    def __enter__(self):
+        if self.profiler:
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # Python 3.12+ allows one profiler at a time, another job has it
+                self.profiler = None
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiler:
+            self.profiler.disable()
+        with self._lock:
+            self._close_span()
+            self._phase = None
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        base = os.path.join(self.directory, f"{stamp}-{self.name}")
+        try:
+            if self.profiler:
+                self.profiler.dump_stats(base + ".prof")
+            with open(base + ".trace.json", "w") as f:
+                json.dump({"traceEvents": self.spans, "displayTimeUnit": "ms"}, f)
+        except OSError:
+            pass
+        return False
@@ -0,0 +1,329 @@
+import os
+import struct
+import time
+import uuid
+import zlib
+
+SECTOR_SIZE = 512
+# Partitions start at 1 MiB, aligned for every flash erase block size in use
+PARTITION_START = 1024 * 1024
+GPT_ENTRIES = 128
+GPT_ENTRY_SIZE = 128
+# Microsoft basic data partition, as stored on disk
+BASIC_DATA_GUID = uuid.UUID("ebd0a0a2-b9e5-4433-87c0-68b6b72699c7").bytes_le
+MBR_TYPES = {"FAT32": 0x0C, "exFAT": 0x07}
+
+CLUSTER_SIZES = {"4K": 4096, "8K": 8192, "16K": 16384, "32K": 32768, "64K": 65536}
+FAT32_MIN_CLUSTERS = 65525
+FAT32_MAX_CLUSTERS = 0x0FFFFFF5
+FAT32_RESERVED_SECTORS = 32
+EXFAT_FAT_OFFSET = 128
+# Boot code for volumes that are not meant to boot: prints nothing, halts
+NO_BOOT_CODE = b"\xfa\xf4\xeb\xfd"
+
+
+class FormatError(Exception):
+    pass
+
+
+def format_cluster_size(cluster_size):
+    # 512 B, 4 KB, 64 KB
+    if cluster_size < 1024:
+        return f"{cluster_size} B"
+    return f"{cluster_size // 1024} KB"
+
+
+def default_cluster_size(filesystem, volume_bytes):
+    # What Windows picks for these volume sizes. FAT32 starts at 512 byte
+    # clusters below 64 MB; should the table's size still leave too few
+    # clusters, the largest size that leaves enough is used instead.
+    if filesystem == "exFAT":
+        if volume_bytes <= 256 * 1024 ** 2:
+            return 4096
+        return 32768 if volume_bytes <= 32 * 1024 ** 3 else 131072
+    size = 32768
+    for limit, table_size in ((64 * 1024 ** 2, 512), (128 * 1024 ** 2, 1024), (256 * 1024 ** 2, 2048),
+                              (8 * 1024 ** 3, 4096), (16 * 1024 ** 3, 8192), (32 * 1024 ** 3, 16384)):
+        if volume_bytes <= limit:
+            size = table_size
+            break
+    while size > SECTOR_SIZE and fat32_layout(volume_bytes, size)[1] < FAT32_MIN_CLUSTERS:
+        size //= 2
+    return size
+
+
+def fat32_layout(length, cluster_size):
+    # (sectors per FAT, data clusters) of a FAT32 volume of length bytes
+    sectors = length // SECTOR_SIZE
+    per_cluster = cluster_size // SECTOR_SIZE
+    # Microsoft's FAT size formula (fatgen103), slightly generous
+    fat_sectors = -(-(sectors - FAT32_RESERVED_SECTORS) // ((256 * per_cluster + 2) // 2))
+    return fat_sectors, (sectors - FAT32_RESERVED_SECTORS - 2 * fat_sectors) // per_cluster
+
+
+def device_size(fd):
+    # Works for image files and block devices alike
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def zero_fill(fd, offset, length, chunk=1024 * 1024):
+    zeros = bytes(min(chunk, length))
+    while length:
+        count = min(length, len(zeros))
+        pwrite_all(fd, zeros[:count], offset)
+        offset += count
+        length -= count
+
+
+def _chs(lba):
+    # Partition entries still carry CHS addresses; past 8 GB they saturate
+    cylinder, rest = divmod(lba, 255 * 63)
+    if cylinder > 1023:
+        return b"\xfe\xff\xff"
+    head, sector = divmod(rest, 63)
+    return bytes((head, (sector + 1) | (cylinder >> 8) << 6, cylinder & 0xFF))
+
+
+def _mbr(entries, disk_signature):
+    # entries: (type, first lba, sectors, active)
+    mbr = bytearray(SECTOR_SIZE)
+    mbr[:len(NO_BOOT_CODE)] = NO_BOOT_CODE
+    struct.pack_into("<I", mbr, 440, disk_signature)
+    for i, (ptype, start, sectors, active) in enumerate(entries):
+        entry = bytearray(16)
+        entry[0] = 0x80 if active else 0
+        entry[1:4] = _chs(start)
+        entry[4] = ptype
+        entry[5:8] = _chs(start + sectors - 1)
+        struct.pack_into("<II", entry, 8, start, min(sectors, 0xFFFFFFFF))
+        mbr[446 + 16 * i:462 + 16 * i] = entry
+    mbr[510:512] = b"\x55\xaa"
+    return mbr
+
+
+def write_partition_table(fd, disk_bytes, start, length, filesystem, scheme="mbr"):
+    # One partition covering start..start+length, MBR or GPT
+    disk_sectors = disk_bytes // SECTOR_SIZE
+    first, sectors = start // SECTOR_SIZE, length // SECTOR_SIZE
+    signature = struct.unpack("<I", os.urandom(4))[0]
+    # Clear what is left of older tables and boot sectors
+    zero_fill(fd, 0, start)
+    if scheme == "mbr":
+        # An old backup GPT header and table in the last sectors would make
+        # tools offer to "restore" the GPT over the new MBR
+        backup_bytes = (1 + GPT_ENTRIES * GPT_ENTRY_SIZE // SECTOR_SIZE) * SECTOR_SIZE
+        if disk_bytes - backup_bytes >= start:
+            zero_fill(fd, disk_bytes - backup_bytes, backup_bytes)
+        pwrite_all(fd, _mbr([(MBR_TYPES[filesystem], first, sectors, True)], signature), 0)
+        return
+
+    entries = bytearray(GPT_ENTRIES * GPT_ENTRY_SIZE)
+    entries[0:16] = BASIC_DATA_GUID
+    entries[16:32] = uuid.uuid4().bytes_le
+    struct.pack_into("<QQQ", entries, 32, first, first + sectors - 1, 0)
+    entries[56:56 + 72] = "Bootable USB".encode("utf-16-le").ljust(72, b"\x00")
+    entry_sectors = len(entries) // SECTOR_SIZE
+    disk_guid = uuid.uuid4().bytes_le
+
+    def header(current, backup, entries_lba):
+        h = bytearray(SECTOR_SIZE)
+        struct.pack_into("<8sIII", h, 0, b"EFI PART", 0x00010000, 92, 0)
+        struct.pack_into("<QQQQ", h, 24, current, backup, 2 + entry_sectors, disk_sectors - 2 - entry_sectors)
+        h[56:72] = disk_guid
+        struct.pack_into("<QIII", h, 72, entries_lba, GPT_ENTRIES, GPT_ENTRY_SIZE, zlib.crc32(entries))
+        struct.pack_into("<I", h, 16, zlib.crc32(h[:92]))
+        return h
+
+    backup_entries = disk_sectors - 1 - entry_sectors
+    pwrite_all(fd, _mbr([(0xEE, 1, disk_sectors - 1, False)], 0), 0)
+    pwrite_all(fd, header(1, disk_sectors - 1, 2), SECTOR_SIZE)
+    pwrite_all(fd, entries, 2 * SECTOR_SIZE)
+    pwrite_all(fd, entries, backup_entries * SECTOR_SIZE)
+    pwrite_all(fd, header(disk_sectors - 1, 1, backup_entries), (disk_sectors - 1) * SECTOR_SIZE)
+
+
+def _label(label, length=11):
+    return (label.upper().encode("ascii", "replace")[:length] or b"NO NAME").ljust(length, b" ")
+
+
+def write_fat32(fd, offset, length, cluster_size, label=""):
+    # Boot sector, FSInfo, their backups, both FATs and the root directory
+    # cluster; the data area is left alone
+    sectors = length // SECTOR_SIZE
+    per_cluster = cluster_size // SECTOR_SIZE
+    reserved = FAT32_RESERVED_SECTORS
+    fat_sectors, clusters = fat32_layout(length, cluster_size)
+    if clusters < FAT32_MIN_CLUSTERS:
+        raise FormatError(f"{length / 1024 ** 2:.0f} MB is too small for FAT32 with {format_cluster_size(cluster_size)} "
+                          f"clusters (needs {FAT32_MIN_CLUSTERS}), pick a smaller cluster size or exFAT")
+    if clusters >= FAT32_MAX_CLUSTERS:
+        raise FormatError("Too many clusters for FAT32, pick a larger cluster size")
+
+    boot = bytearray(SECTOR_SIZE)
+    boot[0:3] = b"\xeb\x58\x90"
+    boot[3:11] = b"MSWIN4.1"
+    struct.pack_into("<HBHBHHBHHHII", boot, 11, SECTOR_SIZE, per_cluster, reserved, 2, 0, 0, 0xF8, 0,
+                     63, 255, offset // SECTOR_SIZE, sectors)
+    struct.pack_into("<IHHIHH", boot, 36, fat_sectors, 0, 0, 2, 1, 6)
+    struct.pack_into("<BBBI", boot, 64, 0x80, 0, 0x29, struct.unpack("<I", os.urandom(4))[0])
+    boot[71:82] = _label(label)
+    boot[82:90] = b"FAT32   "
+    boot[90:90 + len(NO_BOOT_CODE)] = NO_BOOT_CODE
+    boot[510:512] = b"\x55\xaa"
+
+    fsinfo = bytearray(SECTOR_SIZE)
+    struct.pack_into("<I", fsinfo, 0, 0x41615252)
+    # One cluster is taken by the root directory
+    struct.pack_into("<III", fsinfo, 484, 0x61417272, clusters - 1, 3)
+    struct.pack_into("<I", fsinfo, 508, 0xAA550000)
+    third = bytearray(SECTOR_SIZE)
+    third[510:512] = b"\x55\xaa"
+
+    zero_fill(fd, offset, reserved * SECTOR_SIZE)
+    for base in (0, 6):
+        pwrite_all(fd, boot + fsinfo + third, offset + base * SECTOR_SIZE)
+
+    fat_start = offset + reserved * SECTOR_SIZE
+    fat_head = struct.pack("<III", 0x0FFFFFF8, 0x0FFFFFFF, 0x0FFFFFFF)
+    for copy in range(2):
+        start = fat_start + copy * fat_sectors * SECTOR_SIZE
+        zero_fill(fd, start, fat_sectors * SECTOR_SIZE)
+        pwrite_all(fd, fat_head, start)
+
+    root = bytearray(cluster_size)
+    if label:
+        root[0:11] = _label(label)
+        root[11] = 0x08
+        _, date, stamp = _fat_timestamp()
+        struct.pack_into("<HH", root, 22, stamp, date)
+    pwrite_all(fd, root, fat_start + 2 * fat_sectors * SECTOR_SIZE)
+    return {"clusters": clusters, "cluster_size": cluster_size, "fat_sectors": fat_sectors}
+
+
+def _fat_timestamp():
+    t = time.localtime()
+    date = (max(t.tm_year - 1980, 0) << 9) | (t.tm_mon << 5) | t.tm_mday
+    stamp = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return t, date, stamp
+
+
+def _exfat_checksum(data, checksum=0, skip=()):
+    for i, byte in enumerate(data):
+        if i in skip:
+            continue
+        checksum = ((checksum >> 1) | ((checksum & 1) << 31)) + byte & 0xFFFFFFFF
+    return checksum
+
+
+def _upcase_table():
+    # Uncompressed up-case table for the whole BMP
+    table = bytearray(2 * 65536)
+    for code in range(65536):
+        upper = chr(code).upper()
+        struct.pack_into("<H", table, 2 * code, ord(upper) if len(upper) == 1 and ord(upper) < 65536 else code)
+    return table
+
+
+def write_exfat(fd, offset, length, cluster_size, label=""):
+    # Main and backup boot regions, the FAT, and the allocation bitmap,
+    # up-case table and root directory clusters
+    sectors = length // SECTOR_SIZE
+    per_cluster = cluster_size // SECTOR_SIZE
+    fat_offset = EXFAT_FAT_OFFSET
+    clusters = (sectors - fat_offset) // per_cluster
+    while True:
+        fat_sectors = -(-(clusters + 2) * 4 // SECTOR_SIZE)
+        heap_offset = -(-(fat_offset + fat_sectors) // per_cluster) * per_cluster
+        fitting = (sectors - heap_offset) // per_cluster
+        if fitting >= clusters:
+            break
+        clusters = fitting
+    if clusters < 16:
+        raise FormatError("Volume too small for exFAT")
+
+    bitmap = bytearray(-(-clusters // 8))
+    upcase = _upcase_table()
+    layout = []
+    cluster = 2
+    for size in (len(bitmap), len(upcase), cluster_size):
+        count = -(-size // cluster_size)
+        layout.append((cluster, count))
+        cluster += count
+    used = cluster - 2
+    for i in range(used):
+        bitmap[i // 8] |= 1 << (i % 8)
+    (bitmap_cluster, _), (upcase_cluster, _), (root_cluster, _) = layout
+
+    boot = bytearray(SECTOR_SIZE)
+    boot[0:3] = b"\xeb\x76\x90"
+    boot[3:11] = b"EXFAT   "
+    struct.pack_into("<QQIIIIIIHHBBBBB", boot, 64, offset // SECTOR_SIZE, sectors, fat_offset, fat_sectors,
+                     heap_offset, clusters, root_cluster, struct.unpack("<I", os.urandom(4))[0],
+                     0x0100, 0, 9, per_cluster.bit_length() - 1, 1, 0x80, used * 100 // clusters)
+    boot[120:120 + len(NO_BOOT_CODE)] = NO_BOOT_CODE
+    boot[510:512] = b"\x55\xaa"
+    extended = bytearray(SECTOR_SIZE)
+    struct.pack_into("<I", extended, 508, 0xAA550000)
+    region = boot + extended * 8 + bytes(2 * SECTOR_SIZE)
+    # VolumeFlags and PercentInUse are left out of the checksum
+    checksum = _exfat_checksum(region, skip=(106, 107, 112))
+    region += struct.pack("<I", checksum) * (SECTOR_SIZE // 4)
+    zero_fill(fd, offset, fat_offset * SECTOR_SIZE)
+    pwrite_all(fd, region, offset)
+    pwrite_all(fd, region, offset + 12 * SECTOR_SIZE)
+
+    fat = bytearray(fat_sectors * SECTOR_SIZE)
+    struct.pack_into("<II", fat, 0, 0xFFFFFFF8, 0xFFFFFFFF)
+    for first, count in layout:
+        for c in range(first, first + count):
+            struct.pack_into("<I", fat, 4 * c, c + 1 if c < first + count - 1 else 0xFFFFFFFF)
+    pwrite_all(fd, fat, offset + fat_offset * SECTOR_SIZE)
+
+    root = bytearray(cluster_size)
+    name = label[:11].encode("utf-16-le")
+    root[0] = 0x83 if label else 0x03
+    root[1] = len(name) // 2
+    root[2:2 + len(name)] = name
+    root[32] = 0x81
+    struct.pack_into("<IQ", root, 32 + 20, bitmap_cluster, len(bitmap))
+    root[64] = 0x82
+    struct.pack_into("<I", root, 64 + 4, _exfat_checksum(upcase))
+    struct.pack_into("<IQ", root, 64 + 20, upcase_cluster, len(upcase))
+
+    heap = offset + heap_offset * SECTOR_SIZE
+    for (first, _), data in zip(layout, (bitmap, upcase, root)):
+        pwrite_all(fd, data, heap + (first - 2) * cluster_size)
+    return {"clusters": clusters, "cluster_size": cluster_size, "fat_sectors": fat_sectors}
+
+
+def format_volume(path, filesystem="FAT32", cluster_size="Default", label="", partition_table="mbr"):
+    # Lays down a partition table and an empty FAT32 or exFAT file system on
+    # a drive or image file. Only metadata is written (a few MB at most), so
+    # this takes well under a second even on slow sticks.
+    writers = {"FAT32": write_fat32, "exFAT": write_exfat}
+    if filesystem not in writers:
+        raise FormatError(f"{filesystem} cannot be created in-process")
+    fd = os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+    try:
+        disk_bytes = device_size(fd)
+        # GPT keeps a backup table in the last 33 sectors
+        tail = 34 * SECTOR_SIZE if partition_table == "gpt" else 0
+        length = (disk_bytes - PARTITION_START - tail) // PARTITION_START * PARTITION_START
+        if length <= 0:
+            raise FormatError(f"{path} is too small to partition")
+        size = CLUSTER_SIZES.get(cluster_size) or default_cluster_size(filesystem, length)
+        write_partition_table(fd, disk_bytes, PARTITION_START, length, filesystem, partition_table)
+        result = writers[filesystem](fd, PARTITION_START, length, size, label)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return dict(result, filesystem=filesystem, partition_table=partition_table,
+                partition_offset=PARTITION_START, partition_size=length)
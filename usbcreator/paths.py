@@ -0,0 +1,39 @@
+import json
+import os
+import threading
+
+
+def state_dir(*parts):
+    # Per-user directory for logs, caches and saved state, created on demand.
+    # USBCREATOR_HOME overrides the default ~/.usbcreator.
+    base = os.environ.get("USBCREATOR_HOME") or os.path.join(os.path.expanduser("~"), ".usbcreator")
+    path = os.path.join(base, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def save_json(path, data, indent=None):
+    # Atomic rewrite of a JSON state file. The temporary file is unique to
+    # the process and thread, so two writers never share one half-written
+    # file; the last os.replace wins.
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=indent)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def load_json(path):
+    # The contents of a JSON state file, {} when it is missing or damaged
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
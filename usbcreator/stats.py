@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import deque
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+def describe_rate(event):
+    # "120/700 MB at 45.2 MB/s, 0:32 left" from a progress event, "" without byte counts
+    if event.get("bytes_total") is None:
+        return ""
+    text = f"{event['bytes_done'] / (1024 * 1024):.0f}/{event['bytes_total'] / (1024 * 1024):.0f} MB"
+    if event.get("rate"):
+        text += f" at {event['rate'] / (1024 * 1024):.1f} MB/s"
+    if event.get("eta") is not None:
+        text += f", {format_duration(event['eta'])} left"
+    return text
+
+
+class ThroughputMeter:
+    # Moving-average rate over the last `window` seconds of (time, bytes)
+    # samples, so a stall or a burst shows up quickly in the rate and ETA.
+    # Fan-out writers update it from several threads.
+    def __init__(self, total, window=5.0):
+        self.total = total
+        self.window = window
+        self.done = 0
+        self._samples = deque()
+        self._lock = threading.Lock()
+
+    def update(self, done, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.done = done
+            self._samples.append((now, done))
+            while len(self._samples) > 2 and now - self._samples[0][0] > self.window:
+                self._samples.popleft()
+
+    @property
+    def rate(self):
+        # Bytes per second, 0 until there are two samples
+        with self._lock:
+            if len(self._samples) < 2:
+                return 0.0
+            (t0, d0), (t1, d1) = self._samples[0], self._samples[-1]
+        return (d1 - d0) / (t1 - t0) if t1 > t0 else 0.0
+
+    @property
+    def eta(self):
+        # Seconds left at the current rate, None while it is unknown
+        rate = self.rate
+        if not rate:
+            return None
+        return max(0.0, (self.total - self.done) / rate)
+
+
+class PhaseTimer:
+    # Wall time spent in each phase of a job, in the order phases ran.
+    # Bytes can be attached to a phase to report its average throughput.
+    def __init__(self):
+        self.durations = {}
+        self.bytes = {}
+        self._current = None
+        self._started = None
+        self._job_started = time.monotonic()
+
+    def start(self, phase):
+        self.stop()
+        self._current = phase
+        self._started = time.monotonic()
+
+    def stop(self):
+        if self._current:
+            elapsed = time.monotonic() - self._started
+            self.durations[self._current] = self.durations.get(self._current, 0.0) + elapsed
+            self._current = None
+
+    @property
+    def total(self):
+        return time.monotonic() - self._job_started
+
+    def summary(self):
+        parts = []
+        for phase, seconds in self.durations.items():
+            text = f"{phase} {seconds:.2f}s"
+            if self.bytes.get(phase) and seconds > 0:
+                text += f" ({self.bytes[phase] / seconds / (1024 * 1024):.1f} MB/s)"
+            parts.append(text)
+        parts.append(f"total {self.total:.2f}s")
+        return ", ".join(parts)
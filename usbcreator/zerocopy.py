@@ -0,0 +1,281 @@
+import errno
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from usbcreator.engine import (DEFAULT_CHUNK_SIZE, FLUSH_WINDOW, HASH_WORKERS, CopyCancelled, TargetWriter,
+                               chunk_digest, drop_cached_range)
+
+# Tried in this order; copy_file_range only works between files (and only
+# some file system pairs), sendfile writes to any fd, splice goes through
+# a pipe but works with block devices on every kernel that has it
+KERNEL_BACKENDS = ("copy_file_range", "sendfile", "splice")
+COPY_BACKENDS = ("auto", "buffered") + KERNEL_BACKENDS
+# What the kernel answers when a backend cannot do this pair of files
+UNSUPPORTED_ERRNOS = {errno.EINVAL, errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP,
+                      errno.EBADF, errno.ESPIPE}
+# Bigger pipes mean fewer splice calls per chunk
+PIPE_SIZE = 1024 * 1024
+
+
+class ZeroCopyUnsupported(Exception):
+    pass
+
+
+def available_backends():
+    return [backend for backend in KERNEL_BACKENDS if hasattr(os, backend)]
+
+
+class KernelWriter(TargetWriter):
+    # A TargetWriter fed by the kernel straight from the source fd, the
+    # data never reaches Python. backend is the one that worked for this
+    # target (see KernelCopier.probe).
+    def __init__(self, path, start_offset=0, checkpoint=None, flush_window=None):
+        super().__init__(path, start_offset=start_offset, checkpoint=checkpoint, flush_window=flush_window)
+        self.backend = None
+        self._pipe = None
+
+    def copy_range(self, src_fd, offset, count, backend=None):
+        # Copies count bytes at offset of src_fd to the same offset of the
+        # target; returns the number of bytes copied
+        backend = backend or self.backend
+        done = 0
+        while done < count:
+            if backend == "copy_file_range":
+                step = os.copy_file_range(src_fd, self.fd, count - done, offset + done, offset + done)
+            elif backend == "sendfile":
+                step = os.sendfile(self.fd, src_fd, offset + done, count - done)
+            else:
+                step = self._splice(src_fd, offset + done, count - done)
+            if not step:
+                break
+            done += step
+        return done
+
+    def _splice(self, src_fd, offset, count):
+        if self._pipe is None:
+            self._pipe = os.pipe()
+            try:
+                import fcntl
+                fcntl.fcntl(self._pipe[1], fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+            except (ImportError, AttributeError, OSError):
+                pass
+        read_end, write_end = self._pipe
+        moved = os.splice(src_fd, write_end, min(count, PIPE_SIZE), offset_src=offset)
+        left = moved
+        while left:
+            left -= os.splice(read_end, self.fd, left)
+        return moved
+
+    def advance(self, src_fd, count):
+        # Bookkeeping after copy_range, including journal checkpoints; the
+        # segment hash is taken from the source, which is in the page cache
+        self.bytes_written += count
+        if self.write_behind:
+            self.write_behind.advance(self.bytes_written)
+        if self.checkpoint and self.bytes_written % self.checkpoint.segment_bytes == 0:
+            os.fsync(self.fd)
+            self.checkpoint.commit(self.bytes_written, self._source_hash(src_fd, self.bytes_written))
+
+    def _source_hash(self, src_fd, end):
+        h = hashlib.sha256()
+        offset = end - self.checkpoint.segment_bytes
+        while offset < end:
+            data = os.pread(src_fd, min(DEFAULT_CHUNK_SIZE, end - offset), offset)
+            if not data:
+                break
+            h.update(data)
+            offset += len(data)
+        return h.digest()
+
+    def close(self):
+        super().close()
+        if self._pipe:
+            for fd in self._pipe:
+                os.close(fd)
+            self._pipe = None
+
+
+class KernelCopier:
+    # Same job and interface as FanOutCopier (writers, source_digests,
+    # total_bytes, sync_seconds, run()), but each target gets its own
+    # thread asking the kernel to copy chunk_size bytes at a time with
+    # copy_file_range, sendfile or splice. Only for plain images written
+    # as they are: no decompression, no zero skipping.
+    #
+    # backend "auto" picks the first of KERNEL_BACKENDS that works for
+    # each target; run() raises ZeroCopyUnsupported, having written at most
+    # the first chunk, when a target supports none of them, so the caller
+    # can fall back to the buffered engine.
+    #
+    # With hash_source a separate thread reads and hashes the source for
+    # TargetVerifier; those reads are served by the page cache the copies
+    # fill anyway.
+    #
+    # cache_friendly works as in FanOutCopier; the source is dropped from
+    # the cache behind the slowest target (and the hash thread).
+    def __init__(self, source, targets, chunk_size=DEFAULT_CHUNK_SIZE, progress_callback=None,
+                 hash_source=False, sync_callback=None, start_offset=0, checkpoints=None, backend="auto",
+                 cache_friendly=False):
+        if not targets:
+            raise ValueError("No copy targets given")
+        if start_offset % chunk_size:
+            raise ValueError("start_offset must be a multiple of chunk_size")
+        self.source = source
+        self.chunk_size = chunk_size
+        self.queue_depth = 1
+        self.progress_callback = progress_callback
+        self.hash_source = hash_source
+        self.sync_callback = sync_callback
+        self.sync_seconds = 0.0
+        self.start_offset = start_offset
+        self.backends = available_backends() if backend == "auto" else [backend]
+        self.cache_friendly = cache_friendly
+        checkpoints = checkpoints or {}
+        flush_window = FLUSH_WINDOW if cache_friendly else None
+        self.writers = [KernelWriter(t, start_offset, checkpoints.get(t), flush_window) for t in targets]
+        self.total_bytes = os.path.getsize(source)
+        self.source_digests = []
+        self._abort = threading.Event()
+        self._hashed = self.total_bytes if not hash_source else 0
+        self._dropped = 0
+        self._drop_lock = threading.Lock()
+
+    @property
+    def backend(self):
+        # "sendfile", or e.g. "copy_file_range+sendfile" when targets differ
+        used = []
+        for writer in self.writers:
+            if writer.backend and writer.backend not in used:
+                used.append(writer.backend)
+        return "+".join(used) or None
+
+    def cancel(self):
+        self._abort.set()
+
+    def probe(self, src_fd, writer):
+        # Copies the first chunk with each backend until one works
+        count = min(self.chunk_size, self.total_bytes - self.start_offset)
+        for backend in self.backends:
+            if not hasattr(os, backend):
+                continue
+            try:
+                os.lseek(writer.fd, self.start_offset, os.SEEK_SET)
+                if writer.copy_range(src_fd, self.start_offset, count, backend) == count:
+                    writer.backend = backend
+                    return count
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+        raise ZeroCopyUnsupported(f"None of {', '.join(self.backends)} can write to {writer.path}")
+
+    def run(self):
+        src_fd = os.open(self.source, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            for writer in self.writers:
+                try:
+                    writer.open()
+                except OSError as e:
+                    writer.error = e
+            if all(writer.error for writer in self.writers):
+                raise self.writers[0].error
+            # Probing writes the first chunk; a target no backend can write
+            # to sends the whole copy back to the buffered engine, an I/O
+            # error only loses that target
+            first = {}
+            for writer in self.writers:
+                if writer.error:
+                    continue
+                if self.start_offset < self.total_bytes:
+                    try:
+                        first[writer.path] = self.probe(src_fd, writer)
+                    except OSError as e:
+                        writer.error = e
+                else:
+                    writer.backend = self.backends[0] if self.backends else None
+            if all(writer.error for writer in self.writers):
+                raise self.writers[0].error
+
+            digests = None
+            with ThreadPoolExecutor(len(self.writers) + (1 if self.hash_source else 0)) as pool:
+                if self.hash_source:
+                    digests = pool.submit(self._hash_source, src_fd)
+                results = [pool.submit(self._copy, src_fd, writer, first.get(writer.path, 0))
+                           for writer in self.writers if not writer.error]
+                for result in results:
+                    result.result()
+            if self._abort.is_set():
+                raise CopyCancelled("Copy cancelled")
+            if all(writer.error for writer in self.writers):
+                raise self.writers[0].error
+            if digests:
+                self.source_digests = digests.result()
+
+            if self.sync_callback:
+                self.sync_callback()
+            started = time.monotonic()
+            live = [writer for writer in self.writers if writer.error is None]
+            with ThreadPoolExecutor(len(live)) as pool:
+                results = [(writer, pool.submit(writer.finish, self.total_bytes)) for writer in live]
+            for writer, result in results:
+                try:
+                    result.result()
+                except OSError as e:
+                    writer.error = e
+            self.sync_seconds = time.monotonic() - started
+        finally:
+            for writer in self.writers:
+                writer.close()
+            os.close(src_fd)
+        return self.writers
+
+    def _copy(self, src_fd, writer, first):
+        try:
+            if first:
+                writer.advance(src_fd, first)
+                self._report(writer)
+            offset = writer.bytes_written
+            while offset < self.total_bytes and not self._abort.is_set():
+                count = writer.copy_range(src_fd, offset, min(self.chunk_size, self.total_bytes - offset))
+                if not count:
+                    raise OSError(errno.EIO, f"Short copy at byte {offset}")
+                writer.advance(src_fd, count)
+                offset += count
+                self._report(writer)
+                if self.cache_friendly:
+                    self._drop_source_cache(src_fd)
+        except Exception as e:
+            # Only this target is lost
+            writer.error = e
+            if all(w.error for w in self.writers):
+                self._abort.set()
+
+    def _report(self, writer):
+        if self.progress_callback:
+            self.progress_callback(writer.path, writer.bytes_on_device, self.total_bytes)
+
+    def _drop_source_cache(self, src_fd):
+        with self._drop_lock:
+            done = min([w.bytes_written for w in self.writers if not w.error] + [self._hashed])
+            if done - self._dropped >= FLUSH_WINDOW:
+                drop_cached_range(src_fd, self._dropped, done - self._dropped)
+                self._dropped = done
+
+    def _hash_source(self, src_fd):
+        # Digests per chunk, like FanOutCopier(hash_source=True) records
+        digests = []
+        with ThreadPoolExecutor(HASH_WORKERS) as pool:
+            futures = []
+            for offset in range(0, self.total_bytes, self.chunk_size):
+                if self._abort.is_set():
+                    break
+                futures.append(pool.submit(chunk_digest, os.pread(src_fd, self.chunk_size, offset)))
+                self._hashed = offset
+                # Bound the chunks held in memory
+                if len(futures) - len(digests) > 2 * HASH_WORKERS:
+                    digests.append(futures[len(digests)].result())
+            digests.extend(future.result() for future in futures[len(digests):])
+        self._hashed = self.total_bytes
+        return digests